@@ -0,0 +1,113 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare streaming and eager decoding of NewtsClient.fetch.
+
+Each mode runs in its own process against a local HTTP server serving a
+synthetic /measurements response, peak RSS is thus not shared:
+
+    python benchmarks/bench_decode.py --points 1000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def serve(points):
+    row = '[{"name":"metric","timestamp":%d,"value":%f,"type":"GAUGE"}]'
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'[')
+            batch = []
+            for i in range(points):
+                batch.append(row % (i * 60000, i * 0.5))
+                if len(batch) == 1000 or i == points - 1:
+                    if i >= 1000:
+                        self.wfile.write(b',')
+                    self.wfile.write(','.join(batch).encode('ascii'))
+                    batch = []
+            self.wfile.write(b']')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run(url, stream):
+    from graphite_newts.client import NewtsClient
+    client = NewtsClient(url, stream=stream)
+    start = time.time()
+    first = None
+    count = 0
+    for timestamp, value in client.fetch('bench', 'metric', 0, 86400, 60):
+        if first is None:
+            first = time.time() - start
+        count += 1
+    total = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'stream': stream, 'points': count,
+                      'first_point': first, 'total': total,
+                      'maxrss_kb': maxrss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=500000)
+    parser.add_argument('--run', choices=['stream', 'eager'])
+    parser.add_argument('--url')
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.url, args.run == 'stream')
+        return
+
+    server = serve(args.points)
+    url = 'http://127.0.0.1:%d' % server.server_port
+    print('%-8s %10s %14s %10s %12s' % ('mode', 'points', 'first point',
+                                        'total', 'peak RSS'))
+    for mode in ('eager', 'stream'):
+        output = subprocess.check_output([sys.executable, __file__,
+                                          '--run', mode, '--url', url])
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+        print('%-8s %10d %12.3fs %9.3fs %9.1f MB' % (
+            mode, result['points'], result['first_point'], result['total'],
+            result['maxrss_kb'] / 1024.0))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
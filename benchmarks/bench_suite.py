@@ -0,0 +1,246 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark finds, fetches and renders against a local newts stand-in.
+
+Each operation runs --iterations times, p50/p99 latency and the newts
+requests issued per run are reported, peak memory is measured with
+tracemalloc over one more run. Results can be saved as a baseline and later
+runs compared against it, exiting non-zero on regressions:
+
+    python benchmarks/bench_suite.py --save benchmarks/baseline.json
+    python benchmarks/bench_suite.py --compare benchmarks/baseline.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import newts_standin  # noqa: E402
+
+DAY = 86400
+
+# graphite-api logs at debug level by default, that is noise here
+LOGGING = {'version': 1,
+           'handlers': {'raw': {'level': 'WARNING',
+                                'class': 'logging.StreamHandler',
+                                'formatter': 'raw'}},
+           'loggers': {'root': {'handlers': ['raw'], 'level': 'WARNING',
+                                'propagate': False},
+                       'graphite_api': {'handlers': ['raw'],
+                                        'level': 'WARNING'}}}
+
+
+def configure_app(url, newts_config):
+    """Point graphite-api at url and return its flask app.
+
+    graphite-api reads its configuration once, on import."""
+    config = {'finders': ['graphite_newts.finder.NewtsFinder'],
+              'functions': ['graphite_api.functions.SeriesFunctions'],
+              'search_index': os.path.join(tempfile.gettempdir(),
+                                           'graphite-newts-bench-index'),
+              'time_zone': 'UTC',
+              'logging': LOGGING,
+              'newts': dict(newts_config, url=url)}
+    fd, path = tempfile.mkstemp(suffix='.yaml')
+    with os.fdopen(fd, 'w') as f:
+        # JSON is valid YAML
+        json.dump(config, f)
+    os.environ['GRAPHITE_API_CONFIG'] = path
+    try:
+        from graphite_api.app import app
+    finally:
+        os.unlink(path)
+    return app, config
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    index = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def operations(app, config, now):
+    from graphite_api.storage import FindQuery
+    from graphite_newts.finder import NewtsFinder
+
+    finder = NewtsFinder(config)
+    start = now - DAY
+
+    def find(pattern):
+        query = FindQuery(pattern, start, now)
+        return lambda: list(finder.find_nodes(query))
+
+    def fetch(path):
+        node, = finder.find_nodes(FindQuery(path, start, now))
+        return lambda: node.reader.fetch(start, now)
+
+    def fetch_multi(pattern):
+        nodes = list(finder.find_nodes(FindQuery(pattern, start, now)))
+        return lambda: finder.fetch_multi(nodes, start, now)
+
+    client = app.test_client()
+
+    def render(target):
+        body = {'target': target, 'from': '-1d', 'format': 'json'}
+
+        def run():
+            response = client.post('/render', data=json.dumps(body),
+                                   content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError('render failed with %d: %s' % (
+                    response.status_code, response.data[:200]))
+            return response.data
+        return run
+
+    return [('find_root', find('*')),
+            ('find_branches', find('n0.n*.*')),
+            ('find_leaves', find('n0.n1.n2.*')),
+            ('find_wide', find('n0.*.*.m{0,1}')),
+            ('find_prefix', find('n0.n1*.*.m{0,1}')),
+            ('reader_fetch', fetch('n0.n1.n2.m0')),
+            ('fetch_multi', fetch_multi('n0.n1.*.*')),
+            ('render', render('n0.n1.n2.m0')),
+            ('render_wide', render('sumSeries(n0.n*.*.m0)'))]
+
+
+def measure(server, func, iterations):
+    func()  # warm up connections and caches
+    server.reset()
+    latencies = []
+    for _ in range(iterations):
+        started = time.time()
+        func()
+        latencies.append(time.time() - started)
+    requests = dict((k, v / float(iterations))
+                    for k, v in server.requests.items())
+    received = sum(server.bytes_sent.values()) / float(iterations)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'requests': requests,
+            'received_bytes': received,
+            'peak_bytes': peak}
+
+
+def compare(results, baseline, tolerance):
+    """Return a description of each regression of results over baseline."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for key in ('p50_ms', 'p99_ms', 'peak_bytes'):
+            if old.get(key) and result.get(key) is not None and \
+                    result[key] > old[key] * (1 + tolerance):
+                regressions.append('%s %s %.1f -> %.1f' % (
+                    name, key, old[key], result[key]))
+        for endpoint, count in sorted(result['requests'].items()):
+            if count > old['requests'].get(endpoint, 0):
+                regressions.append('%s %s requests %g -> %g' % (
+                    name, endpoint, old['requests'].get(endpoint, 0),
+                    count))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--metrics', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every newts response')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--only', action='append',
+                        help='run only the named operation(s)')
+    parser.add_argument('--newts', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='newts finder setting, the value is YAML')
+    parser.add_argument('--save', help='write results to this file')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative increase over the baseline')
+    args = parser.parse_args()
+
+    import yaml
+    newts_config = {}
+    for setting in args.newts:
+        key, _, value = setting.partition('=')
+        newts_config[key] = yaml.safe_load(value)
+
+    tree = newts_standin.Tree(args.fanout, args.depth, args.metrics)
+    server = newts_standin.start(tree, args.latency)
+    app, config = configure_app(server.url, newts_config)
+
+    setup = {'fanout': args.fanout, 'depth': args.depth,
+             'metrics': args.metrics, 'latency': args.latency,
+             'newts': newts_config}
+    results = {}
+    print('%-14s %10s %10s %24s %10s' % ('operation', 'p50', 'p99',
+                                         'newts requests', 'peak mem'))
+    for name, func in operations(app, config, int(time.time())):
+        if args.only and name not in args.only:
+            continue
+        result = measure(server, func, args.iterations)
+        results[name] = result
+        requests = ' '.join('%s=%g' % x
+                            for x in sorted(result['requests'].items()))
+        peak = '-'
+        if result['peak_bytes'] is not None:
+            peak = '%.1f MB' % (result['peak_bytes'] / 1048576.0)
+        print('%-14s %8.2fms %8.2fms %24s %10s' % (
+            name, result['p50_ms'], result['p99_ms'], requests, peak))
+    server.shutdown()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'setup': setup, 'results': results}, f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['setup'] != setup:
+            print('baseline setup differs, not comparing: %s' %
+                  json.dumps(baseline['setup'], sort_keys=True))
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the newts REST API over a synthetic tree.
+
+Resources are named n0..n<fanout-1> at each level, e.g. n3:n0:n7 for a
+depth of 3, and only resources at the deepest level have metrics
+m0..m<metrics-1>. /search supports _parent: terms joined by OR,
+/measurements returns a sine wave for each export. Run standalone with:
+
+    python benchmarks/newts_standin.py --port 8080 --fanout 10 --depth 3
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qs, urlparse
+
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+class Tree(object):
+    def __init__(self, fanout=10, depth=3, metrics=5):
+        self.fanout = fanout
+        self.depth = depth
+        self.metrics = ['m%d' % i for i in range(metrics)]
+
+    def _level(self, resource):
+        return 0 if resource is None else resource.count(':') + 1
+
+    def children(self, parent):
+        level = self._level(parent)
+        if level >= self.depth:
+            return []
+        prefix = '' if parent is None else parent + ':'
+        metrics = self.metrics if level + 1 == self.depth else []
+        return [(prefix + 'n%d' % i, metrics) for i in range(self.fanout)]
+
+    def exists(self, resource):
+        names = resource.split(':')
+        if len(names) > self.depth:
+            return False
+        for name in names:
+            if not re.match(r'n\d+$', name) or int(name[1:]) >= self.fanout:
+                return False
+        return True
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tree, latency=0.0):
+        HTTPServer.__init__(self, address, Handler)
+        self.tree = tree
+        self.latency = latency
+        self.requests = Counter()
+        self.bytes_sent = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, endpoint, size):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes_sent[endpoint] += size
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent.clear()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+def _parse_date(value):
+    # NewtsClient formats local times with a literal Z suffix
+    parsed = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.000Z')
+    return int(time.mktime(parsed.timetuple()))
+
+
+def _parse_duration(value):
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    return int(value[:-1]) * units[value[-1]]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, endpoint, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        # count before replying, the client may be done right after
+        self.server.count(endpoint, len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/search':
+            return self._reply('error', {'error': 'not found'}, 404)
+
+        query = parse_qs(url.query).get('q', [''])[0]
+        # (_parent:a OR _parent:b) AND (_name:c* OR _name:d)
+        terms = {'_parent': [], '_name': []}
+        for clause in query.split(' AND '):
+            for term in clause.strip('()').split(' OR '):
+                field, _, value = term.partition(':')
+                if field in terms:
+                    terms[field].append(value)
+
+        def accept(resource):
+            name = resource.rsplit(':', 1)[-1]
+            for value in terms['_name']:
+                if value.endswith('*') and not value.endswith('\\*'):
+                    if name.startswith(_UNESCAPE.sub(r'\1', value[:-1])):
+                        return True
+                elif name == _UNESCAPE.sub(r'\1', value):
+                    return True
+            return not terms['_name']
+
+        results = []
+        for value in terms['_parent']:
+            value = _UNESCAPE.sub(r'\1', value)
+            parent = None if value == '_root' else value
+            for resource, metrics in self.server.tree.children(parent):
+                if not accept(resource):
+                    continue
+                results.append({'resource': {'id': resource,
+                                             'attributes': {}},
+                                'metrics': metrics})
+        self._reply('search', results)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        descriptor = json.loads(self.rfile.read(length).decode('utf-8'))
+        if not url.path.startswith('/measurements/'):
+            return self._reply('error', {'error': 'not found'}, 404)
+
+        resource = unquote(url.path[len('/measurements/'):])
+        if not self.server.tree.exists(resource):
+            return self._reply('measurements', [])
+
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        step = _parse_duration(params['resolution'])
+        start = _parse_date(params['start'])
+        end = _parse_date(params['end'])
+        start -= start % step
+
+        rows = []
+        seed = sum(ord(c) for c in resource)
+        for timestamp in range(start, end + 1, step):
+            rows.append([{'name': export,
+                          'timestamp': timestamp * 1000,
+                          'type': 'GAUGE',
+                          'value': math.sin((timestamp + seed) / 3600.0)}
+                         for export in descriptor['exports']])
+        self._reply('measurements', rows)
+
+
+def start(tree, latency=0.0, address=('127.0.0.1', 0)):
+    """Start a stand-in server in a background thread and return it."""
+    server = StandinServer(address, tree, latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--metrics', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    args = parser.parse_args()
+
+    server = StandinServer((args.address, args.port),
+                           Tree(args.fanout, args.depth, args.metrics),
+                           args.latency)
+    print('newts stand-in listening on %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
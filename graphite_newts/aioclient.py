@@ -0,0 +1,305 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio newts client, for python 3 with aiohttp installed.
+
+The package doesn't import this module, NewtsFinder loads it only with
+fetch.async enabled."""
+
+import asyncio
+import json
+import os
+import threading
+import time
+
+import aiohttp
+from structlog import get_logger
+
+from . import client
+from . import endpoints
+from .deadlines import DeadlineExceeded
+from . import stats as newts_stats
+
+logger = get_logger()
+
+
+class AsyncNewtsClient(object):
+    """Coroutine counterpart of NewtsClient.
+
+    At most limit connections are open at a time, requests beyond that
+    wait for a connection. Connection errors are retried up to retries
+    times, newts requests being idempotent, on another node if url lists
+    several. Nodes are picked and hedged like NewtsClient does. Requests
+    given a deadline are cancelled once it expires, raising
+    DeadlineExceeded."""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, limit=100, connect_timeout=3.05, read_timeout=30,
+                 retries=2, stats=None, eject_failures=3, eject_latency=0,
+                 eject_cooldown=30, hedge_percentile=0):
+        self.url = url
+        self.limit = limit
+        self.retries = retries
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self.stats = stats or newts_stats.NullStats()
+        self.endpoints = endpoints.EndpointPool(
+                endpoints.endpoint_urls(url), max_failures=eject_failures,
+                slow_latency=eject_latency, cooldown=eject_cooldown,
+                hedge_percentile=hedge_percentile, stats=self.stats)
+        self._session = None
+
+    def _get_session(self):
+        # the session is bound to the loop it is created from
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _request(self, endpoint, method, path, convert, deadline=None,
+                       **kwargs):
+        # decode the response as it comes, converting each element of the
+        # returned array with convert, None results are left out
+        if deadline is None:
+            return await self._attempts(endpoint, method, path, convert,
+                                        **kwargs)
+        try:
+            return await asyncio.wait_for(
+                    self._attempts(endpoint, method, path, convert, **kwargs),
+                    deadline.remaining())
+        except asyncio.TimeoutError:
+            deadline.check()
+            raise
+
+    async def _attempts(self, endpoint, method, path, convert, **kwargs):
+        attempts = max(self.retries, len(self.endpoints) - 1) + 1
+        tried = []
+        while True:
+            node = self.endpoints.pick(exclude=tried)
+            tried.append(node)
+            delay = self.endpoints.hedge_delay()
+            try:
+                if delay is None:
+                    return await self._send(endpoint, node, method, path,
+                                            convert, **kwargs)
+                return await self._hedge(endpoint, node, delay, method, path,
+                                         convert, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if len(tried) >= attempts:
+                    raise
+
+    async def _send(self, endpoint, node, method, path, convert, **kwargs):
+        self.stats.incr('http.%s.requests' % endpoint)
+        self.stats.adjust('http.inflight', 1)
+        started = time.time()
+        # cancelled requests, e.g. hedges lost, have no outcome
+        elapsed = None
+        ok = False
+        try:
+            async with self._get_session().request(method, node.url + path,
+                                                   **kwargs) as response:
+                elapsed = time.time() - started
+                ok = response.status < 500
+                self.stats.timing('http.%s.latency' % endpoint, elapsed)
+                if response.status >= 400:
+                    self.stats.incr('http.%s.errors' % endpoint)
+                response.raise_for_status()
+                return await self._decode(endpoint, response, convert)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            elapsed = time.time() - started
+            self.stats.incr('http.%s.errors' % endpoint)
+            raise
+        finally:
+            self.stats.adjust('http.inflight', -1)
+            self.endpoints.done(node, elapsed, ok)
+
+    async def _hedge(self, endpoint, node, delay, method, path, convert,
+                     **kwargs):
+        # send to node, and to another node if it doesn't answer in delay
+        pending = {asyncio.ensure_future(self._send(
+                endpoint, node, method, path, convert, **kwargs))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return done.pop().result()
+
+            other = self.endpoints.pick(exclude=[node])
+            if other is node:
+                self.endpoints.done(other)
+                return await pending.pop()
+            self.stats.incr('http.%s.hedged' % endpoint)
+            second = asyncio.ensure_future(self._send(
+                    endpoint, other, method, path, convert, **kwargs))
+            pending.add(second)
+
+            while True:
+                done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is second:
+                            self.stats.incr('http.%s.hedge_wins' % endpoint)
+                        return future.result()
+                if not pending:
+                    return done.pop().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _decode(self, endpoint, response, convert):
+        decoder = client.ArrayDecoder()
+        result = []
+        size = 0
+        async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+            size += len(chunk)
+            for element in decoder.feed(chunk):
+                element = convert(element)
+                if element is not None:
+                    result.append(element)
+        decoder.close()
+        self.stats.incr('http.%s.bytes' % endpoint, size)
+        return result
+
+    async def fetch_multi(self, resource, metrics, start, end, resolution,
+                          function='AVERAGE', functions=None, interval='30s',
+                          heartbeat='1m', deadline=None):
+        """Return the [(timestamp, values), ...] rows of
+        NewtsClient.fetch_multi."""
+        descriptor = client.result_descriptor(metrics, function, functions,
+                                              interval, heartbeat)
+
+        def convert(group):
+            if not group:
+                return None
+            return group[0]['timestamp'], client.row_values(group)
+
+        rows = await self._request(
+                'measurements', 'POST', '/measurements/{}'.format(resource),
+                convert, deadline,
+                data=json.dumps(descriptor),
+                params=client.measurements_params(start, end, resolution),
+                headers={'Content-Type': 'application/json'})
+        self.stats.incr('fetch.points', sum(len(x[1]) for x in rows))
+        return rows
+
+    async def search(self, *terms, deadline=None, strict=False):
+        """Return the [(resource, metrics), ...] results of
+        NewtsClient.search."""
+        logger.debug("search", terms=terms)
+
+        def convert(result):
+            return result['resource']['id'], result['metrics']
+
+        try:
+            return await self._request('search', 'GET', '/search', convert,
+                                       deadline,
+                                       params={'q': ' AND '.join(terms)})
+        except aiohttp.ClientResponseError as e:
+            logger.warn("search_error", exception=e)
+            if strict:
+                raise
+            return []
+
+    async def fetch_many(self, requests, deadline=None):
+        """Run fetch_multi() for each of requests, a list of its keyword
+        arguments, concurrently. Return the rows or the exception of each
+        request, in order."""
+        return await asyncio.gather(
+                *[self.fetch_multi(deadline=deadline, **x) for x in requests],
+                return_exceptions=True)
+
+    async def search_many(self, terms, deadline=None, strict=False):
+        """Run search() for each of terms concurrently. Return the results
+        or the exception of each term, in order."""
+        return await asyncio.gather(
+                *[self.search(x, deadline=deadline, strict=strict)
+                  for x in terms],
+                return_exceptions=True)
+
+
+class SyncNewtsClient(object):
+    """Blocking facade of AsyncNewtsClient, callable from any thread.
+
+    Requests run on an event loop in a background thread, shared by all
+    callers. Besides the NewtsClient interface it has fetch_many() and
+    search_many(), running many requests concurrently on that loop."""
+
+    def __init__(self, url, **kwargs):
+        self.url = url
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._pid = None
+        self._loop = None
+        self._client = None
+
+    def _start(self):
+        # threads don't survive fork(), start the loop in each process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            self._client = AsyncNewtsClient(self.url, **self._kwargs)
+            thread = threading.Thread(target=self._loop.run_forever,
+                                      name='newts-async')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, coroutine_function, *args, **kwargs):
+        self._start()
+        future = asyncio.run_coroutine_threadsafe(
+                coroutine_function(self._client, *args, **kwargs),
+                self._loop)
+        return future.result()
+
+    def fetch(self, resource, metric, start, end, resolution,
+              function='AVERAGE', deadline=None):
+        rows = self.fetch_multi(resource, [metric], start, end, resolution,
+                                function, deadline=deadline)
+        return [(ts, values[metric]) for ts, values in rows
+                if metric in values]
+
+    def fetch_multi(self, resource, metrics, start, end, resolution,
+                    function='AVERAGE', functions=None, interval='30s',
+                    heartbeat='1m', deadline=None):
+        return self._run(AsyncNewtsClient.fetch_multi, resource, metrics,
+                         start, end, resolution, function, functions,
+                         interval, heartbeat, deadline)
+
+    def search(self, *terms, deadline=None, strict=False):
+        return self._run(AsyncNewtsClient.search, *terms, deadline=deadline,
+                         strict=strict)
+
+    def fetch_many(self, requests, deadline=None):
+        return self._run(AsyncNewtsClient.fetch_many, requests, deadline)
+
+    def search_many(self, terms, deadline=None, strict=False):
+        return self._run(AsyncNewtsClient.search_many, terms, deadline,
+                         strict)
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._run(AsyncNewtsClient.close)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._pid = None
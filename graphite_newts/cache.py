@@ -0,0 +1,533 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from structlog import get_logger
+
+from . import series
+from .deadlines import DeadlineExceeded
+from . import stats as newts_stats
+
+logger = get_logger()
+
+
+class _Lookup(object):
+    __slots__ = ('resource', 'metrics', 'time_info', 'functions', 'buckets',
+                 'chunks', 'missing', 'start', 'end')
+
+    def __init__(self, resource, metrics, time_info, functions, buckets,
+                 chunks):
+        self.resource = resource
+        self.metrics = metrics
+        self.time_info = time_info
+        self.functions = functions
+        self.buckets = buckets
+        self.chunks = chunks
+        self.missing = []
+        self.start = self.end = None
+
+
+class FetchCache(object):
+    """Cache of fetched series split in fixed, step-aligned time buckets.
+
+    backend is a graphite-api cache (i.e. app.cache) or None. Each bucket
+    holds bucket_points slots of one metric at one resolution, buckets
+    ending more than settle seconds ago are immutable and kept for ttl
+    seconds, more recent ones for recent_ttl seconds only.
+
+    disk, if given, is a DiskCache looked up for buckets missing from
+    backend, fetched buckets are stored in both."""
+
+    def __init__(self, backend, bucket_points=120, ttl=86400, recent_ttl=30,
+                 settle=300, stats=None, disk=None):
+        self.backend = backend
+        self.disk = disk
+        self.bucket_points = bucket_points
+        self.ttl = ttl
+        self.recent_ttl = recent_ttl
+        self.settle = settle
+        self.stats = stats or newts_stats.NullStats()
+
+    def _key(self, resource, metric, function, step, bucket):
+        # resources can be long and contain spaces, not valid memcached
+        # keys
+        key = json.dumps([step, function, bucket, resource, metric])
+        digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return 'newts-fetch:{}'.format(digest)
+
+    def fetch(self, fetcher, resource, metrics, time_info, functions=None):
+        """Return a SeriesBuffer over time_info for each metric.
+
+        Cached buckets are reused, for each metric the range from its
+        first missing bucket up to the end is fetched with
+        fetcher(metrics, start, end), which must yield rows like
+        NewtsClient.fetch_multi does. Fetched buckets are then cached.
+        functions maps metrics to the aggregation function they are
+        fetched with, AVERAGE by default."""
+        lookup = self.lookup(resource, metrics, time_info, functions)
+        rows = ()
+        if lookup.missing:
+            rows = fetcher(lookup.missing, lookup.start, lookup.end)
+        return self.complete(lookup, rows)
+
+    def lookup(self, resource, metrics, time_info, functions=None):
+        """Look up the cached buckets of metrics, the first half of fetch().
+
+        The returned lookup tells the metrics to fetch, if any, in its
+        missing attribute and the range to fetch them over in start and
+        end. Pass it to complete() along with the fetched rows."""
+        functions = functions or {}
+        start, end, step = time_info
+        span = step * self.bucket_points
+        buckets = list(range(start - start % span, end, span))
+
+        keys = [(metric, bucket) for metric in metrics for bucket in buckets]
+        cached = self._get_many(
+                [self._key(resource, metric,
+                           functions.get(metric, 'AVERAGE'), step, bucket)
+                 for metric, bucket in keys])
+        chunks = dict((k, v) for k, v in zip(keys, cached) if v is not None)
+        self.stats.incr('cache.fetch.hits', len(chunks))
+        self.stats.incr('cache.fetch.misses', len(keys) - len(chunks))
+
+        missing = {}
+        for metric, bucket in keys:
+            if (metric, bucket) not in chunks and metric not in missing:
+                missing[metric] = bucket
+
+        lookup = _Lookup(resource, metrics, time_info, functions, buckets,
+                         chunks)
+        if missing:
+            lookup.missing = sorted(missing)
+            lookup.start = min(missing.values())
+            lookup.end = buckets[-1] + span
+            logger.debug("fetch_cache_miss", resource=resource,
+                         metrics=lookup.missing, start=lookup.start,
+                         end=lookup.end, cached=len(chunks))
+        return lookup
+
+    def complete(self, lookup, rows):
+        """Cache rows fetched for lookup and return the buffers of fetch()."""
+        start, end, step = lookup.time_info
+        chunks = lookup.chunks
+        if lookup.missing:
+            fetched = dict((metric, series.SeriesBuffer(lookup.start,
+                                                        lookup.end, step))
+                           for metric in lookup.missing)
+            series.fill(fetched, rows)
+            self._store(lookup.resource, lookup.functions, step, fetched,
+                        chunks)
+
+        buffers = {}
+        for metric in lookup.metrics:
+            buf = buffers[metric] = series.SeriesBuffer(start, end, step)
+            for bucket in lookup.buckets:
+                buf.update(bucket, chunks[(metric, bucket)])
+        return buffers
+
+    def _get_many(self, keys):
+        if self.backend is not None:
+            cached = self.backend.get_many(*keys)
+        else:
+            cached = [None] * len(keys)
+        if self.disk is None:
+            return cached
+
+        missing = [i for i, chunk in enumerate(cached) if chunk is None]
+        if missing:
+            found = self.disk.get_many(*[keys[i] for i in missing])
+            hits = 0
+            for i, chunk in zip(missing, found):
+                if chunk is not None:
+                    cached[i] = chunk
+                    hits += 1
+            self.stats.incr('cache.fetch.disk_hits', hits)
+        return cached
+
+    def _store(self, resource, functions, step, fetched, chunks):
+        settled = time.time() - self.settle
+        span = step * self.bucket_points
+        by_timeout = {}
+        for metric, buf in fetched.items():
+            for offset in range(0, len(buf.values), self.bucket_points):
+                bucket = buf.start + offset * step
+                chunk = buf.values[offset:offset + self.bucket_points]
+                chunks[(metric, bucket)] = chunk
+                if bucket + span <= settled:
+                    timeout = self.ttl
+                else:
+                    timeout = self.recent_ttl
+                key = self._key(resource, metric,
+                                functions.get(metric, 'AVERAGE'), step,
+                                bucket)
+                by_timeout.setdefault(timeout, {})[key] = chunk
+
+        for timeout, mapping in by_timeout.items():
+            if self.backend is not None:
+                self.backend.set_many(mapping, timeout=timeout)
+            if self.disk is not None:
+                self.disk.set_many(mapping, timeout)
+
+
+def _encode(results, compress=True, max_size=None):
+    """Encode search results as JSON lines, zlib compressed if compress.
+
+    Return (count, data) or None once data grows larger than max_size."""
+    compressor = zlib.compressobj(1) if compress else None
+    chunks = []
+    count = size = 0
+    for resource, metrics in results:
+        line = json.dumps([resource, metrics], separators=(',', ':'))
+        line = (line + '\n').encode('utf-8')
+        if compressor is not None:
+            line = compressor.compress(line)
+        count += 1
+        size += len(line)
+        if max_size and size > max_size:
+            return None
+        chunks.append(line)
+    if compressor is not None:
+        chunks.append(compressor.flush())
+        size += len(chunks[-1])
+        if max_size and size > max_size:
+            return None
+    return count, b''.join(chunks)
+
+
+def _decode(data, compressed=True, chunk_size=64 * 1024):
+    """Yield (resource, metrics) back from _encode output."""
+    decompressor = zlib.decompressobj() if compressed else None
+    pending = b''
+    for offset in range(0, len(data), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            resource, metrics = json.loads(line.decode('utf-8'))
+            yield resource, metrics
+
+
+class _Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LocalCache(object):
+    """In-process cache of SearchCache entries, in front of backend.
+
+    backend is a graphite-api cache, a SearchStore or None. Entries found
+    in or stored to backend are kept here too, for at most ttl seconds and
+    within size bytes overall. To make room the largest of the SAMPLE least
+    recently used entries is evicted, so that a few big results don't push
+    out many small hot ones."""
+
+    SAMPLE = 8
+    # bytes taken by an entry besides its data
+    OVERHEAD = 200
+
+    def __init__(self, backend, size, ttl=60, stats=None):
+        self.backend = backend
+        self.size = size
+        self.ttl = ttl
+        self.stats = stats or newts_stats.NullStats()
+        self.used = 0
+        self._lock = threading.Lock()
+        # key: (evict, weight, entry), least recently used first
+        self._entries = OrderedDict()
+
+    def _weigh(self, key, entry):
+        return self.OVERHEAD + len(key) + len(entry[2] or b'')
+
+    def _get(self, key, now):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= now:
+                self._remove(key)
+                return None
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = item
+            return item[2]
+
+    def _remove(self, key):
+        self.used -= self._entries.pop(key)[1]
+
+    def _keep(self, key, entry, timeout):
+        weight = self._weigh(key, entry)
+        if weight > self.size:
+            return
+        evict = time.time() + min(timeout, self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self.used + weight > self.size:
+                candidates = []
+                for candidate, item in self._entries.items():
+                    candidates.append((item[1], candidate))
+                    if len(candidates) >= self.SAMPLE:
+                        break
+                self._remove(max(candidates)[1])
+                self.stats.incr('cache.search.l1.evictions')
+            self._entries[key] = (evict, weight, entry)
+            self.used += weight
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        now = time.time()
+        entries = [self._get(key, now) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        self.stats.incr('cache.search.l1.hits', len(keys) - len(missing))
+        self.stats.incr('cache.search.l1.misses', len(missing))
+        if not missing or self.backend is None:
+            return entries
+
+        found = self.backend.get_many(*[keys[i] for i in missing])
+        hits = 0
+        for i, entry in zip(missing, found):
+            if entry is None:
+                continue
+            hits += 1
+            entries[i] = entry
+            self._keep(keys[i], entry, self.ttl)
+        self.stats.incr('cache.search.l2.hits', hits)
+        self.stats.incr('cache.search.l2.misses', len(missing) - hits)
+        return entries
+
+    def set(self, key, entry, timeout):
+        self._keep(key, entry, timeout)
+        if self.backend is not None:
+            self.backend.set(key, entry, timeout=timeout)
+
+
+class SearchCache(object):
+    """Search results cache with request coalescing and stale serving.
+
+    Entries are fresh for ttl seconds, afterwards they are served stale for
+    up to stale_ttl more seconds while a single background refresh runs.
+    Empty results and failed searches are cached for negative_ttl seconds.
+    Concurrent misses for the same term within this process wait for one
+    search instead of running their own.
+
+    Results are stored encoded as JSON lines, zlib compressed if compress.
+    Results encoding to more than max_entry bytes are not cached: the miss
+    finding out returns them, to concurrent callers too, later hits search
+    newts again, for ttl seconds."""
+
+    def __init__(self, backend, ttl=600, stale_ttl=3600, negative_ttl=60,
+                 compress=True, max_entry=1024 * 1024, stats=None):
+        self.backend = backend
+        self.stats = stats or newts_stats.NullStats()
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.compress = compress
+        self.max_entry = max_entry
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _key(self, term):
+        # terms can be long and contain spaces, not valid memcached keys
+        digest = hashlib.md5(term.encode('utf-8')).hexdigest()
+        return 'newts-search:{}'.format(digest)
+
+    def get(self, term, search, refresh=None):
+        """Return an iterable over the results for term.
+
+        search() is called to load the results on a miss, refresh() to
+        refresh them in the background when stale, search() by default."""
+        key = self._key(term)
+        entry = self.backend.get(key)
+        results = None
+        if entry is None:
+            self.stats.incr('cache.search.misses')
+            entry, results = self._single_flight(
+                    key, lambda: self._load(key, search))
+        else:
+            self.stats.incr('cache.search.hits')
+            if time.time() >= entry[0]:
+                self.stats.incr('cache.search.stale')
+                self._refresh(key, refresh or search)
+
+        expires, compressed, data = entry
+        if results is not None:
+            return results
+        if data is None:
+            # too big to be cached
+            return search()
+        return _decode(data, compressed)
+
+    def get_many(self, terms, search_many, refresh_many=None):
+        """Return an iterable over the results of each of terms.
+
+        Misses are loaded with a single search_many(terms) call, returning
+        the results or the exception of each term like
+        AsyncNewtsClient.search_many does, stale entries are refreshed with
+        refresh_many() if given. Unlike get(), concurrent misses are not
+        coalesced."""
+        refresh_many = refresh_many or search_many
+        keys = [self._key(x) for x in terms]
+        entries = self.backend.get_many(*keys)
+
+        def loaded(result):
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        self.stats.incr('cache.search.misses', len(missing))
+        self.stats.incr('cache.search.hits', len(terms) - len(missing))
+        # the terms not searched in time, and the results too big to be
+        # cached of the others
+        expired = {}
+        uncached = {}
+        if missing:
+            results = search_many([terms[i] for i in missing])
+            for i, result in zip(missing, results):
+                if isinstance(result, DeadlineExceeded):
+                    expired[i] = result
+                    continue
+                entries[i], found = self._load(
+                        keys[i], lambda result=result: loaded(result))
+                if found is not None:
+                    uncached[i] = found
+
+        now = time.time()
+        for i, (key, term, entry) in enumerate(zip(keys, terms, entries)):
+            if i not in expired and now >= entry[0]:
+                self.stats.incr('cache.search.stale')
+                self._refresh(key, lambda term=term:
+                              loaded(refresh_many([term])[0]))
+
+        # too big to be cached, search them again
+        oversize = [i for i, entry in enumerate(entries)
+                    if i not in expired and i not in uncached and
+                    entry[2] is None]
+        results = dict(zip(oversize,
+                           search_many([terms[i] for i in oversize])
+                           if oversize else []))
+        results.update(expired)
+        results.update(uncached)
+
+        result = []
+        for i, entry in enumerate(entries):
+            if i in results:
+                result.append(results[i])
+            else:
+                result.append(_decode(entry[2], entry[1]))
+        return result
+
+    def _load(self, key, search):
+        # return (entry, results), results being the list of all results
+        # if too big to be cached, None otherwise
+        results = None
+        try:
+            stream = iter(search())
+            read = []
+
+            def reading():
+                for x in stream:
+                    read.append(x)
+                    yield x
+
+            encoded = _encode(reading(), self.compress, self.max_entry)
+            if encoded is None:
+                # keep what was read already and read the rest, instead of
+                # searching again
+                read.extend(stream)
+                results = read
+        except DeadlineExceeded:
+            # not a failure of the search itself
+            raise
+        except Exception as e:
+            logger.warn("search_cache_error", key=key, exception=e)
+            encoded = (0, b'')
+            results = None
+
+        if encoded is None:
+            logger.info("search_cache_oversize", key=key,
+                        max_entry=self.max_entry)
+            ttl, data = self.ttl, None
+        else:
+            count, data = encoded
+            ttl = self.ttl if count else self.negative_ttl
+
+        entry = (time.time() + ttl, self.compress, data)
+        self.backend.set(key, entry, timeout=ttl + self.stale_ttl)
+        return entry, results
+
+    def _join(self, key):
+        # return the flight for key and whether the caller leads it
+        with self._lock:
+            flight = self._inflight.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._inflight[key] = _Flight()
+            return flight, True
+
+    def _lead(self, key, flight, func):
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.event.set()
+        return flight.result
+
+    def _single_flight(self, key, func):
+        flight, leader = self._join(key)
+        if leader:
+            return self._lead(key, flight, func)
+
+        flight.event.wait()
+        if isinstance(flight.error, DeadlineExceeded):
+            # the leader ran out of time, not necessarily this caller
+            return func()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _refresh(self, key, search):
+        flight, leader = self._join(key)
+        if not leader:
+            return
+
+        def run():
+            try:
+                self._lead(key, flight, lambda: self._load(key, search))
+            except Exception as e:
+                logger.warn("search_refresh_error", key=key, exception=e)
+
+        thread = threading.Thread(target=run, name='newts-search-refresh')
+        thread.daemon = True
+        thread.start()
@@ -13,14 +13,27 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import csv
 import datetime
+import io
+import json
 import logging
 import math
 import os
+import sys
+import time
+from collections import OrderedDict
 
 import click
 import parsedatetime
+import structlog
 from . import client as newts
+from . import workers
+
+if sys.version_info[0] < 3:
+    from StringIO import StringIO as _StringIO
+else:
+    _StringIO = io.StringIO
 
 
 DEBUG = False
@@ -35,6 +48,9 @@ def main(debug):
         DEBUG = True
         logging_level = logging.DEBUG
     logging.basicConfig(level=logging_level)
+    # structlog prints to stdout by default, mixing with exported data
+    structlog.configure(logger_factory=structlog.stdlib.LoggerFactory(),
+                        wrapper_class=structlog.stdlib.BoundLogger)
 
 
 @main.command(name='newts-fetch')
@@ -49,6 +65,16 @@ def main(debug):
 def newts_fetch(url, resource, metric, start, end, resolution, maxpoints):
     client = newts.NewtsClient(url)
 
+    ts_start, ts_end, resolution_seconds = _time_range(start, end,
+            resolution, maxpoints)
+
+    datapoints = client.fetch(resource, metric,
+            ts_start, ts_end, resolution_seconds)
+    for timestamp, value in datapoints:
+        print(timestamp, value)
+
+
+def _time_range(start, end, resolution, maxpoints=None):
     cal = parsedatetime.Calendar()
     time_start = cal.parseDT(start)[0]
     time_end = cal.parseDT(end)[0]
@@ -63,10 +89,188 @@ def newts_fetch(url, resource, metric, start, end, resolution, maxpoints):
         resolution_seconds = int(math.ceil((resolution_parsed -
             now).total_seconds()))
 
-    datapoints = client.fetch(resource, metric,
-            ts_start, ts_end, resolution_seconds)
-    for timestamp, value in datapoints:
-        print(timestamp, value)
+    return ts_start, ts_end, max(1, resolution_seconds)
+
+
+def read_pairs(lines):
+    """Yield (resource, metric) from lines like 'resource metric' or
+    'resource,metric', skipping blank lines and # comments."""
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.replace(',', ' ').split()
+        if len(fields) != 2:
+            raise click.BadParameter('expected resource and metric: %r' %
+                                     line)
+        yield fields[0], fields[1]
+
+
+def glob_pairs(client, pattern, start, end, concurrency=1):
+    """Yield (resource, metric) of the leaves matching the graphite glob."""
+    # importing graphite-api loads its configuration, only do it if needed
+    from graphite_api.storage import FindQuery
+    from .finder import NewtsFinder
+
+    finder = NewtsFinder({'newts': {'url': client.url,
+                                    'fetch.concurrency': concurrency}},
+                         newts_client=client)
+    for node in finder.find_nodes(FindQuery(pattern, start, end)):
+        if node.is_leaf:
+            yield node.reader.resource, node.reader.metric
+
+
+def _format_csv(resource, series):
+    out = _StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    for metric, datapoints in series:
+        for timestamp, value in datapoints:
+            writer.writerow((resource, metric, timestamp, repr(value)))
+    return out.getvalue()
+
+
+def _format_ndjson(resource, series):
+    lines = []
+    for metric, datapoints in series:
+        # datapoints are [value, timestamp] like graphite's render
+        lines.append(json.dumps({'resource': resource, 'metric': metric,
+                                 'datapoints': [[v, t] for t, v in
+                                                datapoints]}))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+FORMATS = {'csv': _format_csv, 'ndjson': _format_ndjson}
+
+
+def export(client, pairs, output, time_range, fmt='csv', concurrency=8,
+           progress=None):
+    """Fetch pairs and write them to output, one request per resource.
+
+    Up to concurrency resources are fetched and formatted at a time,
+    results are written in the order of pairs. Datapoints without a value
+    are left out, timestamps are in seconds. progress, if given, is called
+    with a stats dict after each resource. Return the stats."""
+    start, end, resolution = time_range
+    formatter = FORMATS[fmt]
+
+    resources = OrderedDict()
+    for resource, metric in pairs:
+        metrics = resources.setdefault(resource, [])
+        if metric not in metrics:
+            metrics.append(metric)
+
+    def fetch(item):
+        resource, metrics = item
+        datapoints = dict((x, []) for x in metrics)
+        points = 0
+        for timestamp, values in client.fetch_multi(resource, metrics, start,
+                                                    end, resolution):
+            for metric, value in values.items():
+                if value != value:
+                    # NaN, no data
+                    continue
+                datapoints[metric].append((timestamp // 1000, value))
+                points += 1
+        series = [(x, datapoints[x]) for x in metrics]
+        return points, formatter(resource, series)
+
+    stats = {'resources': len(resources),
+             'series': sum(len(x) for x in resources.values()),
+             'done': 0, 'exported': 0, 'points': 0, 'errors': 0,
+             'started': time.time()}
+    pool = workers.WorkerPool(concurrency)
+    try:
+        for (resource, metrics), result, error in pool.map(
+                fetch, resources.items(), concurrency):
+            stats['done'] += 1
+            if error is not None:
+                logging.warning('failed to export %s: %r', resource, error)
+                stats['errors'] += 1
+            else:
+                points, data = result
+                output.write(data)
+                stats['exported'] += len(metrics)
+                stats['points'] += points
+            if progress is not None:
+                progress(stats)
+    finally:
+        pool.shutdown()
+    output.flush()
+    return stats
+
+
+class _Progress(object):
+    # report progress on stderr at most every interval seconds
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = time.time()
+
+    def __call__(self, stats, final=False):
+        now = time.time()
+        if not final and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - stats['started'], 1e-6)
+        click.echo('%d/%d resources, %d/%d series, %d points, '
+                   '%d errors, %.1f series/s' % (
+                       stats['done'], stats['resources'], stats['exported'],
+                       stats['series'], stats['points'], stats['errors'],
+                       stats['exported'] / elapsed), err=True)
+
+
+@main.command(name='newts-export')
+@click.option('--url', default='http://localhost:8080', show_default=True)
+@click.option('--start', default='-15m', show_default=True)
+@click.option('--end', default='now', show_default=True)
+@click.option('--resolution', default='1m', show_default=True)
+@click.option('--maxpoints', default=None, type=int, show_default=True,
+        metavar='NUM', help="Fetch (close to) NUM datapoints, regardless of resolution")
+@click.option('--pairs', type=click.File('r'), default=None,
+        help="File of 'resource metric' lines to export, - for stdin")
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+        default='csv', show_default=True)
+@click.option('--output', default='-', show_default=True,
+        help="File to write to, - for stdout")
+@click.option('--concurrency', default=8, type=int, show_default=True,
+        help="Resources fetched in parallel")
+@click.option('--progress-interval', default=5.0, type=float,
+        show_default=True, help="Seconds between progress reports on stderr")
+@click.option('--buffer-size', default=1024 * 1024, type=int,
+        show_default=True, help="Output buffer size in bytes")
+@click.argument('pattern', required=False)
+def newts_export(url, start, end, resolution, maxpoints, pairs, fmt, output,
+        concurrency, progress_interval, buffer_size, pattern):
+    """Export many series at once, given a graphite glob PATTERN or a file
+    of resource/metric pairs, as CSV (resource,metric,timestamp,value) or
+    newline-delimited JSON (one series per line)."""
+    if (pattern is None) == (pairs is None):
+        raise click.UsageError('give either a PATTERN or --pairs')
+
+    client = newts.NewtsClient(url, pool_size=max(concurrency, 1))
+    time_range = _time_range(start, end, resolution, maxpoints)
+    if pattern is not None:
+        items = glob_pairs(client, pattern, time_range[0], time_range[1],
+                           concurrency)
+    else:
+        items = read_pairs(pairs)
+
+    progress = _Progress(progress_interval)
+    if output == '-':
+        out = sys.stdout
+    else:
+        out = io.open(output, 'w', buffering=buffer_size, encoding='utf-8',
+                      newline='')
+    try:
+        stats = export(client, items, out, time_range, fmt, concurrency,
+                       progress)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    progress(stats, final=True)
+    if stats['errors']:
+        sys.exit(1)
 
 
 @main.command()
@@ -13,52 +13,221 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import codecs
 import json
+import re
+import threading
+import time
+from concurrent import futures
 from datetime import datetime
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from structlog import get_logger
+
+from . import endpoints
+from .deadlines import DeadlineExceeded
+from . import stats as newts_stats
+
 logger = get_logger()
 
 
+# the deadline of the request the current thread is sending
+_sending = threading.local()
+
+
+class _Retry(Retry):
+    def is_exhausted(self):
+        # don't retry past the deadline of the request
+        deadline = getattr(_sending, 'deadline', None)
+        if deadline is not None and deadline.expired:
+            return True
+        return super(_Retry, self).is_exhausted()
+
+
+def _retry(retries):
+    # retry on connection errors and resets only, newts requests are
+    # idempotent thus POST is retried as well
+    kwargs = dict(total=retries, connect=retries, read=retries, status=0,
+                  redirect=0, raise_on_status=False)
+    try:
+        return _Retry(allowed_methods=False, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return _Retry(method_whitelist=False, **kwargs)
+
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+class ArrayDecoder(object):
+    """Incrementally decode a JSON array fed as byte chunks.
+
+    feed() returns the array elements completed by each chunk, thus memory
+    is bounded by the largest element and not by the array."""
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = u''
+        self._opened = False
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return []
+        buf = self._buf + self._utf8.decode(chunk)
+        pos = 0
+        elements = []
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if not self._opened:
+                if buf[pos] != '[':
+                    raise ValueError('expected a JSON array')
+                self._opened = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                self.done = True
+                break
+            try:
+                element, end = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete element, wait for more data
+                break
+            if end == len(buf) and not isinstance(element, (list, dict)):
+                # scalars might continue in the next chunk
+                break
+            pos = end
+            elements.append(element)
+        self._buf = buf[pos:]
+        return elements
+
+    def close(self):
+        if not self.done:
+            raise ValueError('truncated JSON array')
+
+
+def iter_array(chunks):
+    """Incrementally decode a JSON array from an iterable of byte chunks.
+
+    Yield the array elements one at a time as soon as they are complete."""
+    decoder = ArrayDecoder()
+    for chunk in chunks:
+        for element in decoder.feed(chunk):
+            yield element
+        if decoder.done:
+            return
+    decoder.close()
+
+
+def format_date(date):
+    return datetime.fromtimestamp(float(date)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def result_descriptor(metrics, function, functions=None, interval='30s',
+                      heartbeat='1m'):
+    """Return the newts result descriptor to fetch metrics with, aggregated
+    by function unless overridden per metric by functions."""
+    functions = functions or {}
+    return {
+        'interval': interval,
+        'exports': list(metrics),
+        'datasources': [{
+             'label': metric,
+             'source': metric,
+             'function': functions.get(metric, function),
+             'heartbeat': heartbeat
+         } for metric in metrics],
+    }
+
+
+def measurements_params(start, end, resolution):
+    return {
+        'resolution': '{}s'.format(resolution),
+        'start': format_date(start),
+        'end': format_date(end),
+    }
+
+
+def row_values(group):
+    """Return the metric -> float value mapping of a measurements row."""
+    values = {}
+    for d in group:
+        try:
+            values[d['name']] = float(d['value'])
+        except (ValueError, TypeError):
+            continue
+    return values
+
+
 class NewtsClient(object):
-    def __init__(self, url):
-        self.url = url
+    """Client of the newts REST API.
 
-    def _format_date(self, date):
-        return datetime.fromtimestamp(float(date)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    url is the url of newts or a list of urls of equivalent newts nodes,
+    requests are then spread among them as EndpointPool describes. Requests
+    failing to connect are sent to another node. With hedge_percentile
+    set, a request not answered within that percentile of the latencies is
+    sent to a second node as well and the first answer is used.
 
-    def fetch(self, resource, metric, start, end, resolution,
-            function='AVERAGE'):
-
-        resolution = '{}s'.format(resolution)
-        result_descriptor = {
-            'interval': '30s',
-            'exports': [metric],
-            'datasources': [{
-                 'label': metric,
-                 'source': metric,
-                 'function': function,
-                 'heartbeat': '1m'
-             }],
-        }
+    Requests given a deadline raise DeadlineExceeded once it expires, the
+    connection is then closed."""
 
-        fetch_params = {
-            'resolution': resolution,
-            'start': self._format_date(start),
-            'end': self._format_date(end),
-        }
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, url, pool_size=10, connect_timeout=3.05,
+                 read_timeout=30, retries=2, stream=True, stats=None,
+                 eject_failures=3, eject_latency=0, eject_cooldown=30,
+                 hedge_percentile=0):
+        self.url = url
+        self.stream = stream
+        self.stats = stats or newts_stats.NullStats()
+        self.timeout = (connect_timeout, read_timeout)
+        self.endpoints = endpoints.EndpointPool(
+                endpoints.endpoint_urls(url), max_failures=eject_failures,
+                slow_latency=eject_latency, cooldown=eject_cooldown,
+                hedge_percentile=hedge_percentile, stats=self.stats)
+        self._hedger = None
+        if hedge_percentile and len(self.endpoints) > 1:
+            self._hedger = futures.ThreadPoolExecutor(pool_size)
+        # the adapter holds the urllib3 connection pool and it is safe to
+        # share among threads, sessions are kept per-thread instead
+        self._adapter = HTTPAdapter(pool_connections=pool_size,
+                                    pool_maxsize=pool_size,
+                                    max_retries=_retry(retries))
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def _measurements(self, resource, metrics, start, end, resolution,
+            function, functions=None, interval='30s', heartbeat='1m',
+            deadline=None):
+        descriptor = result_descriptor(metrics, function, functions,
+                                       interval, heartbeat)
+        fetch_params = measurements_params(start, end, resolution)
 
         headers = {
             'Content-Type': 'application/json',
         }
 
-        request_url = '{}/measurements/{}'.format(self.url, resource)
-        logger.debug('fetch', url=request_url, data=result_descriptor,
+        path = '/measurements/{}'.format(resource)
+        logger.debug('fetch', path=path, data=descriptor,
                 params=fetch_params)
-        data = requests.post(request_url,
-                data=json.dumps(result_descriptor),
+        data = self._request('measurements', 'POST', path,
+                deadline=deadline,
+                data=json.dumps(descriptor),
                 params=fetch_params,
                 headers=headers)
 
@@ -66,23 +235,196 @@ class NewtsClient(object):
             data.raise_for_status()
         except requests.exceptions.HTTPError as e:
             logger.warn('error while executing %r: %r' % (data.url, e))
+            self._done('measurements', data)
             raise e
 
-        for group in data.json():
-            d = group[0]
+        if not self.stream:
+            return self._json('measurements', data)
+        return self._iter_rows('measurements', data, deadline)
+
+    def _timeout(self, deadline):
+        if deadline is None:
+            return self.timeout
+        remaining = deadline.remaining()
+        if not remaining:
+            raise DeadlineExceeded()
+        return tuple(min(x, remaining) for x in self.timeout)
+
+    def _request(self, endpoint, method, path, deadline=None, **kwargs):
+        # the request is in flight until _done() is called with its response
+        tried = []
+        while True:
+            kwargs['timeout'] = self._timeout(deadline)
+            node = self.endpoints.pick(exclude=tried)
+            tried.append(node)
+            delay = None
+            if self._hedger is not None:
+                delay = self.endpoints.hedge_delay()
             try:
-                yield d['timestamp'], float(d['value'])
-            except ValueError:
-                continue
+                if delay is None:
+                    return self._send(endpoint, node, deadline, method, path,
+                                      **kwargs)
+                return self._hedge(endpoint, node, deadline, delay, method,
+                                   path, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                if deadline is not None:
+                    deadline.check()
+                if len(tried) >= len(self.endpoints):
+                    raise
+                logger.warn("endpoint_failover", url=node.url, path=path,
+                            exception=e)
+
+    def _send(self, endpoint, node, deadline, method, path, **kwargs):
+        self.stats.incr('http.%s.requests' % endpoint)
+        self.stats.adjust('http.inflight', 1)
+        started = time.time()
+        _sending.deadline = deadline
+        try:
+            response = self.session.request(method, node.url + path,
+                                            stream=self.stream, **kwargs)
+        except Exception:
+            self.endpoints.done(node, time.time() - started, ok=False)
+            self.stats.incr('http.%s.errors' % endpoint)
+            self.stats.adjust('http.inflight', -1)
+            raise
+        finally:
+            _sending.deadline = None
+        elapsed = time.time() - started
+        self.endpoints.done(node, elapsed, ok=response.status_code < 500)
+        self.stats.timing('http.%s.latency' % endpoint, elapsed)
+        if response.status_code >= 400:
+            self.stats.incr('http.%s.errors' % endpoint)
+        return response
+
+    def _hedge(self, endpoint, node, deadline, delay, method, path,
+               **kwargs):
+        # send to node, and to another node if it doesn't answer in delay
+        first = self._hedger.submit(self._send, endpoint, node, deadline,
+                                    method, path, **kwargs)
+        try:
+            return first.result(timeout=delay)
+        except futures.TimeoutError:
+            pass
+
+        other = self.endpoints.pick(exclude=[node])
+        if other is node:
+            self.endpoints.done(other)
+            return first.result()
+        self.stats.incr('http.%s.hedged' % endpoint)
+        second = self._hedger.submit(self._send, endpoint, other, deadline,
+                                     method, path, **kwargs)
+
+        def discard(future):
+            if future.exception() is None:
+                self._done(endpoint, future.result())
 
-    def search(self, *terms):
-        logger.debug("search", url=self.url, terms=terms)
+        pending = [first, second]
+        for future in futures.as_completed(pending):
+            pending.remove(future)
+            if future.exception() is None or not pending:
+                break
+        for loser in pending:
+            loser.add_done_callback(discard)
+        if future is second and future.exception() is None:
+            self.stats.incr('http.%s.hedge_wins' % endpoint)
+        return future.result()
 
-        search_params = 'q=%s' % ' AND '.join(terms)
+    def _done(self, endpoint, response, size=None):
+        response.close()
+        self.stats.adjust('http.inflight', -1)
+        if size is not None:
+            self.stats.incr('http.%s.bytes' % endpoint, size)
+
+    def _json(self, endpoint, response):
+        try:
+            return response.json()
+        finally:
+            self._done(endpoint, response, len(response.content))
+
+    def _iter_rows(self, endpoint, response, deadline=None):
+        size = [0]
+
+        def chunks():
+            try:
+                for chunk in response.iter_content(self.CHUNK_SIZE):
+                    if deadline is not None:
+                        deadline.check()
+                    size[0] += len(chunk)
+                    yield chunk
+            except requests.exceptions.RequestException:
+                # timed out reading, because of the deadline
+                if deadline is not None:
+                    deadline.check()
+                raise
+
+        try:
+            for row in iter_array(chunks()):
+                yield row
+        finally:
+            self._done(endpoint, response, size[0])
+
+    def fetch(self, resource, metric, start, end, resolution,
+            function='AVERAGE', deadline=None):
+        points = 0
+        try:
+            for group in self._measurements(resource, [metric], start, end,
+                    resolution, function, deadline=deadline):
+                d = group[0]
+                try:
+                    value = float(d['value'])
+                except ValueError:
+                    continue
+                points += 1
+                yield d['timestamp'], value
+        finally:
+            self.stats.incr('fetch.points', points)
+
+    def fetch_multi(self, resource, metrics, start, end, resolution,
+            function='AVERAGE', functions=None, interval='30s',
+            heartbeat='1m', deadline=None):
+        """Fetch several metrics of the same resource with one request.
+
+        Metrics are aggregated with function, unless overridden per metric
+        by functions. Yield (timestamp, values) for each row returned by
+        newts, where values maps each metric to its float value."""
+        points = 0
         try:
-            response = requests.get(self.url + '/search', params=search_params)
-            response.raise_for_status()
-            for result in response.json():
+            for group in self._measurements(resource, metrics, start, end,
+                    resolution, function, functions, interval, heartbeat,
+                    deadline):
+                if not group:
+                    continue
+                values = row_values(group)
+                points += len(values)
+                yield group[0]['timestamp'], values
+        finally:
+            self.stats.incr('fetch.points', points)
+
+    def search(self, *terms, **kwargs):
+        """Yield (resource, metrics) matching all of terms. HTTP errors
+        end the results, or are raised if strict."""
+        deadline = kwargs.pop('deadline', None)
+        strict = kwargs.pop('strict', False)
+        logger.debug("search", terms=terms)
+
+        search_params = {'q': ' AND '.join(terms)}
+        try:
+            response = self._request('search', 'GET', '/search',
+                    deadline=deadline, params=search_params)
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                self._done('search', response)
+                raise
+            if self.stream:
+                # wide branches have many results, decode them as they come
+                results = self._iter_rows('search', response, deadline)
+            else:
+                results = self._json('search', response)
+            for result in results:
                 yield result['resource']['id'], result['metrics']
         except requests.exceptions.HTTPError as e:
             logger.warn("search_error", exception=e)
+            if strict:
+                raise
@@ -0,0 +1,165 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pick the newts aggregation function to fetch each series with."""
+
+import flask
+from structlog import get_logger
+
+from graphite_api.render.grammar import grammar
+
+from . import patterns
+
+logger = get_logger()
+
+DEFAULT = 'AVERAGE'
+
+# graphite consolidation functions newts can aggregate with
+NEWTS_FUNCTIONS = {
+    'average': 'AVERAGE',
+    'avg': 'AVERAGE',
+    'max': 'MAX',
+    'min': 'MIN',
+}
+
+
+def newts_function(name):
+    """Return the newts function for graphite's name, None if unsupported."""
+    if name.upper() in NEWTS_FUNCTIONS.values():
+        return name.upper()
+    return NEWTS_FUNCTIONS.get(name.lower())
+
+
+def path_match(pattern, path):
+    """Tell whether the metric path matches a graphite path expression."""
+    parts = pattern.split('.')
+    names = path.split('.')
+    if len(parts) != len(names):
+        return False
+    for part, name in zip(parts, names):
+        if not patterns.compile_part(part).match(name):
+            return False
+    return True
+
+
+def _request_targets():
+    # like graphite-api's RequestParams.getlist('target')
+    body = flask.request.get_json(silent=True)
+    if isinstance(body, dict) and 'target' in body:
+        targets = body['target']
+        return targets if isinstance(targets, list) else [targets]
+    return flask.request.values.getlist('target')
+
+
+def _string(tokens):
+    if tokens.string:
+        return tokens.string[1:-1]
+    return None
+
+
+def _bare_path(tokens):
+    # the path expression tokens are made of alone, if any
+    if tokens.expression:
+        return _bare_path(tokens.expression)
+    return tokens.pathExpression or None
+
+
+def _references(tokens, function=None):
+    # yield (path expression, function) for each path in tokens, function
+    # being None for series not consolidated by newts
+    if tokens.expression:
+        for x in _references(tokens.expression):
+            yield x
+        return
+    if tokens.pathExpression:
+        yield tokens.pathExpression, None
+        return
+    if not tokens.call:
+        return
+
+    call = tokens.call
+    args = list(call.args)
+    kwargs = dict((x.argname, x.args[0]) for x in call.kwargs)
+    name = None
+    if call.funcname == 'consolidateBy' and len(args) > 1:
+        name = _string(args[1])
+    elif call.funcname == 'summarize' and args:
+        func = args[2] if len(args) > 2 else kwargs.get('func')
+        name = _string(func) if func is not None else 'sum'
+
+    function = newts_function(name) if name else None
+    path = _bare_path(args[0]) if function is not None else None
+    if path is not None:
+        # consolidating anything else, e.g. sumSeries(), is not the same
+        # as consolidating each of its series
+        yield path, function
+        args = args[1:]
+
+    for arg in args + list(kwargs.values()):
+        for x in _references(arg):
+            yield x
+
+
+def target_functions(targets):
+    """Return (path expression, newts function) for each series referenced
+    by targets.
+
+    The function is the one asked for by consolidateBy() or summarize()
+    directly wrapping the path expression, if newts can aggregate with
+    it, None otherwise."""
+    result = []
+    for target in targets:
+        try:
+            result.extend(_references(grammar.parseString(target)))
+        except Exception as e:
+            logger.debug("target_functions", target=target, exception=e)
+    return result
+
+
+class Consolidation(object):
+    """Choose the aggregation function of each series by its path.
+
+    graphite-api fetches each series once for all the targets of a render
+    request. If all the targets referencing a path ask for the same
+    function it is used, otherwise the function given by rules, a list of
+    (path expression, function), or DEFAULT."""
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for pattern, name in rules:
+            function = newts_function(name)
+            if function is None:
+                raise ValueError('unsupported newts function %r' % name)
+            self.rules.append((pattern, function))
+
+    def _request_references(self):
+        if not flask.has_request_context():
+            return []
+        references = getattr(flask.g, 'newts_consolidation', None)
+        if references is None:
+            references = target_functions(_request_targets())
+            flask.g.newts_consolidation = references
+        return references
+
+    def function(self, path):
+        requested = set(function for pattern, function
+                        in self._request_references()
+                        if path_match(pattern, path))
+        if len(requested) == 1 and None not in requested:
+            return requested.pop()
+        for pattern, function in self.rules:
+            if path_match(pattern, path):
+                return function
+        return DEFAULT
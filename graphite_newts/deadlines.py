@@ -0,0 +1,70 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Time budget of render requests."""
+
+import time
+
+import flask
+
+DROPPED_HEADER = 'X-Newts-Dropped'
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    """The point in time, seconds from now, work must be done by."""
+
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.time())
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires
+
+    def check(self):
+        """Raise DeadlineExceeded if expired."""
+        if self.expired:
+            raise DeadlineExceeded()
+
+
+def current(budget):
+    """Return the deadline of the current request, budget seconds from
+    the first call within it. None without a budget or request."""
+    if not budget or not flask.has_request_context():
+        return None
+    deadline = getattr(flask.g, 'newts_deadline', None)
+    if deadline is None:
+        deadline = flask.g.newts_deadline = Deadline(budget)
+    return deadline
+
+
+def record_dropped(count):
+    """Add count to the series dropped by the current request, reported
+    in its response DROPPED_HEADER."""
+    if not count or not flask.has_request_context():
+        return
+    dropped = getattr(flask.g, 'newts_dropped', 0)
+    if not dropped:
+        @flask.after_this_request
+        def add_header(response):
+            response.headers[DROPPED_HEADER] = str(flask.g.newts_dropped)
+            return response
+    flask.g.newts_dropped = dropped + count
@@ -0,0 +1,214 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Fixed-size on-disk cache of series chunks, shared through mmap.
+
+The cache is a single file of fixed-size slots, each holding one chunk of
+doubles. Slots are grouped in sets of WAYS, a key can only live in the set
+its hash points to, thus the file never grows and storing a chunk into a
+full set evicts the chunk of that set expiring first.
+
+All processes map the same file, reads go through the page cache and do
+not lock: each slot carries a sequence number which writers make odd while
+updating the slot, readers retry nothing and report a miss if it changed.
+Writers serialize with flock()."""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from array import array
+
+from structlog import get_logger
+
+logger = get_logger()
+
+MAGIC = b'NEWTSFC1'
+WAYS = 8
+# magic, points per chunk, sets, ways
+_HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = mmap.PAGESIZE
+# sequence, key digest, expiry time
+_SLOT = struct.Struct('<Q16sd')
+_SEQ = struct.Struct('<Q')
+
+
+if hasattr(array, 'frombytes'):
+    _frombytes = array.frombytes
+    _tobytes = array.tobytes
+else:
+    _frombytes = array.fromstring
+    _tobytes = array.tostring
+
+
+def _digest(key):
+    return hashlib.md5(key.encode('utf-8')).digest()
+
+
+class DiskCache(object):
+    """Cache chunks of points doubles in a file of about size bytes.
+
+    It implements get_many() and set_many() like graphite-api caches do,
+    for chunks only, i.e. arrays of doubles of points length."""
+
+    def __init__(self, directory, size, points):
+        self.path = os.path.join(directory, 'fetch-%d.cache' % points)
+        self.points = points
+        self.slot_size = _SLOT.size + points * 8
+        self.sets = max(1, (size - HEADER_SIZE) // (self.slot_size * WAYS))
+        self.file_size = HEADER_SIZE + self.sets * WAYS * self.slot_size
+        self._header = _HEADER.pack(MAGIC, points, self.sets, WAYS)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # after a fork the descriptor must not be shared, flock() locks
+        # belong to the open file and not to the process
+        if self._pid == os.getpid():
+            return self._map
+        with self._lock:
+            if self._pid != os.getpid():
+                self._fd, self._map = self._map_file()
+                try:
+                    self._view = memoryview(self._map)
+                except TypeError:
+                    # python 2, slices are copied
+                    self._view = self._map
+                self._pid = os.getpid()
+        return self._map
+
+    def _lock_file(self):
+        # return a locked descriptor of the file currently at path, it
+        # might have been replaced while waiting for the lock
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                return fd
+            os.close(fd)
+
+    def _map_file(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd = self._lock_file()
+        try:
+            header = os.read(fd, _HEADER.size)
+            if header != self._header or \
+                    os.fstat(fd).st_size != self.file_size:
+                new_fd = self._create()
+                os.close(fd)
+                fd = new_fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        return fd, mmap.mmap(fd, self.file_size)
+
+    def _create(self):
+        # never resize a file others might have mapped, replace it
+        logger.info("disk_cache_create", path=self.path,
+                    size=self.file_size, sets=self.sets)
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            # a sparse file, empty slots read as zeros
+            os.ftruncate(fd, self.file_size)
+            os.write(fd, self._header)
+            os.fchmod(fd, 0o644)
+            os.rename(path, self.path)
+        except Exception:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        return fd
+
+    def _slots(self, digest):
+        index = struct.unpack('<Q', digest[:8])[0] % self.sets
+        offset = HEADER_SIZE + index * WAYS * self.slot_size
+        return range(offset, offset + WAYS * self.slot_size, self.slot_size)
+
+    def _get(self, key, now):
+        digest = _digest(key)
+        for offset in self._slots(digest):
+            seq, slot_digest, expires = _SLOT.unpack_from(self._map, offset)
+            if slot_digest != digest:
+                continue
+            if seq & 1 or expires < now:
+                return None
+            start = offset + _SLOT.size
+            chunk = array('d')
+            _frombytes(chunk, self._view[start:start + self.points * 8])
+            if _SEQ.unpack_from(self._map, offset)[0] != seq:
+                # overwritten while reading
+                return None
+            return chunk
+        return None
+
+    def get_many(self, *keys):
+        try:
+            self._open()
+            now = time.time()
+            return [self._get(key, now) for key in keys]
+        except EnvironmentError as e:
+            logger.warn("disk_cache_error", path=self.path, exception=e)
+            return [None] * len(keys)
+
+    def _victim(self, digest):
+        # the slot of the same key, else an empty or expired one, else the
+        # one expiring first
+        victim = None
+        for offset in self._slots(digest):
+            seq, slot_digest, expires = _SLOT.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                return offset, seq
+            if victim is None or expires < victim[2]:
+                victim = (offset, seq, expires)
+        return victim[:2]
+
+    def _set(self, key, chunk, expires):
+        digest = _digest(key)
+        offset, seq = self._victim(digest)
+        start = offset + _SLOT.size
+        _SEQ.pack_into(self._map, offset, seq + 1)
+        self._map[start:start + self.points * 8] = _tobytes(chunk)
+        _SLOT.pack_into(self._map, offset, seq + 2, digest, expires)
+
+    def set_many(self, mapping, timeout):
+        try:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for key, chunk in mapping.items():
+                    if len(chunk) != self.points:
+                        continue
+                    self._set(key, chunk, time.time() + timeout)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except EnvironmentError as e:
+            logger.warn("disk_cache_error", path=self.path, exception=e)
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                if isinstance(self._view, memoryview):
+                    self._view.release()
+                self._map.close()
+                os.close(self._fd)
+            self._pid = None
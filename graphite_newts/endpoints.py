@@ -0,0 +1,163 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Health tracking of the newts endpoints a client talks to."""
+
+import threading
+import time
+from collections import deque
+
+from structlog import get_logger
+
+from . import stats as newts_stats
+
+logger = get_logger()
+
+# successful requests measured before an endpoint can be found slow
+SLOW_SAMPLES = 10
+# latencies measured before hedging starts
+HEDGE_SAMPLES = 20
+# weight of the last request in the average latency
+_ALPHA = 0.2
+
+
+def endpoint_urls(url):
+    """Return the list of urls in url, a url or a list of urls."""
+    if isinstance(url, (list, tuple)):
+        urls = list(url)
+    else:
+        urls = [url]
+    if not urls:
+        raise ValueError('no newts url configured')
+    return [x.rstrip('/') for x in urls]
+
+
+class Endpoint(object):
+    __slots__ = ('url', 'inflight', 'failures', 'samples', 'latency',
+                 'ejected_until')
+
+    def __init__(self, url):
+        self.url = url
+        self.inflight = 0
+        self._admit()
+
+    def _admit(self):
+        self.failures = 0
+        self.samples = 0
+        self.latency = None
+        self.ejected_until = None
+
+    def __repr__(self):
+        return 'Endpoint(%r)' % self.url
+
+
+class EndpointPool(object):
+    """Spread requests across newts endpoints, ejecting unhealthy ones.
+
+    Requests go to the healthy endpoint with the fewest requests in flight,
+    in turn among equals. An endpoint is ejected for cooldown seconds after
+    max_failures failures in a row, or when its average latency goes above
+    slow_latency seconds, if not 0. With every endpoint ejected the one
+    due back first is used anyway.
+
+    If hedge_percentile is not 0, hedge_delay() returns that percentile of
+    the latencies of the last window requests."""
+
+    def __init__(self, urls, max_failures=3, slow_latency=0, cooldown=30,
+                 hedge_percentile=0, window=1000, stats=None):
+        self.endpoints = [Endpoint(x) for x in urls]
+        self.max_failures = max_failures
+        self.slow_latency = slow_latency
+        self.cooldown = cooldown
+        self.hedge_percentile = hedge_percentile
+        self.stats = stats or newts_stats.NullStats()
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._turn = 0
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def pick(self, exclude=()):
+        """Return the endpoint to send the next request to, preferring the
+        ones not in exclude. The request is in flight until done()."""
+        now = time.time()
+        with self._lock:
+            for e in self.endpoints:
+                if e.ejected_until is not None and now >= e.ejected_until:
+                    logger.info("endpoint_readmitted", url=e.url)
+                    e._admit()
+
+            candidates = [e for e in self.endpoints if e not in exclude] or \
+                self.endpoints
+            healthy = [e for e in candidates if e.ejected_until is None]
+            if healthy:
+                self._turn += 1
+                n = len(healthy)
+                healthy = [healthy[(self._turn + i) % n] for i in range(n)]
+                chosen = min(healthy, key=lambda e: e.inflight)
+            else:
+                chosen = min(candidates, key=lambda e: e.ejected_until)
+            chosen.inflight += 1
+            return chosen
+
+    def done(self, endpoint, elapsed=None, ok=True):
+        """Record the outcome of a request sent to endpoint, taking elapsed
+        seconds. Requests given up on, e.g. hedges lost, have no outcome."""
+        with self._lock:
+            endpoint.inflight -= 1
+            if elapsed is None:
+                return
+            if not ok:
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures:
+                    self._eject(endpoint, 'failures')
+                return
+
+            self._latencies.append(elapsed)
+            endpoint.failures = 0
+            endpoint.samples += 1
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += _ALPHA * (elapsed - endpoint.latency)
+            if self.slow_latency and endpoint.samples >= SLOW_SAMPLES and \
+                    endpoint.latency > self.slow_latency:
+                self._eject(endpoint, 'slow')
+
+    def _eject(self, endpoint, reason):
+        if endpoint.ejected_until is not None:
+            return
+        if all(e.ejected_until is not None for e in self.endpoints
+               if e is not endpoint):
+            # never eject the last endpoint standing
+            return
+        logger.warn("endpoint_ejected", url=endpoint.url, reason=reason,
+                    failures=endpoint.failures, latency=endpoint.latency,
+                    cooldown=self.cooldown)
+        self.stats.incr('endpoints.ejections.%s' % reason)
+        endpoint.ejected_until = time.time() + self.cooldown
+
+    def hedge_delay(self):
+        """Return the seconds to wait for an answer before sending a
+        duplicate request to another endpoint, None not to."""
+        if not self.hedge_percentile or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            if len(self._latencies) < HEDGE_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
@@ -14,151 +14,695 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import time
-import re
 import math
+import time
+from collections import OrderedDict
 
 from structlog import get_logger
 
 from graphite_api.intervals import Interval, IntervalSet
 from graphite_api.node import BranchNode, LeafNode
 from graphite_api.app import app
-from graphite_api.finders import match_entries
-
+from . import cache
 from . import client
+from . import consolidation
+from . import deadlines
+from . import diskcache
+from . import index
+from . import patterns
+from . import resolution
+from . import searchstore
+from . import series
+from . import stats
+from . import warmer
+from . import workers
 
 logger = get_logger()
 
 
+def _time_grid(time_start, time_end, step):
+    """Return (start, end, step) with start and end aligned to step."""
+    start = int(time_start) - int(time_start) % step
+    end = int(math.ceil(float(time_end) / step)) * step
+    if end <= start:
+        end = start + step
+    return start, end, step
+
+
+def _parent_term(resource):
+    if resource is None:
+        return '_parent:_root'
+    term = resource.replace(':', '\\:')
+    term = term.replace('-', '\\-')
+    return '_parent:%s' % term
+
+
+_NULL_STATS = stats.NullStats()
+
+
+class TooManyNodes(Exception):
+    pass
+
+
+class ReaderContext(object):
+    """The state shared by all readers of a finder."""
+
+    __slots__ = ('client', 'maxpoints', 'fetch_cache', 'consolidation',
+                 'ladder', 'stats', 'deadline', 'intervals')
+
+    def __init__(self, client, maxpoints, fetch_cache=None,
+                 consolidation=None, ladder=None, stats=None, deadline=0):
+        self.client = client
+        self.maxpoints = maxpoints
+        self.fetch_cache = fetch_cache
+        self.consolidation = consolidation
+        self.ladder = ladder or resolution.Ladder()
+        self.stats = stats or _NULL_STATS
+        # the time budget of render requests, in seconds
+        self.deadline = deadline
+        # newts keeps no record of when series start, all readers have
+        # the same intervals
+        self.intervals = IntervalSet([Interval(float('-inf'),
+                                               float('inf'))])
+
+
+class NewtsLeafNode(LeafNode):
+    __slots__ = ()
+    __fetch_multi__ = 'newts'
+
+    def __init__(self, path, reader):
+        # LeafNode.__init__ without splitting path and building intervals
+        # for each of possibly many thousands of nodes
+        self.path = path
+        self.name = reader.metric
+        self.local = True
+        self.is_leaf = True
+        self.reader = reader
+        self.intervals = reader.context.intervals
+
+
+def _fetch_buffers(client, fetch_cache, resource, metrics, time_info, rung,
+                   functions=None, deadline=None):
+    """Fetch metrics of resource into a SeriesBuffer each, through
+    fetch_cache if not None. functions maps metrics to the newts
+    aggregation function to use."""
+    def fetcher(metrics, start, end):
+        return client.fetch_multi(resource, metrics, start, end, rung.step,
+                                  functions=functions,
+                                  interval=rung.interval,
+                                  heartbeat=rung.heartbeat,
+                                  deadline=deadline)
+
+    if fetch_cache is not None:
+        return fetch_cache.fetch(fetcher, resource, metrics, time_info,
+                                 functions)
+
+    start, end, step = time_info
+    buffers = dict((x, series.SeriesBuffer(start, end, step))
+                   for x in metrics)
+    return series.fill(buffers, fetcher(list(metrics), start, end))
+
+
 class NewtsReader(object):
-    __slots__ = ('resource', 'metric', 'client', 'maxpoints')
+    __slots__ = ('resource', 'metric', 'context')
 
-    def __init__(self, client, resource, metric, maxpoints):
+    def __init__(self, resource, metric, context):
         self.resource = resource
         self.metric = metric
-        self.client = client
-        self.maxpoints = maxpoints
+        self.context = context
 
     def get_intervals(self):
-        start = float('-inf')
-        end = float('inf')
-        logger.debug("get_intervals", finder="newts", start=start, end=end)
-        return IntervalSet([Interval(start, end)])
+        return self.context.intervals
 
     def fetch(self, time_start, time_end):
-        logger.debug("fetch", reader="newts", client=self.client,
+        context = self.context
+        logger.debug("fetch", reader="newts", client=context.client,
                      resource=self.resource, metric=self.metric,
                      start=time_start, end=time_end)
 
-        values = []
-        ts_start = time.time()
-        ts_end = 0
-
-        # XXX
-        resolution = int((time_end - time_start) / self.maxpoints)
-        resolution = (resolution // 60) * 60
-        if resolution < 60:
-            resolution = 60
-        for timestamp_ms, value in self.client.fetch(
-                self.resource, self.metric, time_start, time_end, resolution):
-            timestamp = timestamp_ms / 1000
-            ts_start = min(ts_start, timestamp)
-            ts_end = max(ts_end, timestamp)
-            if math.isnan(value):
-                values.append(None)
-            else:
-                values.append(value)
-
-        time_info = (ts_start, ts_end, resolution)
-        return time_info, values
+        rung = context.ladder.rung(time_start, time_end, context.maxpoints)
+        time_info = _time_grid(time_start, time_end, rung.step)
+        functions = None
+        if context.consolidation is not None:
+            # XXX ambigous, : is valid in graphite name
+            path = '{}.{}'.format(self.resource.replace(':', '.'),
+                                  self.metric)
+            functions = {self.metric: context.consolidation.function(path)}
+        context.stats.incr('fetch.series')
+        with context.stats.timer('fetch.duration'):
+            try:
+                buffers = _fetch_buffers(
+                        context.client, context.fetch_cache, self.resource,
+                        [self.metric], time_info, rung, functions,
+                        deadlines.current(context.deadline))
+            except deadlines.DeadlineExceeded:
+                logger.warn("fetch_deadline", reader="newts",
+                            resource=self.resource, metric=self.metric)
+                context.stats.incr('fetch.dropped')
+                deadlines.record_dropped(1)
+                start, end, step = time_info
+                return time_info, [None] * ((end - start) // step)
+            return time_info, buffers[self.metric].tolist()
 
 
 class NewtsFinder(object):
+    __fetch_multi__ = 'newts'
+
     DEFAULT_CONFIG = {'url': 'http://localhost:8080',
-                      'fetch.maxpoints': 200}
+                      'fetch.maxpoints': 200,
+                      'fetch.steps': resolution.DEFAULT_LADDER,
+                      'fetch.stream': True,
+                      'fetch.concurrency': 1,
+                      'fetch.render_concurrency': 0,
+                      'search.batch_size': 1,
+                      'search.concurrency': 0,
+                      'search.name_field': None,
+                      'render.deadline': 0,
+                      'find.max_nodes': 0,
+                      'warmer.enabled': False,
+                      'warmer.path':
+                          '/var/cache/graphite-newts/warmer.json',
+                      'warmer.entries': 100,
+                      'warmer.interval': 600,
+                      'warmer.concurrency': 2,
+                      'warmer.threshold': 0.9,
+                      'warmer.timeout': 300,
+                      'warmer.ready_path': '/newts/ready',
+                      'index.enabled': False,
+                      'index.refresh_interval': 300,
+                      'search.cache_ttl': 600,
+                      'search.cache_stale_ttl': 3600,
+                      'search.cache_negative_ttl': 60,
+                      'search.cache_compress': True,
+                      'search.cache_max_entry': 1024 * 1024,
+                      'search.shared_cache': False,
+                      'search.shared_cache_dir': '/var/cache/graphite-newts',
+                      'search.shared_cache_size': 256 * 1024 * 1024,
+                      'search.local_cache_size': 0,
+                      'search.local_cache_ttl': 60,
+                      'fetch.functions': [],
+                      'fetch.cache': True,
+                      'fetch.cache_bucket_points': 120,
+                      'fetch.cache_ttl': 86400,
+                      'fetch.cache_recent_ttl': 30,
+                      'fetch.cache_settle': 300,
+                      'fetch.disk_cache': False,
+                      'fetch.disk_cache_dir': '/var/cache/graphite-newts',
+                      'fetch.disk_cache_size': 1024 * 1024 * 1024,
+                      'http.pool_size': 10,
+                      'http.connect_timeout': 3.05,
+                      'http.read_timeout': 30,
+                      'http.retries': 2,
+                      'http.eject_failures': 3,
+                      'http.eject_latency': 0,
+                      'http.eject_cooldown': 30,
+                      'http.hedge_percentile': 0,
+                      'http.async': False,
+                      'http.async_limit': 100,
+                      'stats.sink': None,
+                      'stats.prefix': 'graphite_newts',
+                      'stats.statsd_host': 'localhost',
+                      'stats.statsd_port': 8125,
+                      'stats.prometheus_path': '/newts/metrics'}
 
     def __init__(self, app_config, newts_client=None, app=app):
         self.config = self.DEFAULT_CONFIG.copy()
         self.config.update(app_config.get('newts', {}))
         self.use_cache = app_config.get('cache') is not None
         self.app = app
+        self.stats = self._make_stats()
 
         if newts_client is not None:
             self.client = newts_client
+        elif self.config['http.async']:
+            self.client = self._make_async_client()
+        else:
+            self.client = client.NewtsClient(
+                    self.config['url'],
+                    pool_size=self.config['http.pool_size'],
+                    stream=self.config['fetch.stream'],
+                    **self._client_config())
+
+        self.workers = workers.WorkerPool(self.config['fetch.concurrency'])
+        self.consolidation = consolidation.Consolidation(
+                self.config['fetch.functions'])
+        self.ladder = resolution.Ladder(self.config['fetch.steps'])
+
+        self.search_cache = None
+        backend = None
+        if self.config['search.shared_cache']:
+            backend = searchstore.SearchStore(
+                    self.config['search.shared_cache_dir'],
+                    self.config['search.shared_cache_size'])
+        elif self.use_cache:
+            backend = self.app.cache
+        if self.config['search.local_cache_size']:
+            backend = cache.LocalCache(
+                    backend, self.config['search.local_cache_size'],
+                    ttl=self.config['search.local_cache_ttl'],
+                    stats=self.stats)
+        if backend is not None:
+            self.search_cache = cache.SearchCache(
+                    backend,
+                    ttl=self.config['search.cache_ttl'],
+                    stale_ttl=self.config['search.cache_stale_ttl'],
+                    negative_ttl=self.config['search.cache_negative_ttl'],
+                    compress=self.config['search.cache_compress'],
+                    max_entry=self.config['search.cache_max_entry'],
+                    stats=self.stats)
+
+        self.fetch_cache = None
+        backend = None
+        if self.use_cache and self.config['fetch.cache']:
+            backend = self.app.cache
+        disk = None
+        if self.config['fetch.disk_cache']:
+            disk = diskcache.DiskCache(
+                    self.config['fetch.disk_cache_dir'],
+                    self.config['fetch.disk_cache_size'],
+                    self.config['fetch.cache_bucket_points'])
+        if backend is not None or disk is not None:
+            self.fetch_cache = cache.FetchCache(
+                    backend,
+                    bucket_points=self.config['fetch.cache_bucket_points'],
+                    ttl=self.config['fetch.cache_ttl'],
+                    recent_ttl=self.config['fetch.cache_recent_ttl'],
+                    settle=self.config['fetch.cache_settle'],
+                    stats=self.stats,
+                    disk=disk)
+
+        self.reader_context = ReaderContext(
+                self.client, self.config['fetch.maxpoints'], self.fetch_cache,
+                self.consolidation, self.ladder, self.stats,
+                self.config['render.deadline'])
+
+        self.index = None
+        if self.config['index.enabled']:
+            self.index = index.MetricIndex(
+                    lambda parents: self._search_children(
+                            parents, cached=False, strict=True),
+                    self.config['index.refresh_interval'])
+            self.index.start()
+
+        self.warmer = None
+        if self.config['warmer.enabled']:
+            self.warmer = warmer.CacheWarmer(
+                    self, self.config['warmer.path'],
+                    entries=self.config['warmer.entries'],
+                    interval=self.config['warmer.interval'],
+                    concurrency=self.config['warmer.concurrency'],
+                    threshold=self.config['warmer.threshold'],
+                    timeout=self.config['warmer.timeout'])
+            self.warmer.mount(self.app, self.config['warmer.ready_path'])
+            self.warmer.start()
+
+    def _make_stats(self):
+        sink = self.config['stats.sink']
+        if not sink:
+            return stats.NullStats()
+        if sink == 'statsd':
+            sink = stats.StatsdSink(self.config['stats.statsd_host'],
+                                    self.config['stats.statsd_port'])
+        elif sink == 'prometheus':
+            sink = stats.PrometheusSink()
+            sink.mount(self.app, self.config['stats.prometheus_path'])
         else:
-            self.client = client.NewtsClient(self.config['url'])
+            raise ValueError('unknown stats sink %r' % sink)
+        return stats.Stats(sink, self.config['stats.prefix'])
+
+    def _make_async_client(self):
+        try:
+            from . import aioclient
+        except (ImportError, SyntaxError) as e:
+            raise ValueError('http.async needs python 3 and aiohttp: %s' % e)
+        return aioclient.SyncNewtsClient(
+                self.config['url'],
+                limit=self.config['http.async_limit'],
+                **self._client_config())
+
+    def _client_config(self):
+        # the settings common to both newts clients
+        return {'connect_timeout': self.config['http.connect_timeout'],
+                'read_timeout': self.config['http.read_timeout'],
+                'retries': self.config['http.retries'],
+                'eject_failures': self.config['http.eject_failures'],
+                'eject_latency': self.config['http.eject_latency'],
+                'eject_cooldown': self.config['http.eject_cooldown'],
+                'hedge_percentile': self.config['http.hedge_percentile'],
+                'stats': self.stats}
+
+    def _deadline(self):
+        return deadlines.current(self.config['render.deadline'])
 
     def find_nodes(self, query):
         logger.debug("find_nodes", finder="newts", start=query.startTime,
                      end=query.endTime, pattern=query.pattern)
 
-        for resource, metric, is_leaf in self._search_nodes(query.pattern):
-            # XXX ambigous, : is valid in graphite name
-            dot_path = resource.replace(':', '.')
+        started = time.time()
+        if self.warmer is not None:
+            self.warmer.record(query.pattern, query.startTime, query.endTime)
+        if self.index is not None and self.index.ready:
+            self.stats.incr('find.index')
+            nodes = self.index.find(query.pattern)
+        else:
+            nodes = self._search_nodes(query.pattern, self._deadline())
+
+        limit = self.config['find.max_nodes']
+        context = self.reader_context
+        found = 0
+        # one copy of each metric name for all readers
+        names = {}
+        resource = dot_path = None
+        for node_resource, metric, is_leaf in nodes:
+            found += 1
+            if limit and found > limit:
+                logger.warn("find_too_many", finder="newts",
+                            pattern=query.pattern, limit=limit)
+                self.stats.incr('find.rejected')
+                raise TooManyNodes('%r matches more than %d nodes' %
+                                   (query.pattern, limit))
+            if node_resource != resource:
+                # leaves come grouped by resource, share its strings
+                resource = node_resource
+                # XXX ambigous, : is valid in graphite name
+                dot_path = resource.replace(':', '.')
             if not is_leaf:
                 yield BranchNode(dot_path)
             else:
-                reader = NewtsReader(self.client, resource, metric,
-                                     self.config['fetch.maxpoints'])
-                yield LeafNode('{}.{}'.format(dot_path, metric), reader)
-
-    # XXX potentially big results
-    def _run_search(self, term):
-        if not self.use_cache:
-            result = self.client.search(term)
-        else:
-            result = self.app.cache.get(term)
-            if result is None:
-                result = [(x, y) for x, y in self.client.search(term)]
-                self.app.cache.add(term, result)
+                metric = names.setdefault(metric, metric)
+                reader = NewtsReader(resource, metric, context)
+                yield NewtsLeafNode('{}.{}'.format(dot_path, metric), reader)
 
-        for x, y in result:
-            yield x, y
+        self.stats.incr('find.requests')
+        self.stats.observe('find.nodes', found)
+        self.stats.timing('find.duration', time.time() - started)
 
-    def _search_nodes(self, pattern):
-        parts = pattern.split('.')
-        queue = [('_parent:_root', parts)]
-
-        while queue:
-            search_term, patterns = queue.pop()
-            pattern = patterns[0]
-            patterns = patterns[1:]
-
-            # map branches to their resource (the branch full path) and the
-            # retrieved metrics (the leaves)
-            branches = {}
-            for resource, metrics in self._run_search(search_term):
-                if search_term == '_parent:_root':
-                    branch = resource
+    def fetch_multi(self, nodes, time_start, time_end):
+        """Fetch all nodes, issuing one newts request per resource.
+
+        Return a (time_info, series) tuple as expected by graphite-api, with
+        series mapping each node path to its step-aligned values."""
+        logger.debug("fetch_multi", finder="newts", nodes=len(nodes),
+                     start=time_start, end=time_end)
+
+        rung = self.ladder.rung(time_start, time_end,
+                                self.config['fetch.maxpoints'])
+        time_info = _time_grid(time_start, time_end, rung.step)
+        start, end, step = time_info
+        slots = (end - start) // step
+
+        # group metrics by the resource they belong to, keep the node path
+        # around to demultiplex the results
+        resources = OrderedDict()
+        for node in nodes:
+            reader = node.reader
+            resources.setdefault(reader.resource, []).append(
+                    (reader.metric, node.path))
+
+        batches = []
+        for resource, leaves in resources.items():
+            paths = {}
+            functions = {}
+            for metric, path in leaves:
+                paths.setdefault(metric, []).append(path)
+                # the request context is not available from the workers
+                functions.setdefault(metric,
+                                     self.consolidation.function(path))
+            batches.append((resource, paths, functions))
+
+        deadline = self._deadline()
+
+        def fetch(request):
+            resource, paths, functions = request
+            # decode the results here, i.e. from within the worker
+            return _fetch_buffers(self.client, self.fetch_cache, resource,
+                                  list(paths), time_info, rung, functions,
+                                  deadline)
+
+        if hasattr(self.client, 'fetch_many'):
+            fetched = self._fetch_many(batches, time_info, rung, deadline)
+        else:
+            fetched = self.workers.map(
+                    fetch, batches, self.config['fetch.render_concurrency'],
+                    deadline)
+
+        started = time.time()
+        self.stats.incr('fetch_multi.series', len(nodes))
+        result = {}
+        dropped = 0
+        for (resource, paths, _), buffers, error in fetched:
+            if isinstance(error, deadlines.DeadlineExceeded):
+                dropped += sum(len(x) for x in paths.values())
+                buffers = {}
+            elif error is not None:
+                logger.warn("fetch_error", finder="newts", resource=resource,
+                            exception=error)
+                self.stats.incr('fetch_multi.errors')
+                buffers = {}
+            for metric, metric_paths in paths.items():
+                if metric in buffers:
+                    values = buffers[metric].tolist()
                 else:
-                    # XXX column is valid in graphite names
-                    branch = resource.rsplit(':', 1)[1]
-                branches[branch] = (resource, metrics)
-
-            # multi-part pattern
-            if patterns:
-                # walk the branches first
-                for match in match_entries(branches.keys(), pattern):
-                    resource, metrics = branches[match]
-                    parent_term = resource.replace(':', '\:')
-                    parent_term = parent_term.replace('-', '\-')
-                    queue.append(('_parent:%s' % parent_term, patterns))
-                    # only one pattern left, match leaves too (i.e. metrics)
-                    if len(patterns) == 1:
-                        for match in match_entries(metrics, patterns[0]):
-                            yield resource, match, True
+                    values = [None] * slots
+                for path in metric_paths:
+                    result[path] = values
+
+        if dropped:
+            logger.warn("fetch_deadline", finder="newts", dropped=dropped,
+                        series=len(nodes))
+            self.stats.incr('fetch.dropped', dropped)
+            deadlines.record_dropped(dropped)
+        self.stats.observe('fetch_multi.resources', len(batches))
+        self.stats.timing('fetch_multi.duration', time.time() - started)
+        return time_info, result
+
+    def _fetch_many(self, batches, time_info, rung, deadline=None):
+        """Fetch batches with a single client.fetch_many() call.
+
+        Like workers.map() yield (batch, buffers, error) for each batch, all
+        requests run concurrently on the client event loop instead."""
+        start, end, step = time_info
+        lookups = []
+        requests = []
+        for resource, paths, functions in batches:
+            lookup = None
+            metrics = list(paths)
+            fetch_start, fetch_end = start, end
+            if self.fetch_cache is not None:
+                lookup = self.fetch_cache.lookup(resource, metrics, time_info,
+                                                 functions)
+                metrics = lookup.missing
+                fetch_start, fetch_end = lookup.start, lookup.end
+            lookups.append(lookup)
+            if metrics:
+                requests.append({'resource': resource, 'metrics': metrics,
+                                 'start': fetch_start, 'end': fetch_end,
+                                 'resolution': rung.step,
+                                 'functions': functions,
+                                 'interval': rung.interval,
+                                 'heartbeat': rung.heartbeat})
+
+        results = iter(self.client.fetch_many(requests, deadline=deadline)
+                       if requests else [])
+        for batch, lookup in zip(batches, lookups):
+            rows = ()
+            if lookup is None or lookup.missing:
+                rows = next(results)
+            if isinstance(rows, Exception):
+                yield batch, None, rows
+                continue
+            if lookup is not None:
+                buffers = self.fetch_cache.complete(lookup, rows)
+            else:
+                buffers = dict((x, series.SeriesBuffer(start, end, step))
+                               for x in batch[1])
+                series.fill(buffers, rows)
+            yield batch, buffers, None
+
+    def _run_search(self, term, deadline=None):
+        self.stats.incr('search.requests')
+        with self.stats.timer('search.duration'):
+            if self.search_cache is None:
+                result = self.client.search(term, deadline=deadline)
+            else:
+                # refreshes run in the background, past the deadline
+                result = self.search_cache.get(
+                        term,
+                        lambda: self.client.search(term, deadline=deadline),
+                        lambda: self.client.search(term))
+
+            for x, y in result:
+                yield x, y
+
+    def _search_children(self, parents, part=None, cached=True,
+                         deadline=None, strict=False):
+        """Search the children of all parents, None being the root.
+
+        Parents are searched batch_size at a time with a single OR query,
+        batches run concurrently on the worker pool. Children are filtered
+        by part, if given, as results arrive. Yield (parent, children) in
+        the same order as parents, children are sorted by resource.
+
+        With search.name_field set, the queries also select the children
+        matching part, if it translates to a search expression.
+
+        If strict, failed searches, HTTP errors included, yield None as the
+        children of their parents instead of raising."""
+        batch_size = max(1, self.config['search.batch_size'])
+        batches = [parents[i:i + batch_size]
+                   for i in range(0, len(parents), batch_size)]
+        accept = patterns.matcher(part) if part is not None else None
+        expression = None
+        if part is not None and self.config['search.name_field']:
+            expression = patterns.search_expression(
+                    part, self.config['search.name_field'])
+            if expression is not None:
+                self.stats.incr('search.pushdown', len(batches))
+
+        def search_term(batch):
+            term = ' OR '.join(_parent_term(x) for x in batch)
+            if expression is None:
+                return term
+            if len(batch) > 1:
+                term = '(%s)' % term
+            return '%s AND %s' % (term, expression)
+
+        def search(batch):
+            term = search_term(batch)
+            if not cached:
+                results = self.client.search(term, deadline=deadline,
+                                             strict=strict)
             else:
-                # patterns like 'foo', yield only branches
-                for match in match_entries(branches.keys(), pattern):
-                    yield match, None, False
-
-    # XXX fix regex transformation
-    # XXX untrusted input
-    # https://graphite.readthedocs.org/en/latest/render_api.html
-    def _compile_part(self, part):
-        pattern = part.replace('*', '.*')
-        pattern = pattern.replace('{', '(')
-        pattern = pattern.replace('}', ')')
-        pattern = pattern.replace(',', '|')
-        logger.debug('_compile_part', pattern=pattern, part=part)
-        return re.compile(pattern)
+                results = self._run_search(term, deadline)
+            if accept is None:
+                return list(results)
+            # XXX column is valid in graphite names
+            return [(resource, metrics) for resource, metrics in results
+                    if accept(resource.rsplit(':', 1)[-1])]
+
+        if hasattr(self.client, 'search_many'):
+            searched = self._search_many(
+                    batches, [search_term(x) for x in batches], cached,
+                    accept, deadline, strict)
+        else:
+            searched = self.workers.map(search, batches,
+                                        self.config['search.concurrency'],
+                                        deadline)
+
+        for batch, results, error in searched:
+            if error is not None and strict:
+                logger.warn("search_failed", finder="newts",
+                            parents=len(batch), exception=error)
+                for parent in batch:
+                    yield parent, None
+                continue
+            if error is not None:
+                raise error
+
+            results.sort(key=lambda x: x[0])
+            if len(batch) == 1:
+                yield batch[0], results
+                continue
+
+            # demultiplex children to their parent
+            children = dict((x, []) for x in batch)
+            for resource, metrics in results:
+                # XXX column is valid in graphite names
+                parent = resource.rsplit(':', 1)[0]
+                if parent in children:
+                    children[parent].append((resource, metrics))
+            for parent in batch:
+                yield parent, children[parent]
+
+    def _search_many(self, batches, terms, cached, accept, deadline=None,
+                     strict=False):
+        """Search batches with a single client.search_many() call, with
+        the term of each.
+
+        Like workers.map() yield (batch, results, error) for each batch, all
+        searches run concurrently on the client event loop instead."""
+        def search_many(terms):
+            return self.client.search_many(terms, deadline=deadline)
+
+        if not cached:
+            searched = self.client.search_many(terms, deadline=deadline,
+                                               strict=strict)
+        else:
+            self.stats.incr('search.requests', len(terms))
+            with self.stats.timer('search.duration'):
+                if self.search_cache is None:
+                    searched = search_many(terms)
+                else:
+                    searched = self.search_cache.get_many(
+                            terms, search_many, self.client.search_many)
+
+        for batch, results in zip(batches, searched):
+            if isinstance(results, Exception):
+                yield batch, None, results
+                continue
+            # XXX column is valid in graphite names
+            yield batch, [(resource, metrics) for resource, metrics in results
+                          if accept is None or
+                          accept(resource.rsplit(':', 1)[-1])], None
+
+    def _search_nodes(self, pattern, deadline=None):
+        """Walk the tree breadth-first, one level per pattern part.
+
+        All branches matched at one level are searched together, thus the
+        number of round trips grows with the pattern depth and not with the
+        number of branches. Once deadline expires the walk stops, only the
+        nodes found so far are returned."""
+        parts = pattern.split('.')
+        parents = [None]
+        batch_size = max(1, self.config['search.batch_size'])
+        searches = 0
+
+        for depth, part in enumerate(parts):
+            remaining = len(parts) - depth - 1
+            matched = []
+
+            # the names of branches to walk are known already and none of
+            # their metrics are needed, skip listing the parents
+            names = patterns.literals(part) if remaining > 1 else None
+            if names is not None:
+                for parent in parents:
+                    for name in names:
+                        if parent is None:
+                            matched.append(name)
+                        else:
+                            matched.append('{}:{}'.format(parent, name))
+                parents = matched
+                continue
+
+            searches += (len(parents) + batch_size - 1) // batch_size
+            searched = self._search_children(parents, part,
+                                             deadline=deadline)
+            try:
+                for parent, children in searched:
+                    previous = None
+                    for resource, metrics in children:
+                        if resource == previous:
+                            continue
+                        previous = resource
+                        if not remaining:
+                            # patterns like 'foo', yield only branches
+                            yield resource, None, False
+                            continue
+                        # walk the branches first
+                        matched.append(resource)
+                        # only one pattern left, match leaves too (i.e.
+                        # metrics)
+                        if remaining == 1:
+                            for metric in patterns.match(metrics, parts[-1]):
+                                yield resource, metric, True
+            except deadlines.DeadlineExceeded:
+                logger.warn("find_deadline", finder="newts", pattern=pattern,
+                            depth=depth)
+                self.stats.incr('find.truncated')
+                break
+
+            if not matched:
+                break
+            parents = matched
+
+        self.stats.observe('find.searches', searches)
@@ -0,0 +1,179 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+
+from structlog import get_logger
+
+from . import patterns
+
+logger = get_logger()
+
+
+class _Node(object):
+    __slots__ = ('children', 'metrics')
+
+    def __init__(self):
+        # name -> _Node, None for leaf resources to save an empty dict
+        self.children = None
+        self.metrics = ()
+
+
+class MetricIndex(object):
+    """In-process prefix tree of newts resources and their metrics.
+
+    search is a callable taking a list of parent resources (None being the
+    root) and yielding (parent, [(resource, metrics), ...]) for each of
+    them, or (parent, None) if that failed, the tree is walked
+    breadth-first through it. The children of parents failing to be
+    searched are kept as they were, and walked still.
+
+    Every refresh walks the whole tree, newts doesn't tell what changed. Nodes are updated in
+    place on refresh, thus lookups can run while a refresh is in progress.
+    """
+
+    def __init__(self, search, refresh_interval=300):
+        self._search = search
+        self._root = _Node()
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self.refresh_interval = refresh_interval
+        self.ready = False
+        self.stats = {}
+
+    def _intern(self, name):
+        return self._names.setdefault(name, name)
+
+    def refresh(self):
+        """Walk the whole tree and update the index with what changed."""
+        started = time.time()
+        self._names = {}
+        level = [(None, self._root)]
+        failed = 0
+
+        while level:
+            nodes = dict(level)
+            next_level = []
+            for parent, children in self._search([x for x, _ in level]):
+                node = nodes[parent]
+                old = node.children or {}
+                if children is None:
+                    failed += 1
+                    for name, child in old.items():
+                        if parent is not None:
+                            name = '{}:{}'.format(parent, name)
+                        next_level.append((name, child))
+                    continue
+                new = {}
+                for resource, metrics in children:
+                    if parent is None:
+                        name = resource
+                    else:
+                        # XXX column is valid in graphite names
+                        name = resource.rsplit(':', 1)[1]
+                    name = self._intern(name)
+                    child = old.get(name)
+                    if child is None:
+                        child = _Node()
+                    child.metrics = tuple(self._intern(x) for x in metrics)
+                    new[name] = child
+                    next_level.append((resource, child))
+                node.children = new or None
+            level = next_level
+
+        self._names = {}
+        self.ready = True
+        self.stats = self.memory_usage()
+        logger.info("index_refresh", finder="newts", failed=failed,
+                    elapsed=time.time() - started, **self.stats)
+
+    def memory_usage(self):
+        """Return an estimate of the index size in bytes and node counts."""
+        nodes = metrics = size = 0
+        seen = set()
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            nodes += 1
+            metrics += len(node.metrics)
+            size += sys.getsizeof(node) + sys.getsizeof(node.metrics)
+            for name in node.metrics:
+                if id(name) not in seen:
+                    seen.add(id(name))
+                    size += sys.getsizeof(name)
+            if node.children:
+                size += sys.getsizeof(node.children)
+                for name, child in node.children.items():
+                    if id(name) not in seen:
+                        seen.add(id(name))
+                        size += sys.getsizeof(name)
+                    stack.append(child)
+        return {'resources': nodes - 1, 'metrics': metrics, 'bytes': size}
+
+    def find(self, pattern):
+        """Yield (resource, metric, is_leaf) matching pattern.
+
+        This mirrors NewtsFinder._search_nodes, answered from the index."""
+        parts = pattern.split('.')
+        level = [(None, self._root)]
+
+        for depth, part in enumerate(parts):
+            remaining = len(parts) - depth - 1
+            matched = []
+
+            for parent, node in level:
+                children = node.children
+                if not children:
+                    continue
+                for name in patterns.match(children, part):
+                    child = children[name]
+                    if parent is None:
+                        resource = name
+                    else:
+                        resource = '{}:{}'.format(parent, name)
+                    if not remaining:
+                        yield resource, None, False
+                        continue
+                    matched.append((resource, child))
+                    if remaining == 1:
+                        for metric in patterns.match(child.metrics,
+                                                     parts[-1]):
+                            yield resource, metric, True
+
+            if not matched:
+                return
+            level = matched
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warn("index_refresh_error", finder="newts",
+                            exception=e)
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """Load the index and keep it refreshed from a background thread."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='newts-index')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,213 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Graphite glob patterns, one path part at a time.
+
+See https://graphite.readthedocs.org/en/latest/render_api.html#paths-and-wildcards
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+CACHE_SIZE = 1024
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _translate(part, i=0, nested=False):
+    """Translate part into a regular expression, starting at index i.
+
+    Return (regex, index, terminator) where index points past the translated
+    input. When nested the translation stops at the first ',' or '}' which
+    is returned as terminator."""
+    out = []
+    n = len(part)
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '[':
+            j = i
+            if j < n and part[j] in '!^':
+                j += 1
+            if j < n and part[j] == ']':
+                j += 1
+            j = part.find(']', j)
+            if j == -1:
+                out.append(re.escape(c))
+                continue
+            chars = part[i:j].replace('\\', '\\\\')
+            i = j + 1
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            out.append('[%s]' % chars)
+        elif c == '{':
+            alternatives = []
+            terminator = None
+            j = i
+            while terminator not in ('}', ''):
+                regex, j, terminator = _translate(part, j, nested=True)
+                alternatives.append(regex)
+                terminator = terminator or ''
+            if terminator != '}':
+                # unbalanced, take the brace literally
+                out.append(re.escape(c))
+                continue
+            i = j
+            out.append('(?:%s)' % '|'.join(alternatives))
+        elif nested and c in ',}':
+            return ''.join(out), i, c
+        else:
+            out.append(re.escape(c))
+    return ''.join(out), i, None
+
+
+def compile_part(part):
+    """Return a compiled regex matching part as a whole, with an LRU cache."""
+    with _cache_lock:
+        regex = _cache.get(part)
+        if regex is not None:
+            # move to the most recently used end
+            del _cache[part]
+            _cache[part] = regex
+            return regex
+
+    regex = re.compile(r'\A(?:%s)\Z' % _translate(part)[0], re.DOTALL)
+
+    with _cache_lock:
+        _cache[part] = regex
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return regex
+
+
+def match(entries, part):
+    """Return the sorted entries matching part, like match_entries."""
+    literal = literals(part)
+    if literal is not None:
+        if len(literal) == 1:
+            return [literal[0]] if literal[0] in entries else []
+        return sorted(x for x in set(literal) if x in entries)
+    accept = compile_part(part).match
+    return sorted(x for x in entries if accept(x))
+
+
+def matcher(part):
+    """Return a predicate telling whether a single name matches part."""
+    literal = literals(part)
+    if literal is not None:
+        return frozenset(literal).__contains__
+    regex = compile_part(part)
+    return lambda name: regex.match(name) is not None
+
+
+def _expand(part):
+    # expand braces of a pattern without other wildcards
+    v1 = part.find('{')
+    if v1 == -1:
+        return [part]
+    depth = 0
+    for v2 in range(v1, len(part)):
+        if part[v2] == '{':
+            depth += 1
+        elif part[v2] == '}':
+            depth -= 1
+            if not depth:
+                break
+    else:
+        return None
+
+    alternatives = []
+    depth = 0
+    start = v1 + 1
+    for k in range(v1 + 1, v2):
+        c = part[k]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif c == ',' and not depth:
+            alternatives.append(part[start:k])
+            start = k + 1
+    alternatives.append(part[start:v2])
+
+    result = []
+    for alternative in alternatives:
+        expanded = _expand(part[:v1] + alternative + part[v2 + 1:])
+        if expanded is None:
+            return None
+        result.extend(expanded)
+    return result
+
+
+def literals(part, limit=32):
+    """Return the names part can match if they can be enumerated.
+
+    That is the case for literals and brace sets without wildcards, e.g.
+    'foo' or 'web{1,2}', up to limit distinct names. Return None
+    otherwise."""
+    if not part or '*' in part or '?' in part or '[' in part:
+        return None
+    if '{' not in part and '}' not in part:
+        return [part]
+    names = _expand(part)
+    if names is None:
+        return None
+    # e.g. {a,a}, in order
+    names = list(OrderedDict.fromkeys(names))
+    if len(names) > limit or '}' in ''.join(names):
+        return None
+    return names
+
+
+# characters with a meaning in newts search queries
+_SEARCH_SPECIAL = re.compile(r'([-+!(){}\[\]^"~*?:\\/&|\s])')
+
+
+def search_escape(value):
+    """Escape value to be searched for literally."""
+    return _SEARCH_SPECIAL.sub(r'\\\1', value)
+
+
+def search_expression(part, field, limit=32):
+    """Return a newts search expression on field for names matching part.
+
+    Literal names and prefixes translate to terms, brace sets to OR-ed
+    terms, e.g. 'web{1,2}*' to '(field:web1* OR field:web2*)', up to limit
+    terms. Return None for parts matching anything or with other
+    wildcards, they are to be matched client side."""
+    if not part or '?' in part or '[' in part:
+        return None
+    names = _expand(part)
+    if names is None or len(names) > limit:
+        return None
+
+    terms = []
+    for name in sorted(set(names)):
+        prefix = name.endswith('*')
+        if prefix:
+            name = name[:-1]
+        if not name or '*' in name or '{' in name or '}' in name:
+            return None
+        terms.append('%s:%s%s' % (field, search_escape(name),
+                                  '*' if prefix else ''))
+    if len(terms) == 1:
+        return terms[0]
+    return '(%s)' % ' OR '.join(terms)
@@ -0,0 +1,80 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Snap fetches to a fixed set of resolutions."""
+
+import flask
+
+DEFAULT_LADDER = [
+    {'step': 60, 'interval': '30s', 'heartbeat': '1m'},
+    {'step': 300, 'interval': '30s', 'heartbeat': '10m'},
+    {'step': 3600, 'interval': '30s', 'heartbeat': '2h'},
+    {'step': 86400, 'interval': '30s', 'heartbeat': '2d'},
+]
+
+
+class Rung(object):
+    __slots__ = ('step', 'interval', 'heartbeat')
+
+    def __init__(self, step, interval='30s', heartbeat='1m'):
+        self.step = int(step)
+        self.interval = interval
+        self.heartbeat = heartbeat
+
+    def __repr__(self):
+        return '<Rung: %ds interval=%s heartbeat=%s>' % (
+            self.step, self.interval, self.heartbeat)
+
+
+def request_maxpoints():
+    """Return maxDataPoints of the current request, if any."""
+    if not flask.has_request_context():
+        return None
+    body = flask.request.get_json(silent=True)
+    if isinstance(body, dict) and 'maxDataPoints' in body:
+        value = body['maxDataPoints']
+    else:
+        value = flask.request.values.get('maxDataPoints')
+    try:
+        value = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+class Ladder(object):
+    """The resolutions fetches are allowed to use, from the finest.
+
+    Snapping to a few resolutions keeps fetches of similar time ranges
+    cacheable, rungs is a list of dicts with step (in seconds), interval
+    and heartbeat as used in the newts result descriptor."""
+
+    def __init__(self, rungs=None):
+        if rungs is None:
+            rungs = DEFAULT_LADDER
+        self.rungs = sorted((Rung(**x) for x in rungs), key=lambda x: x.step)
+        if not self.rungs:
+            raise ValueError('empty resolution ladder')
+
+    def rung(self, time_start, time_end, maxpoints):
+        """Return the finest rung fetching at most maxpoints, or the
+        coarsest one. maxDataPoints of the current request, if any, takes
+        precedence over maxpoints."""
+        maxpoints = request_maxpoints() or maxpoints
+        wanted = float(time_end - time_start) / maxpoints
+        for rung in self.rungs:
+            if rung.step >= wanted:
+                return rung
+        return self.rungs[-1]
@@ -0,0 +1,146 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Search cache entries in a local SQLite file, shared by all processes.
+
+Entries are stored as SearchCache builds them, the results staying in
+their encoded form: a row is the digest of the key, the expiry times and
+the JSON lines blob. Reading an entry copies the blob and nothing else,
+results are decoded as SearchCache iterates over them.
+
+The file is in WAL mode, readers never wait for writers. Once it grows
+past size bytes the rows expiring first are deleted, their pages being
+reused afterwards."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from structlog import get_logger
+
+logger = get_logger()
+
+# sets between checks of the file size
+PRUNE_EVERY = 100
+# fraction of the rows deleted when the file is too big
+PRUNE_FRACTION = 0.1
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS entries ('
+           'key BLOB PRIMARY KEY, '
+           'evict REAL NOT NULL, '
+           'expires REAL NOT NULL, '
+           'compressed INTEGER NOT NULL, '
+           'data BLOB) WITHOUT ROWID')
+
+
+def _digest(key):
+    return sqlite3.Binary(hashlib.md5(key.encode('utf-8')).digest())
+
+
+class SearchStore(object):
+    """Store SearchCache entries in a file of about size bytes.
+
+    It implements get(), get_many() and set() like graphite-api caches do,
+    for SearchCache entries only, i.e. (expires, compressed, data)."""
+
+    def __init__(self, directory, size):
+        self.path = os.path.join(directory, 'search.db')
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._db = None
+        self._sets = 0
+
+    def _open(self):
+        # sqlite connections must not be used across fork()
+        if self._pid == os.getpid():
+            return self._db
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, timeout=1, isolation_level=None,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute(_SCHEMA)
+        self._db = db
+        self._pid = os.getpid()
+        return db
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        entries = dict((x, None) for x in keys)
+        digests = dict((bytes(_digest(x)), x) for x in keys)
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._open()
+                rows = db.execute(
+                        'SELECT key, expires, compressed, data FROM entries '
+                        'WHERE evict > ? AND key IN (%s)' %
+                        ','.join('?' * len(digests)),
+                        [now] + [sqlite3.Binary(x) for x in digests])
+                rows = rows.fetchall()
+        except (sqlite3.Error, EnvironmentError) as e:
+            logger.warn("search_store_error", path=self.path, exception=e)
+            rows = []
+
+        for digest, expires, compressed, data in rows:
+            if data is not None:
+                data = bytes(data)
+            entries[digests[bytes(digest)]] = (expires, bool(compressed),
+                                               data)
+        return [entries[x] for x in keys]
+
+    def set(self, key, entry, timeout):
+        expires, compressed, data = entry
+        if data is not None:
+            data = sqlite3.Binary(data)
+        try:
+            with self._lock:
+                db = self._open()
+                db.execute('INSERT OR REPLACE INTO entries VALUES '
+                           '(?, ?, ?, ?, ?)',
+                           (_digest(key), time.time() + timeout, expires,
+                            int(compressed), data))
+                self._sets += 1
+                if self._sets % PRUNE_EVERY == 0:
+                    self._prune(db)
+        except (sqlite3.Error, EnvironmentError) as e:
+            logger.warn("search_store_error", path=self.path, exception=e)
+
+    def _prune(self, db):
+        db.execute('DELETE FROM entries WHERE evict <= ?', (time.time(),))
+        pages, = db.execute('PRAGMA page_count').fetchone()
+        page_size, = db.execute('PRAGMA page_size').fetchone()
+        free, = db.execute('PRAGMA freelist_count').fetchone()
+        if (pages - free) * page_size <= self.size:
+            return
+        rows, = db.execute('SELECT COUNT(*) FROM entries').fetchone()
+        logger.info("search_store_prune", path=self.path, rows=rows,
+                    size=pages * page_size)
+        db.execute('DELETE FROM entries WHERE key IN (SELECT key FROM '
+                   'entries ORDER BY evict LIMIT ?)',
+                   (max(1, int(rows * PRUNE_FRACTION)),))
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._db.close()
+            self._pid = None
@@ -0,0 +1,72 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NAN = float('nan')
+
+
+class SeriesBuffer(object):
+    """Fixed-step series backed by a preallocated array of doubles.
+
+    Slots without a datapoint are NaN until converted with tolist()."""
+    __slots__ = ('start', 'end', 'step', 'values')
+
+    def __init__(self, start, end, step):
+        self.start = start
+        self.end = end
+        self.step = step
+        self.values = array('d', [NAN]) * ((end - start) // step)
+
+    def add(self, timestamp, value):
+        """Store value in the slot of timestamp (in seconds), if in range."""
+        index = (int(timestamp) - self.start) // self.step
+        if 0 <= index < len(self.values):
+            self.values[index] = value
+
+    def update(self, start, values):
+        """Copy values, an array of slots starting at start, in place."""
+        offset = (int(start) - self.start) // self.step
+        lo = max(0, -offset)
+        hi = min(len(values), len(self.values) - offset)
+        if lo < hi:
+            self.values[offset + lo:offset + hi] = values[lo:hi]
+
+    def tolist(self):
+        """Return the values as a list with None in place of NaN."""
+        if numpy is not None:
+            values = numpy.frombuffer(self.values, dtype=numpy.float64)
+            result = values.astype(object)
+            result[numpy.isnan(values)] = None
+            return result.tolist()
+        return [None if v != v else v for v in self.values]
+
+
+def fill(buffers, rows):
+    """Add rows as returned by NewtsClient.fetch_multi to buffers.
+
+    buffers maps each metric to its SeriesBuffer, timestamps are in ms."""
+    for timestamp_ms, values in rows:
+        timestamp = timestamp_ms // 1000
+        for metric, value in values.items():
+            buf = buffers.get(metric)
+            if buf is not None:
+                buf.add(timestamp, value)
+    return buffers
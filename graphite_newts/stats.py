@@ -0,0 +1,209 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counters and timers of the finder, sent to statsd or scraped by
+prometheus.
+
+Names are dotted, e.g. http.search.latency, and prefixed when sent."""
+
+import socket
+import threading
+import time
+
+import flask
+from structlog import get_logger
+
+logger = get_logger()
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullStats(object):
+    """Discard everything, used when stats are disabled."""
+    enabled = False
+
+    def incr(self, name, value=1):
+        pass
+
+    def adjust(self, name, delta):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+
+class _Timer(object):
+    __slots__ = ('stats', 'name', 'started')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.timing(self.name, time.time() - self.started)
+        return False
+
+
+class Stats(NullStats):
+    """Send counters, gauges, timings and observations to sink.
+
+    sink implements count(), gauge(), timing() and observe(), each taking
+    a prefixed name and a value."""
+    enabled = True
+
+    def __init__(self, sink, prefix='graphite_newts'):
+        self.sink = sink
+        self.prefix = prefix + '.' if prefix else ''
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        self.sink.count(self.prefix + name, value)
+
+    def adjust(self, name, delta):
+        """Move the gauge name up or down by delta, e.g. requests in
+        flight."""
+        with self._lock:
+            level = self._levels[name] = self._levels.get(name, 0) + delta
+        self.sink.gauge(self.prefix + name, level)
+
+    def timing(self, name, seconds):
+        self.sink.timing(self.prefix + name, seconds)
+
+    def observe(self, name, value):
+        """Record value into the distribution name, e.g. a size."""
+        self.sink.observe(self.prefix + name, value)
+
+    def timer(self, name):
+        """Return a context manager recording its duration as name."""
+        return _Timer(self, name)
+
+
+class StatsdSink(object):
+    """Send stats to statsd over UDP, fire and forget."""
+
+    def __init__(self, host='localhost', port=8125):
+        family, _, _, _, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_DGRAM)[0]
+        self.address = address
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error as e:
+            logger.debug("statsd_error", exception=e)
+
+    def count(self, name, value):
+        self._send('%s:%d|c' % (name, value))
+
+    def gauge(self, name, value):
+        self._send('%s:%d|g' % (name, value))
+
+    def timing(self, name, seconds):
+        self._send('%s:%.3f|ms' % (name, seconds * 1000))
+
+    def observe(self, name, value):
+        self._send('%s:%d|h' % (name, value))
+
+
+class PrometheusSink(object):
+    """Aggregate stats in process, exposed in the prometheus text format.
+
+    Timings and observations are exported as summaries without quantiles,
+    i.e. their count and sum."""
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def _name(self, name):
+        return name.replace('.', '_').replace('-', '_')
+
+    def count(self, name, value):
+        name = self._name(name) + '_total'
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[self._name(name)] = value
+
+    def _summary(self, name, value):
+        with self._lock:
+            summary = self._summaries.get(name)
+            if summary is None:
+                summary = self._summaries[name] = [0, 0]
+            summary[0] += 1
+            summary[1] += value
+
+    def timing(self, name, seconds):
+        self._summary(self._name(name) + '_seconds', seconds)
+
+    def observe(self, name, value):
+        self._summary(self._name(name), value)
+
+    def render(self):
+        """Return all stats in the prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s %s' % (name, value))
+            for name, value in sorted(self._gauges.items()):
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, value))
+            for name, (count, total) in sorted(self._summaries.items()):
+                lines.append('# TYPE %s summary' % name)
+                lines.append('%s_count %d' % (name, count))
+                lines.append('%s_sum %r' % (name, float(total)))
+        return '\n'.join(lines) + '\n'
+
+    def mount(self, app, path):
+        """Serve the stats from the flask app at path."""
+        endpoint = 'newts_stats'
+        if endpoint in app.view_functions:
+            logger.warn("stats_endpoint_exists", path=path)
+            return
+
+        def view():
+            return flask.Response(self.render(), mimetype=None,
+                                  content_type=self.CONTENT_TYPE)
+        app.add_url_rule(path, endpoint, view)
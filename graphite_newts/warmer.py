@@ -0,0 +1,223 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Warm the finder caches with the queries seen most often.
+
+Finds are recorded as (pattern, window), window being the length in
+seconds of the time range of renders and None for plain finds. The most
+frequent ones are saved to a JSON file, which every process replays from
+a background thread at start and then periodically, last writer winning.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import flask
+from structlog import get_logger
+
+from . import workers
+
+logger = get_logger()
+
+FORMAT_VERSION = 1
+# render windows are recorded rounded to this many seconds
+WINDOW_STEP = 60
+# distinct queries tracked per entry saved
+TRACKED_FACTOR = 10
+
+
+class CacheWarmer(object):
+    """Record the queries of finder and replay them to fill its caches.
+
+    Up to entries queries are kept in path, counts being halved once
+    every interval seconds so that recent queries win, however many
+    processes save. Replays run every interval seconds, at most
+    concurrency at a time. The process is ready once threshold of the
+    saved queries were replayed successfully, right away without any, or
+    after timeout seconds whatever the replays did."""
+
+    def __init__(self, finder, path, entries=100, interval=600,
+                 concurrency=2, threshold=0.9, timeout=300):
+        self.finder = finder
+        self.path = path
+        self.entries = entries
+        self.interval = interval
+        self.threshold = threshold
+        self.timeout = timeout
+        self.workers = workers.WorkerPool(concurrency)
+        self.counts = Counter()
+        self.ready = False
+        self.progress = {'total': 0, 'done': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+        self._started = None
+
+    def record(self, pattern, start=None, end=None):
+        """Count a find of pattern over start to end, epoch seconds.
+
+        Only finds of requests are counted, e.g. not replays."""
+        if not flask.has_request_context():
+            return
+        self.start()
+        window = None
+        if start and end and end > start:
+            window = max(WINDOW_STEP, int(round(float(end - start) /
+                                                WINDOW_STEP)) * WINDOW_STEP)
+        with self._lock:
+            self.counts[(pattern, window)] += 1
+            if len(self.counts) > self.entries * TRACKED_FACTOR:
+                self.counts = Counter(dict(
+                        self.counts.most_common(len(self.counts) // 2)))
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (EnvironmentError, ValueError) as e:
+            logger.info("warmer_load_error", path=self.path, exception=e)
+            return {}
+        if saved.get('version') != FORMAT_VERSION:
+            return {}
+        return saved
+
+    def load(self):
+        """Return the [(pattern, window, count), ...] saved in path."""
+        return [tuple(x) for x in self._read().get('queries', [])]
+
+    def save(self):
+        """Merge the queries recorded with those in path and save the most
+        frequent ones, halving the counts if the last halving is older
+        than interval."""
+        with self._lock:
+            counts = self.counts
+            self.counts = Counter()
+        saved = self._read()
+        for pattern, window, count in saved.get('queries', []):
+            counts[(pattern, window)] += count
+        now = time.time()
+        decayed = saved.get('decayed', 0)
+        decay = now - decayed >= self.interval
+        if decay:
+            decayed = now
+        queries = [[pattern, window, (count // 2 or 1) if decay else count]
+                   for (pattern, window), count
+                   in counts.most_common(self.entries)]
+
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': FORMAT_VERSION, 'decayed': decayed,
+                           'queries': queries}, f)
+            os.chmod(path, 0o644)
+            os.rename(path, self.path)
+        except EnvironmentError as e:
+            logger.warn("warmer_save_error", path=self.path, exception=e)
+
+    def _replay_one(self, query):
+        # graphite_api.storage needs the app configured
+        from graphite_api.storage import FindQuery
+
+        pattern, window, _ = query
+        now = int(time.time())
+        start = now - window if window else None
+        end = now if window else None
+        nodes = list(self.finder.find_nodes(FindQuery(pattern, start, end)))
+        leaves = [x for x in nodes if x.is_leaf]
+        if window and leaves:
+            self.finder.fetch_multi(leaves, start, end)
+        return len(leaves)
+
+    def replay(self):
+        """Run the queries saved in path."""
+        queries = self.load()
+        started = time.time()
+        self.progress = {'total': len(queries), 'done': 0, 'failed': 0}
+        self._check_ready()
+        for query, _, error in self.workers.map(self._replay_one, queries):
+            self.progress['done'] += 1
+            if error is not None:
+                logger.warn("warmer_replay_error", pattern=query[0],
+                            exception=error)
+                self.progress['failed'] += 1
+            self._check_ready()
+        logger.info("warmer_replay", elapsed=time.time() - started,
+                    **self.progress)
+
+    def _check_ready(self):
+        if self.ready:
+            return
+        total = self.progress['total']
+        succeeded = self.progress['done'] - self.progress['failed']
+        if not total or succeeded >= total * self.threshold:
+            logger.info("warmer_ready", **self.progress)
+            self.ready = True
+        elif (self._started is not None and
+              time.time() - self._started >= self.timeout):
+            logger.warn("warmer_ready_timeout", timeout=self.timeout,
+                        **self.progress)
+            self.ready = True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.replay()
+            except Exception as e:
+                logger.warn("warmer_error", exception=e)
+            self._stop.wait(self.interval)
+            self.save()
+
+    def start(self):
+        """Replay from a background thread, once per process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # the state inherited through fork() is not this process'
+            self.ready = False
+            self.counts = Counter()
+            self._started = time.time()
+            thread = threading.Thread(target=self._run, name='newts-warmer')
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+
+    def mount(self, app, path):
+        """Serve the readiness state from the flask app at path, with
+        status 503 until ready."""
+        endpoint = 'newts_ready'
+        if endpoint in app.view_functions:
+            logger.warn("ready_endpoint_exists", path=path)
+            return
+
+        def view():
+            self.start()
+            self._check_ready()
+            state = dict(self.progress, ready=self.ready)
+            return flask.Response(json.dumps(state),
+                                  status=200 if self.ready else 503,
+                                  content_type='application/json')
+        app.add_url_rule(path, endpoint, view)
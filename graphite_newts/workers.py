@@ -0,0 +1,111 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from structlog import get_logger
+
+from .deadlines import DeadlineExceeded
+
+logger = get_logger()
+
+
+class WorkerPool(object):
+    """A lazily started thread pool shared by all requests of a finder.
+
+    With size <= 1 calls are run inline in the calling thread."""
+
+    def __init__(self, size):
+        self.size = size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.size)
+        return self._executor
+
+    def map(self, func, items, limit=None, deadline=None):
+        """Run func over items with at most limit calls in flight.
+
+        Yield (item, result, error) in the same order as items. A failing
+        call yields its exception as error without affecting the others.
+        Once deadline expires the calls not done yet are abandoned, they
+        yield DeadlineExceeded as error."""
+        if self.size <= 1:
+            for item in items:
+                try:
+                    if deadline is not None:
+                        deadline.check()
+                    yield item, func(item), None
+                except Exception as e:
+                    yield item, None, e
+            return
+
+        if limit is None or limit <= 0:
+            limit = self.size
+
+        executor = self._get_executor()
+        items = iter(items)
+        pending = deque()
+
+        def submit():
+            for item in items:
+                future = None
+                if deadline is None or not deadline.expired:
+                    future = executor.submit(func, item)
+                pending.append((item, future))
+                return
+
+        for _ in range(limit):
+            submit()
+
+        try:
+            while pending:
+                item, future = pending.popleft()
+                try:
+                    if future is None:
+                        raise DeadlineExceeded()
+                    timeout = None
+                    if deadline is not None:
+                        timeout = deadline.remaining()
+                    result, error = future.result(timeout), None
+                except FutureTimeoutError as e:
+                    if future.done():
+                        # raised by func itself
+                        result, error = None, e
+                    else:
+                        future.cancel()
+                        result, error = None, DeadlineExceeded()
+                except Exception as e:
+                    result, error = None, e
+                submit()
+                yield item, result, error
+        finally:
+            # the consumer went away, don't leave work queued
+            for _, future in pending:
+                if future is not None:
+                    future.cancel()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
@@ -7,7 +7,10 @@ setup(
     description          = 'A graphite storage finder for Newts.',
     author               = 'Filippo Giunchedi',
     author_email         = 'fgiunchedi@wikimedia.org',
-    install_requires     = ['graphite-api', 'requests', 'click', 'parsedatetime'],
+    install_requires     = ['graphite-api', 'requests', 'click', 'parsedatetime',
+                            'futures; python_version < "3"'],
+    extras_require       = {'numpy': ['numpy'],
+                            'async': ['aiohttp; python_version >= "3.5"']},
     include_package_data = True,
     setup_requires       = ['nose>=1.0'],
     tests_require        = ['requests-mock', 'coverage'],
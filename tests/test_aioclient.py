@@ -0,0 +1,206 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from graphite_newts import aioclient
+except (ImportError, SyntaxError):
+    aioclient = None
+    BaseHTTPRequestHandler = HTTPServer = ThreadingMixIn = object
+
+import flask
+
+import graphite_api_app
+from test_cache import DictCache
+from test_finder import FakeNewtsClient, Query
+from graphite_newts import finder
+from graphite_newts.deadlines import Deadline, DeadlineExceeded
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Reply with the JSON registered for the request path."""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self):
+        self.server.requests.append(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        time.sleep(self.server.delay)
+        path = self.path.split('?')[0]
+        if path not in self.server.replies:
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.replies[path]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _reply
+
+
+@unittest.skipIf(aioclient is None, 'needs python 3 and aiohttp')
+class TestSyncNewtsClient(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.replies = {}
+        self.server.requests = []
+        self.server.delay = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.client = aioclient.SyncNewtsClient(
+                'http://127.0.0.1:%d' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testFetch(self):
+        self.server.replies['/measurements/foo'] = [
+                [{'name': 'a', 'timestamp': 1000, 'value': 1},
+                 {'name': 'b', 'timestamp': 1000, 'value': 2}],
+                [{'name': 'a', 'timestamp': 2000, 'value': 3}]]
+        self.assertEqual(self.client.fetch_multi('foo', ['a', 'b'], 0, 60, 1),
+                         [(1000, {'a': 1, 'b': 2}), (2000, {'a': 3})])
+        self.assertEqual(self.client.fetch('foo', 'b', 0, 60, 1),
+                         [(1000, 2)])
+
+    def testSearch(self):
+        self.server.replies['/search'] = [
+                {'resource': {'id': 'a:b'}, 'metrics': ['m1']}]
+        self.assertEqual(self.client.search('_parent:a'), [('a:b', ['m1'])])
+        self.assertEqual(self.client.search_many(['_parent:a', '_parent:b']),
+                         [[('a:b', ['m1'])], [('a:b', ['m1'])]])
+
+    def testFetchMany(self):
+        self.server.replies['/measurements/foo'] = [
+                [{'name': 'a', 'timestamp': 1000, 'value': 1}]]
+        results = self.client.fetch_many([
+                {'resource': 'foo', 'metrics': ['a'], 'start': 0, 'end': 60,
+                 'resolution': 1},
+                {'resource': 'missing', 'metrics': ['a'], 'start': 0,
+                 'end': 60, 'resolution': 1}])
+        self.assertEqual(results[0], [(1000, {'a': 1})])
+        self.assertIsInstance(results[1], Exception)
+
+    def testFailover(self):
+        self.server.replies['/search'] = []
+        url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        client = aioclient.SyncNewtsClient(['http://127.0.0.1:1', url],
+                                           retries=0)
+        try:
+            for _ in range(2):
+                self.assertEqual(client.search('_parent:a'), [])
+        finally:
+            client.close()
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testDeadline(self):
+        self.server.replies['/search'] = []
+        self.server.delay = 1
+        started = time.time()
+        with self.assertRaises(DeadlineExceeded):
+            self.client.search('_parent:a', deadline=Deadline(0.2))
+        results = self.client.search_many(['_parent:a', '_parent:b'],
+                                          deadline=Deadline(0.2))
+        self.assertIsInstance(results[1], DeadlineExceeded)
+        self.assertLess(time.time() - started, 0.8)
+
+    def testSearchError(self):
+        # failed searches return no results, like NewtsClient.search
+        self.assertEqual(self.client.search('_parent:a'), [])
+
+
+class FakeAsyncClient(FakeNewtsClient):
+    def __init__(self, url):
+        super(FakeAsyncClient, self).__init__(url)
+        self.calls = []
+
+    def fetch_many(self, requests, deadline=None):
+        self.calls.append(('fetch_many', len(requests)))
+        results = []
+        for request in requests:
+            try:
+                results.append(list(self.fetch_multi(**request)))
+            except IOError as e:
+                results.append(e)
+        return results
+
+    def search_many(self, terms, deadline=None, strict=False):
+        self.calls.append(('search_many', len(terms)))
+        return [list(self.search(x)) for x in terms]
+
+
+class TestFinderFetchMany(graphite_api_app.TestCase):
+    def _finder(self, client, cache=True):
+        app = flask.Flask('test')
+        app.cache = DictCache()
+        return finder.NewtsFinder({'newts': {'url': 'localhost'},
+                                   'cache': {} if cache else None},
+                                  newts_client=client, app=app)
+
+    def _client(self):
+        client = FakeAsyncClient('test')
+        for x in ('b', 'c', 'd'):
+            client._insert('a:%s' % x, 'm1', [(60000, 1.0), (120000, 2.0)])
+        client._broken.add('a:d')
+        return client
+
+    def testFetchMulti(self):
+        for cache in (True, False):
+            client = self._client()
+            f = self._finder(client, cache)
+            nodes = list(f.find_nodes(Query('a.*.m1')))
+            # one call per level, searching all branches at once
+            self.assertEqual(client.calls, [('search_many', 1),
+                                            ('search_many', 3)])
+
+            for _ in range(2):
+                time_info, series = f.fetch_multi(nodes, 0, 180)
+            self.assertEqual(series['a.b.m1'], [None, 1.0, 2.0])
+            self.assertEqual(series['a.c.m1'], [None, 1.0, 2.0])
+            self.assertEqual(series['a.d.m1'], [None] * 3)
+            # cached resources are not fetched again
+            fetched = [x for x in client.calls if x[0] == 'fetch_many']
+            self.assertEqual(fetched, [('fetch_many', 3),
+                                       ('fetch_many', 1 if cache else 3)])
+
+    def testAsyncConfig(self):
+        if aioclient is None:
+            with self.assertRaises(ValueError):
+                finder.NewtsFinder({'newts': {'http.async': True}})
+            return
+        f = finder.NewtsFinder({'newts': {'http.async': True}})
+        self.assertIsInstance(f.client, aioclient.SyncNewtsClient)
+
+
+if __name__ == '__main__':
+    unittest.main()
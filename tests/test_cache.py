@@ -0,0 +1,305 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from graphite_newts import cache
+from graphite_newts import stats as newts_stats
+from graphite_newts.deadlines import DeadlineExceeded
+
+
+class DictCache(object):
+    """The subset of the graphite-api cache interface in use."""
+
+    def __init__(self):
+        self.data = {}
+        self.timeouts = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def get_many(self, *keys):
+        return [self.data.get(k) for k in keys]
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+        self.timeouts[key] = timeout
+
+    def add(self, key, value, timeout=None):
+        if key not in self.data:
+            self.set(key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class Fetcher(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, metrics, start, end):
+        self.calls.append((tuple(metrics), start, end))
+        for ts in range(start, end, 60):
+            yield ts * 1000, dict((m, float(ts)) for m in metrics)
+
+
+class TestFetchCache(unittest.TestCase):
+    def setUp(self):
+        self.backend = DictCache()
+        self.cache = cache.FetchCache(self.backend, bucket_points=10,
+                                      ttl=1000, recent_ttl=10, settle=0)
+        self.fetcher = Fetcher()
+
+    def _fetch(self, start, end, metrics=('m1', 'm2')):
+        return self.cache.fetch(self.fetcher, 'res', list(metrics),
+                                (start, end, 60))
+
+    def testReuse(self):
+        buffers = self._fetch(0, 1800)
+        self.assertEqual(self.fetcher.calls, [(('m1', 'm2'), 0, 1800)])
+        self.assertEqual(buffers['m1'].tolist(),
+                         [float(x) for x in range(0, 1800, 60)])
+
+        # fully cached
+        buffers = self._fetch(300, 1500)
+        self.assertEqual(len(self.fetcher.calls), 1)
+        self.assertEqual(buffers['m2'].tolist(),
+                         [float(x) for x in range(300, 1500, 60)])
+
+    def testTail(self):
+        self._fetch(0, 1200)
+        buffers = self._fetch(300, 2100)
+        # only the buckets past the cached ones
+        self.assertEqual(self.fetcher.calls[1], (('m1', 'm2'), 1200, 2400))
+        self.assertEqual(buffers['m1'].tolist(),
+                         [float(x) for x in range(300, 2100, 60)])
+
+    def testOnlyMissingMetrics(self):
+        self._fetch(0, 600, metrics=['m1'])
+        self._fetch(0, 600)
+        self.assertEqual(self.fetcher.calls[1], (('m2',), 0, 600))
+
+    def testKeys(self):
+        resource = 'a b:' + 'c' * 300
+        self.cache.fetch(self.fetcher, resource, ['m 1'], (0, 1200, 60))
+        for key in self.backend.data:
+            self.assertLessEqual(len(key), 250)
+            self.assertNotIn(' ', key)
+        self.cache.fetch(self.fetcher, resource, ['m 1'], (0, 1200, 60))
+        self.assertEqual(len(self.fetcher.calls), 1)
+
+    def testTimeouts(self):
+        now = int(time.time())
+        now -= now % 600
+        self._fetch(now - 1200, now + 60, metrics=['m1'])
+        timeouts = sorted(self.backend.timeouts.values())
+        self.assertEqual(timeouts, [10, 1000, 1000])
+
+
+class TestSearchCache(unittest.TestCase):
+    def setUp(self):
+        self.backend = DictCache()
+        self.cache = cache.SearchCache(self.backend, ttl=60, stale_ttl=600,
+                                       negative_ttl=5)
+        self.calls = 0
+
+    def _search(self, results, delay=0):
+        def search():
+            self.calls += 1
+            time.sleep(delay)
+            for x in results:
+                yield x
+        return search
+
+    def testCached(self):
+        search = self._search([('foo', ['m'])])
+        self.assertEqual(list(self.cache.get('_parent:_root', search)),
+                         [('foo', ['m'])])
+        self.assertEqual(list(self.cache.get('_parent:_root', search)),
+                         [('foo', ['m'])])
+        self.assertEqual(self.calls, 1)
+        key = self.cache._key('_parent:_root')
+        self.assertEqual(self.backend.timeouts[key], 660)
+
+    def testCoalescing(self):
+        search = self._search([('foo', [])], delay=0.05)
+        results = []
+        threads = [threading.Thread(
+                   target=lambda: results.append(
+                       list(self.cache.get('t', search))))
+                   for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [[('foo', [])]] * 10)
+
+    def testStaleWhileRevalidate(self):
+        key = self.cache._key('t')
+        count, data = cache._encode([('old', [])])
+        self.backend.set(key, (time.time() - 1, True, data))
+        search = self._search([('new', [])], delay=0.05)
+
+        self.assertEqual(list(self.cache.get('t', search)), [('old', [])])
+        # a single refresh runs
+        self.assertEqual(list(self.cache.get('t', search)), [('old', [])])
+        for _ in range(100):
+            if self.backend.get(key)[0] > time.time():
+                break
+            time.sleep(0.01)
+        self.assertEqual(list(self.cache.get('t', search)), [('new', [])])
+        self.assertEqual(self.calls, 1)
+
+    def testNegative(self):
+        def broken():
+            raise IOError()
+
+        self.assertEqual(list(self.cache.get('t', broken)), [])
+        self.assertEqual(list(self.cache.get('e', self._search([]))), [])
+        self.assertEqual(self.backend.timeouts[self.cache._key('t')], 605)
+        self.assertEqual(self.backend.timeouts[self.cache._key('e')], 605)
+
+    def testDeadline(self):
+        def late():
+            raise DeadlineExceeded()
+            yield
+
+        with self.assertRaises(DeadlineExceeded):
+            list(self.cache.get('t', late))
+        # not cached as a failure
+        self.assertIsNone(self.backend.get(self.cache._key('t')))
+
+        results = self.cache.get_many(
+                ['t', 'u'], lambda terms: [DeadlineExceeded(), [('u', [])]])
+        self.assertIsInstance(results[0], DeadlineExceeded)
+        self.assertEqual(list(results[1]), [('u', [])])
+        self.assertIsNone(self.backend.get(self.cache._key('t')))
+
+    def testEncoding(self):
+        results = [('r%d' % i, ['m1', u'm\u00e9']) for i in range(5000)]
+        for compress in (True, False):
+            count, data = cache._encode(results, compress)
+            self.assertEqual(count, 5000)
+            self.assertEqual(list(cache._decode(data, compress,
+                                                chunk_size=100)), results)
+        self.assertIsNone(cache._encode(results, False, max_size=1000))
+
+    def testOversize(self):
+        c = cache.SearchCache(self.backend, max_entry=100)
+        results = [('r%d' % i, ['m']) for i in range(100)]
+        self.assertEqual(list(c.get('t', self._search(results))), results)
+        self.assertEqual(list(c.get('t', self._search(results))), results)
+        # not cached, the second request goes to newts
+        self.assertEqual(self.calls, 2)
+        self.assertIsNone(self.backend.get(c._key('t'))[2])
+
+        self.assertEqual([list(x) for x in c.get_many(
+                ['u'], lambda terms: [results] * len(terms))], [results])
+
+    def testOversizeCoalescing(self):
+        c = cache.SearchCache(self.backend, max_entry=100)
+        expected = [('r%d' % i, ['m']) for i in range(100)]
+        search = self._search(expected, delay=0.05)
+        results = []
+        threads = [threading.Thread(
+                   target=lambda: results.append(list(c.get('t', search))))
+                   for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [expected] * 10)
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        # test_stats imports this module
+        from test_stats import RecordingSink
+        self.sink = RecordingSink()
+        self.backend = DictCache()
+
+    def _cache(self, size=10000, ttl=60):
+        return cache.LocalCache(self.backend, size, ttl,
+                                newts_stats.Stats(self.sink, prefix='p'))
+
+    def _count(self, name):
+        return self.sink.total('count', 'p.cache.search.' + name)
+
+    def testTiers(self):
+        c = self._cache()
+        self.backend.set('a', (0, True, b'a'))
+        self.assertEqual(c.get_many('a', 'b'), [(0, True, b'a'), None])
+        # a is answered locally, without asking the backend
+        del self.backend.data['a']
+        self.assertEqual(c.get('a'), (0, True, b'a'))
+        self.assertEqual((self._count('l1.hits'), self._count('l1.misses')),
+                         (1, 2))
+        self.assertEqual((self._count('l2.hits'), self._count('l2.misses')),
+                         (1, 1))
+
+        c.set('b', (0, True, b'b'), 30)
+        self.assertEqual(self.backend.timeouts['b'], 30)
+        self.assertEqual(c.get('b'), (0, True, b'b'))
+
+    def testExpiry(self):
+        c = self._cache(ttl=-1)
+        c.set('a', (0, True, b'a'), 60)
+        del self.backend.data['a']
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(c.used, 0)
+
+    def testSizeWeightedEviction(self):
+        overhead = cache.LocalCache.OVERHEAD + 1
+        c = self._cache(size=4 * overhead + 1000)
+        c.set('a', (0, True, b''), 60)
+        c.set('b', (0, True, b'x' * 1000), 60)
+        c.set('c', (0, True, b''), 60)
+        c.set('d', (0, True, b''), 60)
+        self.backend.data.clear()
+        # the big entry goes first, although not the least recently used
+        c.set('e', (0, True, b''), 60)
+        self.assertIsNone(c.get('b'))
+        for key in 'acde':
+            self.assertIsNotNone(c.get(key))
+        self.assertLessEqual(c.used, c.size)
+        self.assertEqual(self._count('l1.evictions'), 1)
+        # too big to be kept at all
+        c.set('f', (0, True, b'x' * c.size), 60)
+        self.backend.data.clear()
+        self.assertIsNone(c.get('f'))
+
+    def testSearchCache(self):
+        calls = []
+
+        def search():
+            calls.append(1)
+            return [('a:b', ['m1'])]
+
+        c = cache.SearchCache(cache.LocalCache(None, 10000))
+        for _ in range(2):
+            self.assertEqual(list(c.get('t', search)), [('a:b', ['m1'])])
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import unittest
+
+import requests_mock
+from click.testing import CliRunner
+
+import graphite_api_app
+from test_finder import FakeNewtsClient
+from graphite_newts import cli
+
+
+class TestExport(graphite_api_app.TestCase):
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.client = FakeNewtsClient('test')
+        self.client.url = 'test'
+        self.client._insert('a:b', 'm1', [(60000, 1.0), (120000, 2.0)])
+        self.client._insert('a:b', 'm2', [(60000, float('nan'))])
+        self.client._insert('a:c', 'm1', [(60000, 3.0)])
+        self.client._broken.add('a:d')
+
+    def testReadPairs(self):
+        lines = ['a:b m1\n', '# comment\n', '\n', 'a:c,m2\n']
+        self.assertEqual(list(cli.read_pairs(lines)),
+                         [('a:b', 'm1'), ('a:c', 'm2')])
+
+    def testCsv(self):
+        out = io.StringIO()
+        stats = cli.export(self.client, [('a:b', 'm1'), ('a:c', 'm1'),
+                                         ('a:b', 'm2')],
+                           out, (0, 180, 60), concurrency=2)
+        self.assertEqual(out.getvalue().splitlines(),
+                         ['a:b,m1,60,1.0', 'a:b,m1,120,2.0',
+                          'a:c,m1,60,3.0'])
+        # one request per resource
+        self.assertEqual(sorted(self.client.fetches),
+                         [('a:b', ['m1', 'm2']), ('a:c', ['m1'])])
+        self.assertEqual(stats['exported'], 3)
+        self.assertEqual(stats['points'], 3)
+
+    def testNdjsonErrors(self):
+        out = io.StringIO()
+        progress = []
+        stats = cli.export(self.client, [('a:d', 'm1'), ('a:c', 'm1')], out,
+                           (0, 180, 60), fmt='ndjson',
+                           progress=lambda x: progress.append(x['done']))
+        lines = [json.loads(x) for x in out.getvalue().splitlines()]
+        self.assertEqual(lines, [{'resource': 'a:c', 'metric': 'm1',
+                                  'datapoints': [[3.0, 60]]}])
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(progress, [1, 2])
+
+    def testGlob(self):
+        self.assertEqual(list(cli.glob_pairs(self.client, 'a.*.m1', 0, 180)),
+                         [('a:b', 'm1'), ('a:c', 'm1')])
+
+    @requests_mock.Mocker()
+    def testCommand(self, m):
+        m.post('/measurements/a:b', json=[[{'name': 'm1', 'timestamp': 60000,
+                                            'value': 1}]])
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            with open('pairs', 'w') as f:
+                f.write('a:b m1\n')
+            result = runner.invoke(cli.main, ['newts-export', '--pairs',
+                                              'pairs', '--output', 'out'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open('out') as f:
+                self.assertEqual(f.read(), 'a:b,m1,60,1.0\n')
+
+        result = runner.invoke(cli.main, ['newts-export'])
+        self.assertNotEqual(result.exit_code, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,12 +13,22 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import unittest
 import math
+import threading
+import time
 
 import requests
 import requests_mock
-from graphite_newts.client import NewtsClient
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from graphite_newts.client import NewtsClient, iter_array
+from graphite_newts.deadlines import Deadline, DeadlineExceeded
 
 NEWTS_URL = 'http://localhost:8080'
 
@@ -42,6 +52,202 @@ class TestNewtsFetch(unittest.TestCase):
         self.assertIn(-5, list(result.values()))
         self.assertIn(0.4, list(result.values()))
 
+    def testFetchMulti(self, m):
+        datapoints = [
+                [{"name": "m1", "timestamp": 1, "value": 1},
+                 {"name": "m2", "timestamp": 1, "value": "NaN"}],
+                [{"name": "m1", "timestamp": 2, "value": 2},
+                 {"name": "m2", "timestamp": 2, "value": 3}],
+            ]
+        m.post('/measurements/foo:bar?resolution=60s',
+               json=datapoints)
+        result = list(self.client.fetch_multi('foo:bar', ['m1', 'm2'],
+                0, 86400, 60))
+        self.assertEqual(len(m.request_history), 1)
+        exports = m.request_history[0].json()['exports']
+        self.assertEqual(exports, ['m1', 'm2'])
+        datasources = m.request_history[0].json()['datasources']
+        self.assertEqual([x['function'] for x in datasources],
+                         ['AVERAGE', 'AVERAGE'])
+
+        list(self.client.fetch_multi('foo:bar', ['m1', 'm2'], 0, 86400, 60,
+                                     functions={'m2': 'MAX'}))
+        datasources = m.request_history[1].json()['datasources']
+        self.assertEqual([x['function'] for x in datasources],
+                         ['AVERAGE', 'MAX'])
+        self.assertEqual(len(result), 2)
+        self.assertTrue(math.isnan(result[0][1]['m2']))
+        self.assertEqual(result[1], (2, {'m1': 2.0, 'm2': 3.0}))
+
+    def testResultDescriptor(self, m):
+        m.post('/measurements/foo:bar?resolution=300s', json=[])
+        list(self.client.fetch_multi('foo:bar', ['m1'], 0, 86400, 300,
+                                     interval='1m', heartbeat='10m'))
+        descriptor = m.last_request.json()
+        self.assertEqual(descriptor['interval'], '1m')
+        self.assertEqual(descriptor['datasources'][0]['heartbeat'], '10m')
+
+    def testFetchEager(self, m):
+        client = NewtsClient(NEWTS_URL, stream=False)
+        m.post('/measurements/foo:bar?resolution=60s',
+               json=[[{"timestamp": 1, "value": 2}]])
+        self.assertEqual(list(client.fetch('foo:bar', 'metric', 0, 60, 60)),
+                         [(1, 2.0)])
+
+    def testSearch(self, m):
+        m.get('/search', json=[{'resource': {'id': 'foo:bar'},
+                                'metrics': ['m1']}])
+        self.assertEqual(list(self.client.search('_parent:foo')),
+                         [('foo:bar', ['m1'])])
+        self.assertEqual(m.last_request.qs, {'q': ['_parent:foo']})
+
+    def testSearchEncoding(self, m):
+        m.get('/search', json=[])
+        list(self.client.search('_parent:a&b', '_parent:c+d'))
+        self.assertEqual(m.last_request.qs,
+                         {'q': ['_parent:a&b and _parent:c+d']})
+
+    def testSearchError(self, m):
+        m.get('/search', status_code=500)
+        self.assertEqual(list(self.client.search('_parent:foo')), [])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            list(self.client.search('_parent:foo', strict=True))
+
+
+class TestIterArray(unittest.TestCase):
+    def _chunks(self, data, size):
+        data = data.encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def testChunkBoundaries(self):
+        rows = [[{"timestamp": i, "value": i * 1.5, "name": u"m\u00e9"}]
+                for i in range(50)]
+        data = json.dumps(rows)
+        for size in (1, 2, 7, 64, len(data)):
+            self.assertEqual(list(iter_array(self._chunks(data, size))), rows)
+
+    def testScalars(self):
+        self.assertEqual(list(iter_array(self._chunks('[ 1, 22 ,333]', 1))),
+                         [1, 22, 333])
+        self.assertEqual(list(iter_array(self._chunks('[]', 1))), [])
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            list(iter_array(self._chunks('{"a": 1}', 4)))
+        with self.assertRaises(ValueError):
+            list(iter_array(self._chunks('[[1], [2', 4)))
+
+
+class TestNewtsSession(unittest.TestCase):
+    def testSessionPerThread(self):
+        client = NewtsClient(NEWTS_URL, pool_size=4, retries=1)
+        self.assertIs(client.session, client.session)
+
+        sessions = []
+        t = threading.Thread(target=lambda: sessions.append(client.session))
+        t.start()
+        t.join()
+        self.assertIsNot(sessions[0], client.session)
+        # the connection pool is shared
+        self.assertIs(sessions[0].get_adapter(NEWTS_URL),
+                      client.session.get_adapter(NEWTS_URL))
+
+    def testPoolConfig(self):
+        client = NewtsClient(NEWTS_URL, pool_size=4, connect_timeout=1,
+                             read_timeout=5, retries=3)
+        adapter = client.session.get_adapter(NEWTS_URL)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.connect, 3)
+        self.assertEqual(client.timeout, (1, 5))
+
+    @requests_mock.Mocker()
+    def testTimeout(self, m):
+        client = NewtsClient(NEWTS_URL, connect_timeout=1, read_timeout=5)
+        m.get('/search', json=[])
+        list(client.search('_parent:_root'))
+        self.assertEqual(m.last_request.timeout, (1, 5))
+
+
+@requests_mock.Mocker()
+class TestNewtsEndpoints(unittest.TestCase):
+    URLS = ['http://newts1:8080', 'http://newts2:8080']
+
+    def testSpread(self, m):
+        client = NewtsClient(self.URLS)
+        m.get('/search', json=[])
+        for _ in range(4):
+            list(client.search('_parent:_root'))
+        self.assertEqual(sorted(x.netloc for x in m.request_history),
+                         ['newts1:8080'] * 2 + ['newts2:8080'] * 2)
+
+    def testFailover(self, m):
+        client = NewtsClient(self.URLS, eject_failures=1)
+        m.get('http://newts1:8080/search',
+              exc=requests.exceptions.ConnectionError)
+        m.get('http://newts2:8080/search',
+              json=[{'resource': {'id': 'foo'}, 'metrics': []}])
+        for _ in range(3):
+            self.assertEqual(list(client.search('_parent:_root')),
+                             [('foo', [])])
+        # newts1 is not tried again after failing
+        self.assertEqual(sorted(x.netloc for x in m.request_history),
+                         ['newts1:8080'] + ['newts2:8080'] * 3)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = json.dumps([{'resource': {'id': self.server.name},
+                            'metrics': []}]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestNewtsHedge(unittest.TestCase):
+    def _server(self, name, delay):
+        server = Server(('127.0.0.1', 0), SlowHandler)
+        server.name = name
+        server.delay = delay
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def testHedge(self):
+        urls = [self._server('slow', 0.5), self._server('fast', 0)]
+        client = NewtsClient(urls, hedge_percentile=50)
+        client.endpoints._latencies.extend([0.01] * 100)
+        slow = client.endpoints.endpoints[0]
+        # send the request to the slow endpoint first
+        client.endpoints.endpoints[1].inflight = 1
+
+        started = time.time()
+        self.assertEqual(list(client.search('_parent:_root')),
+                         [('fast', [])])
+        self.assertLess(time.time() - started, 0.4)
+        # the request lost is let finish
+        self.assertEqual(slow.inflight, 1)
+        time.sleep(0.6)
+        self.assertEqual(slow.inflight, 0)
+
+    def testDeadline(self):
+        client = NewtsClient(self._server('slow', 1))
+        started = time.time()
+        with self.assertRaises(DeadlineExceeded):
+            list(client.search('_parent:_root', deadline=Deadline(0.2)))
+        self.assertLess(time.time() - started, 0.5)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,82 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import graphite_api_app
+from graphite_newts import consolidation
+
+
+class TestConsolidation(unittest.TestCase):
+    def testNewtsFunction(self):
+        self.assertEqual(consolidation.newts_function('max'), 'MAX')
+        self.assertEqual(consolidation.newts_function('avg'), 'AVERAGE')
+        self.assertEqual(consolidation.newts_function('MIN'), 'MIN')
+        self.assertIsNone(consolidation.newts_function('sum'))
+
+    def testTargetFunctions(self):
+        targets = [
+            "alias(consolidateBy(a.*.b, 'max'), 'x')",
+            "summarize(sumSeries(c.{d,e}), '1h', 'min')",
+            "summarize(f.g, '1h')",
+            "consolidateBy(h.i, 'sum')",
+            ")",
+        ]
+        self.assertEqual(consolidation.target_functions(targets),
+                         [('a.*.b', 'MAX'), ('c.{d,e}', None),
+                          ('f.g', None), ('h.i', None)])
+
+    def testRules(self):
+        c = consolidation.Consolidation([('*.errors', 'max')])
+        self.assertEqual(c.function('web.errors'), 'MAX')
+        self.assertEqual(c.function('web.cpu'), 'AVERAGE')
+        self.assertEqual(c.function('web.host.errors'), 'AVERAGE')
+        self.assertRaises(ValueError, consolidation.Consolidation,
+                          [('*', 'sum')])
+
+    def testRequest(self):
+        c = consolidation.Consolidation([('*.errors', 'max')])
+        with graphite_api_app.app.test_request_context(
+                "/render?target=consolidateBy(web.*,'min')"):
+            self.assertEqual(c.function('web.errors'), 'MIN')
+            self.assertEqual(c.function('db.errors'), 'MAX')
+
+    def _functions(self, query, paths):
+        c = consolidation.Consolidation()
+        with graphite_api_app.app.test_request_context('/render?' + query):
+            return [c.function(x) for x in paths]
+
+    def testSharedSeries(self):
+        # a.b is fetched once for both targets
+        self.assertEqual(self._functions(
+                "target=a.b&target=consolidateBy(a.b,'max')", ['a.b']),
+                ['AVERAGE'])
+        self.assertEqual(self._functions(
+                "target=consolidateBy(a.b,'max')&"
+                "target=consolidateBy(a.*,'min')", ['a.b', 'a.c']),
+                ['AVERAGE', 'MIN'])
+        self.assertEqual(self._functions(
+                "target=consolidateBy(a.b,'max')&"
+                "target=consolidateBy(a.b,'max')", ['a.b']), ['MAX'])
+
+    def testNotBarePath(self):
+        # the max of the sum, not the sum of the maxes
+        self.assertEqual(self._functions(
+                "target=consolidateBy(sumSeries(a.*),'max')", ['a.b']),
+                ['AVERAGE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
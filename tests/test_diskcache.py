@@ -0,0 +1,142 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+from test_cache import DictCache, Fetcher
+from graphite_newts import cache, diskcache
+
+
+def chunk(value, points=4):
+    return array('d', [float(value)] * points)
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.caches = []
+
+    def tearDown(self):
+        for c in self.caches:
+            c.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _cache(self, size=1024 * 1024, points=4, directory=None):
+        c = diskcache.DiskCache(directory or self.directory, size, points)
+        self.caches.append(c)
+        return c
+
+    def testRoundTrip(self):
+        c = self._cache()
+        self.assertEqual(c.get_many('a', 'b'), [None, None])
+        c.set_many({'a': chunk(1), 'b': chunk(2)}, 60)
+        self.assertEqual(c.get_many('a', 'b', 'c'),
+                         [chunk(1), chunk(2), None])
+        c.set_many({'a': chunk(3)}, 60)
+        self.assertEqual(c.get_many('a'), [chunk(3)])
+        # chunks of the wrong size are not stored
+        c.set_many({'d': chunk(4, points=3)}, 60)
+        self.assertEqual(c.get_many('d'), [None])
+
+    def testExpiry(self):
+        c = self._cache()
+        c.set_many({'a': chunk(1)}, -1)
+        self.assertEqual(c.get_many('a'), [None])
+
+    def testBoundedSize(self):
+        c = self._cache(size=0)
+        self.assertEqual(c.sets, 1)
+        c.get_many('k0')
+        size = os.path.getsize(c.path)
+        # the entries expiring first are evicted
+        for i in range(diskcache.WAYS + 1):
+            c.set_many({'k%d' % i: chunk(i)}, 100 + i)
+        self.assertEqual(os.path.getsize(c.path), size)
+        self.assertEqual(c.get_many('k0'), [None])
+        self.assertEqual(c.get_many('k1', 'k%d' % diskcache.WAYS),
+                         [chunk(1), chunk(diskcache.WAYS)])
+
+    def testShared(self):
+        first = self._cache()
+        second = self._cache()
+        first.set_many({'a': chunk(1)}, 60)
+        self.assertEqual(second.get_many('a'), [chunk(1)])
+
+    def testFork(self):
+        c = self._cache()
+        c.get_many('a')
+        pid = os.fork()
+        if not pid:
+            try:
+                c.set_many({'a': chunk(1)}, 60)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(c.get_many('a'), [chunk(1)])
+
+    def testLayoutChange(self):
+        first = self._cache(size=1024 * 1024)
+        first.set_many({'a': chunk(1)}, 60)
+        # a different size replaces the file
+        second = self._cache(size=2 * 1024 * 1024)
+        self.assertEqual(second.get_many('a'), [None])
+        self.assertEqual(os.path.getsize(second.path), second.file_size)
+        # which is not shared with the other process anymore
+        self.assertEqual(first.get_many('a'), [chunk(1)])
+
+    def testUnwritable(self):
+        path = os.path.join(self.directory, 'file')
+        open(path, 'w').close()
+        c = self._cache(directory=os.path.join(path, 'cache'))
+        self.assertEqual(c.get_many('a'), [None])
+        c.set_many({'a': chunk(1)}, 60)
+
+
+class TestFetchCacheDisk(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _cache(self, backend=None):
+        disk = diskcache.DiskCache(self.directory, 1024 * 1024, 10)
+        return cache.FetchCache(backend, bucket_points=10, ttl=1000,
+                                recent_ttl=10, settle=0, disk=disk)
+
+    def testDiskOnly(self):
+        fetcher = Fetcher()
+        self._cache().fetch(fetcher, 'res', ['m1'], (0, 1200, 60))
+        # as if restarted
+        buffers = self._cache().fetch(fetcher, 'res', ['m1'], (0, 1200, 60))
+        self.assertEqual(len(fetcher.calls), 1)
+        self.assertEqual(buffers['m1'].tolist(),
+                         [float(x) for x in range(0, 1200, 60)])
+
+    def testBehindBackend(self):
+        fetcher = Fetcher()
+        self._cache(DictCache()).fetch(fetcher, 'res', ['m1'],
+                                       (0, 1200, 60))
+        backend = DictCache()
+        self._cache(backend).fetch(fetcher, 'res', ['m1'], (0, 1200, 60))
+        self.assertEqual(len(fetcher.calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import unittest
+
+from graphite_newts import endpoints
+
+
+class TestEndpointPool(unittest.TestCase):
+    def _pool(self, **kwargs):
+        return endpoints.EndpointPool(['a', 'b', 'c'], **kwargs)
+
+    def _urls(self, pool, count, exclude=()):
+        urls = []
+        for _ in range(count):
+            e = pool.pick(exclude)
+            urls.append(e.url)
+            pool.done(e, 0.01)
+        return urls
+
+    def testUrls(self):
+        self.assertEqual(endpoints.endpoint_urls('http://a/'), ['http://a'])
+        self.assertEqual(endpoints.endpoint_urls(['http://a', 'http://b']),
+                         ['http://a', 'http://b'])
+        with self.assertRaises(ValueError):
+            endpoints.endpoint_urls([])
+
+    def testSpread(self):
+        pool = self._pool()
+        self.assertEqual(sorted(self._urls(pool, 6)),
+                         ['a', 'a', 'b', 'b', 'c', 'c'])
+        # the least busy endpoint is picked
+        busy = [pool.pick(), pool.pick()]
+        self.assertNotIn(pool.pick().url, [x.url for x in busy])
+        self.assertNotEqual(pool.pick(exclude=busy[:1]).url, busy[0].url)
+
+    def testEjectFailures(self):
+        pool = self._pool(max_failures=2, cooldown=60)
+        a = pool.endpoints[0]
+        for _ in range(2):
+            pool.pick()
+            pool.done(a, 0.01, ok=False)
+        self.assertIsNotNone(a.ejected_until)
+        self.assertNotIn('a', self._urls(pool, 10))
+
+        a.ejected_until = time.time() - 1
+        self.assertIn('a', self._urls(pool, 3))
+        self.assertEqual(a.failures, 0)
+
+    def testEjectSlow(self):
+        pool = self._pool(slow_latency=0.5)
+        a = pool.endpoints[0]
+        for _ in range(endpoints.SLOW_SAMPLES):
+            pool.pick()
+            pool.done(a, 1.0)
+        self.assertIsNotNone(a.ejected_until)
+
+    def testLastStanding(self):
+        pool = self._pool(max_failures=1)
+        for e in pool.endpoints:
+            pool.pick()
+            pool.done(e, 0.01, ok=False)
+        self.assertEqual(
+                len([e for e in pool.endpoints if e.ejected_until is None]),
+                1)
+
+        pool = endpoints.EndpointPool(['a'], max_failures=1)
+        pool.done(pool.pick(), 0.01, ok=False)
+        self.assertIsNone(pool.endpoints[0].ejected_until)
+
+    def testHedgeDelay(self):
+        self.assertIsNone(self._pool().hedge_delay())
+        pool = self._pool(hedge_percentile=90)
+        self.assertIsNone(pool.hedge_delay())
+        for i in range(100):
+            e = pool.pick()
+            pool.done(e, i / 100.0)
+        self.assertEqual(pool.hedge_delay(), 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
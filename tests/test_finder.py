@@ -13,10 +13,21 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import unittest
+import json
+import os
 import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import flask
+import requests_mock
 
 import graphite_api_app
+from test_cache import DictCache
 from graphite_newts import finder
 from graphite_api.node import BranchNode, LeafNode
 
@@ -28,10 +39,18 @@ class Query(object):
         self.endTime = endTime
 
 
+class FakeApp(object):
+    def __init__(self):
+        self.cache = DictCache()
+
+
 class FakeNewtsClient(object):
     def __init__(self, url):
         self._resources = {}
-        pass
+        self._broken = set()
+        self.fetches = []
+        self.functions = {}
+        self.searches = []
 
     def _parents(self, resource):
         if ':' not in resource:
@@ -51,20 +70,54 @@ class FakeNewtsClient(object):
             if values:
                 m.extend(values)
 
-    def fetch(self, resource, metric, start, end):
-        pass
-
-    def search(self, *terms):
-        for term in terms:
+    def fetch(self, resource, metric, start, end, resolution,
+            function='AVERAGE', deadline=None):
+        for timestamp, value in self._resources[resource].get(metric, []):
+            yield timestamp, value
+
+    def fetch_multi(self, resource, metrics, start, end, resolution,
+            function='AVERAGE', functions=None, interval='30s',
+            heartbeat='1m', deadline=None):
+        self.fetches.append((resource, metrics))
+        self.functions.update(functions or {})
+        if resource in self._broken:
+            raise IOError(resource)
+        rows = {}
+        for metric in metrics:
+            for timestamp, value in self._resources[resource].get(metric, []):
+                rows.setdefault(timestamp, {})[metric] = value
+        for timestamp in sorted(rows):
+            yield timestamp, rows[timestamp]
+
+    def _names(self, clauses):
+        # the _name terms, names ending with * are prefixes
+        names = []
+        for term in [x for c in clauses for x in c.strip('()').split(' OR ')]:
+            if term.startswith('_name:'):
+                names.append(re.sub(r'\\(.)', r'\1', term.split(':', 1)[1]))
+        return names
+
+    def _accept(self, names, resource):
+        name = resource.rsplit(':', 1)[-1]
+        return not names or any(
+                name.startswith(x[:-1]) if x.endswith('*') else name == x
+                for x in names)
+
+    def search(self, *terms, **kwargs):
+        self.searches.append(terms)
+        clauses = ' AND '.join(terms).split(' AND ')
+        names = self._names(clauses[1:])
+        for term in clauses[0].strip('()').split(' OR '):
             if term == '_parent:_root':
                 for r in self._resources:
-                    if ':' in r:
+                    if ':' in r or not self._accept(names, r):
                         continue
                     yield r, list(self._resources[r].keys())
             elif term.startswith('_parent:'):
                 branch = term.split(':', 1)[1]
                 for r in self._resources:
-                    if not re.match('%s:[^:]+$' % branch, r):
+                    if not re.match('%s:[^:]+$' % branch, r) or \
+                            not self._accept(names, r):
                         continue
                     yield r, list(self._resources[r].keys())
 
@@ -125,7 +178,7 @@ class TestFinderQueries(graphite_api_app.TestCase):
         self.client._insert('toplevel4:branch1', 'metric2')
 
         branch, leaf = self._run_query('*')
-        print branch, leaf
+        print(branch, leaf)
         self.assertEqual(len(branch), 5)
         self.assertEqual(len(leaf), 0)
 
@@ -141,7 +194,7 @@ class TestFinderQueries(graphite_api_app.TestCase):
         self.assertEqual(len(leaf), 0)
 
         branch, leaf = self._run_query('foo.*')
-        print branch, leaf
+        print(branch, leaf)
         self.assertEqual(len(branch), 2)
         self.assertEqual(len(leaf), 1)
 
@@ -178,7 +231,7 @@ class TestFinderQueries(graphite_api_app.TestCase):
         self.client._insert('toplevel4', 'metric')
 
         branch, leaf = self._run_query('notfound.*')
-        print branch, leaf
+        print(branch, leaf)
         self.assertEqual(len(branch), 0)
         self.assertEqual(len(leaf), 0)
 
@@ -205,6 +258,378 @@ class TestFinderQueries(graphite_api_app.TestCase):
         self.assertEqual(len(branch), 2)
         self.assertEqual(len(leaf), 0)
 
+    def testBranchPath(self):
+        self.client._insert('foo:bar:baz')
+
+        branch, leaf = self._run_query('foo.*')
+        self.assertEqual([x.path for x in branch], ['foo.bar'])
+
+        branch, leaf = self._run_query('foo.bar.*')
+        self.assertEqual([x.path for x in branch], ['foo.bar.baz'])
+
+    def testSearchesPerLevel(self):
+        for i in range(10):
+            for j in range(10):
+                self.client._insert('a:b%d:c%d' % (i, j), 'metric')
+
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'search.batch_size': 100}},
+                newts_client=self.client, app=self.app)
+        leaf = [x for x in f.find_nodes(Query('a.*.*.metric'))]
+        self.assertEqual(len(leaf), 100)
+        # one search per pattern part, the leading literal is not searched
+        self.assertEqual(len(self.client.searches), 3)
+
+    def testConcurrentSearch(self):
+        for i in range(10):
+            self.client._insert('a:b%d:c' % i, 'metric')
+
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'fetch.concurrency': 4,
+                           'search.batch_size': 3}},
+                newts_client=self.client, app=self.app)
+        leaf = [x.path for x in f.find_nodes(Query('a.*.c.metric'))]
+        self.assertEqual(sorted(leaf),
+                         sorted('a.b%d.c.metric' % i for i in range(10)))
+        # a, then 4 batches for both b* and c
+        self.assertEqual(len(self.client.searches), 9)
+        f.workers.shutdown()
+
+    def testLiteralShortcut(self):
+        self.client._insert('servers:web1:cpu', 'user')
+        self.client._insert('servers:web2:cpu', 'user')
+        self.client._insert('servers:web3:cpu', 'user')
+        self.client._insert('servers:web1:mem', 'free')
+
+        leaf = [x.path for x in self.finder.find_nodes(
+                Query('servers.{web1,web3}.cpu.user'))]
+        self.assertEqual(sorted(leaf), ['servers.web1.cpu.user',
+                                        'servers.web3.cpu.user'])
+        # servers and web* are never listed
+        self.assertEqual(self.client.searches,
+                         [(r'_parent:servers\:web1',),
+                          (r'_parent:servers\:web3',),
+                          (r'_parent:servers\:web1\:cpu',),
+                          (r'_parent:servers\:web3\:cpu',)])
+
+    def testDuplicateLiterals(self):
+        self.client._insert('servers:web1:cpu', 'user')
+
+        leaf = [x.path for x in self.finder.find_nodes(
+                Query('servers.{web1,web1}.cpu.user'))]
+        self.assertEqual(leaf, ['servers.web1.cpu.user'])
+        # web1 is searched for once
+        self.assertEqual(self.client.searches,
+                         [(r'_parent:servers\:web1',),
+                          (r'_parent:servers\:web1\:cpu',)])
+
+    def testPushdown(self):
+        self.client._insert('servers:web1:cpu', 'user')
+        self.client._insert('servers:web2:cpu', 'user')
+        self.client._insert('servers:db1:cpu', 'user')
+        self.client._insert('servers:web1:mem', 'free')
+
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'search.name_field': '_name'}},
+                newts_client=self.client, app=self.app)
+        leaf = [x.path for x in f.find_nodes(Query('servers.web*.c?u.user'))]
+        self.assertEqual(sorted(leaf), ['servers.web1.cpu.user',
+                                        'servers.web2.cpu.user'])
+        # c?u is matched client side only
+        self.assertEqual(self.client.searches[0],
+                         ('_parent:servers AND _name:web*',))
+        self.assertEqual(len(self.client.searches[1]), 1)
+
+    def testSharedReaders(self):
+        self.client._insert('foo:bar', 'metric1')
+        self.client._insert('foo:bar', 'metric2')
+        self.client._insert('foo:baz', 'metric1')
+
+        leaf = list(self.finder.find_nodes(Query('foo.*.*')))
+        self.assertEqual([x.path for x in leaf], ['foo.bar.metric1',
+                                                  'foo.bar.metric2',
+                                                  'foo.baz.metric1'])
+        self.assertEqual([x.name for x in leaf],
+                         ['metric1', 'metric2', 'metric1'])
+        self.assertIs(leaf[0].reader.context, leaf[2].reader.context)
+        self.assertIs(leaf[0].intervals, leaf[2].intervals)
+        self.assertIs(leaf[0].reader.resource, leaf[1].reader.resource)
+
+    def testMaxNodes(self):
+        for i in range(10):
+            self.client._insert('a:b%d' % i, 'metric')
+
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'find.max_nodes': 5}},
+                newts_client=self.client, app=self.app)
+        nodes = f.find_nodes(Query('a.*.metric'))
+        for _ in range(5):
+            next(nodes)
+        with self.assertRaises(finder.TooManyNodes):
+            next(nodes)
+        self.assertEqual(len(list(f.find_nodes(Query('a.b1.*')))), 1)
+
+
+class TestFinderConfig(graphite_api_app.TestCase):
+    def testClientConfig(self):
+        f = finder.NewtsFinder({'newts': {'url': 'http://newts:8080',
+                                          'http.pool_size': 3,
+                                          'http.read_timeout': 10}},
+                               app=self.app)
+        self.assertEqual(f.client.url, 'http://newts:8080')
+        self.assertEqual(f.client.timeout, (3.05, 10))
+        adapter = f.client.session.get_adapter(f.client.url)
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    def testDiskCacheConfig(self):
+        directory = tempfile.mkdtemp()
+        try:
+            f = finder.NewtsFinder({'newts': {'url': 'localhost',
+                                              'fetch.disk_cache': True,
+                                              'fetch.disk_cache_dir':
+                                                  directory}},
+                                   newts_client=FakeNewtsClient('test'),
+                                   app=self.app)
+            # no graphite-api cache configured, the disk tier only
+            self.assertIsNone(f.fetch_cache.backend)
+            self.assertEqual(f.fetch_cache.disk.points,
+                             f.config['fetch.cache_bucket_points'])
+        finally:
+            shutil.rmtree(directory)
+
+    def testSharedSearchCacheConfig(self):
+        directory = tempfile.mkdtemp()
+        try:
+            f = finder.NewtsFinder({'newts': {'url': 'localhost',
+                                              'search.shared_cache': True,
+                                              'search.shared_cache_dir':
+                                                  directory}},
+                                   newts_client=FakeNewtsClient('test'),
+                                   app=self.app)
+            self.assertEqual(f.search_cache.backend.path,
+                             os.path.join(directory, 'search.db'))
+        finally:
+            shutil.rmtree(directory)
+
+    def testLocalSearchCacheConfig(self):
+        app = flask.Flask('test')
+        app.cache = DictCache()
+        f = finder.NewtsFinder({'newts': {'url': 'localhost',
+                                          'search.local_cache_size': 1000},
+                                'cache': {}},
+                               newts_client=FakeNewtsClient('test'), app=app)
+        self.assertEqual(f.search_cache.backend.size, 1000)
+        self.assertIs(f.search_cache.backend.backend, app.cache)
+
+    def testGraphiteApiConfig(self):
+        # graphite-api loads finders while graphite_api.app is imported,
+        # which this process did already
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'graphite-api.yaml')
+            with open(path, 'w') as f:
+                # JSON is valid YAML
+                json.dump({'finders': ['graphite_newts.finder.NewtsFinder'],
+                           'search_index': os.path.join(directory, 'index'),
+                           'newts': {'url': 'http://localhost:8080'}}, f)
+            env = dict(os.environ, GRAPHITE_API_CONFIG=path)
+            output = subprocess.check_output(
+                    [sys.executable, '-c',
+                     'from graphite_api.app import app; '
+                     'print([type(x).__name__ for x in app.store.finders])'],
+                    env=env, stderr=subprocess.STDOUT)
+            self.assertIn("['NewtsFinder']", output.decode('utf-8'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestFinderIndex(graphite_api_app.TestCase):
+    def testFindFromIndex(self):
+        client = FakeNewtsClient('test')
+        client._insert('foo:bar', 'metric1')
+        client._insert('foo:baz', 'metric2')
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'index.enabled': True}},
+                newts_client=client, app=self.app)
+        f.index.stop()
+        f.index._thread.join()
+        self.assertTrue(f.index.ready)
+
+        searches = len(client.searches)
+        nodes = [x.path for x in f.find_nodes(Query('foo.*.*'))]
+        self.assertEqual(sorted(nodes), ['foo.bar.metric1', 'foo.baz.metric2'])
+        self.assertEqual(len(client.searches), searches)
+
+    @requests_mock.Mocker()
+    def testRefreshError(self, m):
+        tree = {'_parent:_root': [('a', [])],
+                '_parent:a': [('a:b', ['m'])]}
+        failing = set()
+
+        def search(request, context):
+            term = request.qs['q'][0]
+            if term in failing:
+                context.status_code = 500
+                return {}
+            return [{'resource': {'id': x}, 'metrics': y}
+                    for x, y in tree.get(term, [])]
+
+        m.get('http://newts/search', json=search)
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'http://newts', 'index.enabled': True}},
+                app=self.app)
+        f.index.stop()
+        f.index._thread.join()
+        self.assertEqual(list(f.index.find('a.b.m')), [('a:b', 'm', True)])
+
+        # a newts error is not an empty branch
+        failing.add('_parent:a')
+        f.index.refresh()
+        self.assertEqual(list(f.index.find('a.b.m')), [('a:b', 'm', True)])
+
+
+class TestFinderFetchMulti(graphite_api_app.TestCase):
+    def setUp(self):
+        super(TestFinderFetchMulti, self).setUp()
+        self.client = FakeNewtsClient('test')
+        self.finder = finder.NewtsFinder(
+                {'newts': {'url': 'localhost'}},
+                newts_client=self.client, app=self.app)
+
+    def _find_leaves(self, pattern):
+        return [x for x in self.finder.find_nodes(Query(pattern))
+                if isinstance(x, LeafNode)]
+
+    def testOneRequestPerResource(self):
+        self.client._insert('web:host1', 'cpu', [(60000, 1.0), (120000, 2.0)])
+        self.client._insert('web:host1', 'mem', [(60000, 3.0)])
+        self.client._insert('web:host2', 'cpu', [(120000, 4.0)])
+
+        nodes = self._find_leaves('web.*.*')
+        self.assertEqual(len(nodes), 3)
+        for node in nodes:
+            self.assertEqual(node.__fetch_multi__, self.finder.__fetch_multi__)
+
+        time_info, series = self.finder.fetch_multi(nodes, 0, 180)
+        self.assertEqual(time_info, (0, 180, 60))
+        self.assertEqual(sorted(r for r, _ in self.client.fetches),
+                         ['web:host1', 'web:host2'])
+        self.assertEqual(series['web.host1.cpu'], [None, 1.0, 2.0])
+        self.assertEqual(series['web.host1.mem'], [None, 3.0, None])
+        self.assertEqual(series['web.host2.cpu'], [None, None, 4.0])
+
+    def testNaNIsNone(self):
+        self.client._insert('foo', 'bar', [(0, float('nan')), (60000, 1.0)])
+
+        time_info, series = self.finder.fetch_multi(
+                self._find_leaves('foo.bar'), 0, 120)
+        self.assertEqual(series['foo.bar'], [None, 1.0])
+
+    def testReaderFetch(self):
+        self.client._insert('foo', 'bar', [(60000, 1.0), (180000, 3.0),
+                                           (240000, float('nan'))])
+        leaf, = self._find_leaves('foo.bar')
+
+        time_info, values = leaf.fetch(0, 300)
+        self.assertEqual(time_info, (0, 300, 60))
+        self.assertEqual(values, [None, 1.0, None, 3.0, None])
+
+    def testFetchCache(self):
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost'}, 'cache': {'type': 'simple'}},
+                newts_client=self.client, app=FakeApp())
+        self.client._insert('foo', 'bar', [(60000, 1.0)])
+        leaf, = [x for x in f.find_nodes(Query('foo.bar'))
+                 if isinstance(x, LeafNode)]
+
+        self.assertEqual(f.fetch_multi([leaf], 0, 120)[1]['foo.bar'],
+                         [None, 1.0])
+        self.assertEqual(leaf.fetch(0, 120)[1], [None, 1.0])
+        self.assertEqual(len(self.client.fetches), 1)
+
+    def testFunctions(self):
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost',
+                           'fetch.functions': [['web.*.errors', 'max']]}},
+                newts_client=self.client, app=self.app)
+        self.client._insert('web:host1', 'errors', [(60000, 1.0)])
+        self.client._insert('web:host1', 'cpu', [(60000, 1.0)])
+        self.client._insert('web:host2', 'cpu', [(60000, 1.0)])
+        nodes = [x for x in f.find_nodes(Query('web.*.*'))
+                 if isinstance(x, LeafNode)]
+
+        f.fetch_multi(nodes, 0, 120)
+        self.assertEqual(self.client.functions,
+                         {'errors': 'MAX', 'cpu': 'AVERAGE'})
+
+        with graphite_api_app.app.test_request_context(
+                '/render?target=consolidateBy(web.host2.cpu,"min")'):
+            f.fetch_multi(nodes, 0, 120)
+        self.assertEqual(self.client.functions,
+                         {'errors': 'MAX', 'cpu': 'MIN'})
+
+    def testResolutionLadder(self):
+        self.client._insert('foo', 'bar', [(0, 1.0), (3600000, 2.0)])
+        leaf, = self._find_leaves('foo.bar')
+
+        # 200 points by default
+        time_info, _ = self.finder.fetch_multi([leaf], 0, 86400)
+        self.assertEqual(time_info, (0, 86400, 3600))
+        time_info, values = leaf.fetch(0, 7200)
+        self.assertEqual(time_info, (0, 7200, 60))
+
+        with graphite_api_app.app.test_request_context(
+                '/render?target=foo.bar&maxDataPoints=10'):
+            time_info, values = self.finder.fetch_multi([leaf], 0, 7200)
+            self.assertEqual(time_info, (0, 7200, 3600))
+            self.assertEqual(values['foo.bar'], [1.0, 2.0])
+
+    def testConcurrentFetch(self):
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'fetch.concurrency': 4,
+                           'fetch.render_concurrency': 2}},
+                newts_client=self.client, app=self.app)
+        for i in range(10):
+            self.client._insert('host%d' % i, 'cpu', [(60000, float(i))])
+        self.client._broken.add('host3')
+
+        nodes = [x for x in f.find_nodes(Query('*.cpu'))
+                 if isinstance(x, LeafNode)]
+        time_info, series = f.fetch_multi(nodes, 0, 120)
+        self.assertEqual(len(self.client.fetches), 10)
+        self.assertEqual(len(series), 10)
+        self.assertEqual(series['host3.cpu'], [None, None])
+        self.assertEqual(series['host9.cpu'], [None, 9.0])
+        f.workers.shutdown()
+
+    def testDeadline(self):
+        class SlowClient(FakeNewtsClient):
+            def fetch_multi(self, resource, *args, **kwargs):
+                if resource == 'slow':
+                    time.sleep(0.5)
+                    kwargs['deadline'].check()
+                return super(SlowClient, self).fetch_multi(
+                        resource, *args, **kwargs)
+
+        client = SlowClient('test')
+        client._insert('slow', 'cpu', [(60000, 1.0)])
+        client._insert('fast', 'cpu', [(60000, 2.0)])
+        f = finder.NewtsFinder(
+                {'newts': {'url': 'localhost', 'fetch.concurrency': 4,
+                           'render.deadline': 0.2}},
+                newts_client=client, app=self.app)
+
+        with graphite_api_app.app.test_request_context('/render'):
+            nodes = [x for x in f.find_nodes(Query('*.cpu'))
+                     if isinstance(x, LeafNode)]
+            started = time.time()
+            time_info, series = f.fetch_multi(nodes, 0, 120)
+            self.assertLess(time.time() - started, 0.4)
+            self.assertEqual(series, {'slow.cpu': [None, None],
+                                      'fast.cpu': [None, 2.0]})
+            self.assertEqual(flask.g.newts_dropped, 1)
+        f.workers.shutdown()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,110 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import graphite_api_app
+from graphite_newts.index import MetricIndex
+
+
+class FakeTree(object):
+    def __init__(self, resources):
+        # resource -> metrics
+        self.resources = resources
+        self.calls = 0
+        # parents failing to be searched
+        self.broken = set()
+
+    def search(self, parents):
+        self.calls += 1
+        for parent in parents:
+            if parent in self.broken:
+                yield parent, None
+                continue
+            children = []
+            for resource, metrics in sorted(self.resources.items()):
+                if parent is None:
+                    if ':' not in resource:
+                        children.append((resource, metrics))
+                elif ':' in resource and resource.rsplit(':', 1)[0] == parent:
+                    children.append((resource, metrics))
+            yield parent, children
+
+
+class TestMetricIndex(unittest.TestCase):
+    def setUp(self):
+        self.tree = FakeTree({
+            'web': [],
+            'web:host1': ['cpu', 'mem'],
+            'web:host2': ['cpu'],
+            'web:host2:disk': ['read', 'write'],
+            'db': ['up'],
+        })
+        self.index = MetricIndex(self.tree.search)
+        self.index.refresh()
+
+    def _find(self, pattern):
+        return sorted(self.index.find(pattern))
+
+    def testLoad(self):
+        self.assertTrue(self.index.ready)
+        # one search per tree level
+        self.assertEqual(self.tree.calls, 4)
+        self.assertEqual(self.index.stats['resources'], 5)
+        self.assertEqual(self.index.stats['metrics'], 6)
+        self.assertGreater(self.index.stats['bytes'], 0)
+
+    def testFind(self):
+        self.assertEqual(self._find('*'),
+                         [('db', None, False), ('web', None, False)])
+        self.assertEqual(self._find('web.*'),
+                         [('web:host1', None, False),
+                          ('web:host2', None, False)])
+        self.assertEqual(self._find('web.*.cpu'),
+                         [('web:host1', 'cpu', True),
+                          ('web:host2', 'cpu', True)])
+        self.assertEqual(self._find('web.host2.*'),
+                         [('web:host2', 'cpu', True),
+                          ('web:host2:disk', None, False)])
+        self.assertEqual(self._find('nothere.*'), [])
+
+    def testRefresh(self):
+        host1 = self.index._root.children['web'].children['host1']
+        del self.tree.resources['web:host2:disk']
+        self.tree.resources['web:host1'] = ['cpu']
+        self.tree.resources['web:host3'] = ['cpu']
+        self.index.refresh()
+
+        self.assertIs(self.index._root.children['web'].children['host1'],
+                      host1)
+        self.assertEqual(self._find('web.*.*'),
+                         [('web:host1', 'cpu', True),
+                          ('web:host2', 'cpu', True),
+                          ('web:host3', 'cpu', True)])
+
+    def testFailedSearch(self):
+        self.tree.broken.add('web')
+        del self.tree.resources['web:host2:disk']
+        self.index.refresh()
+        self.assertTrue(self.index.ready)
+        # web is kept, its children are refreshed still
+        self.assertEqual(self._find('web.*.*'),
+                         [('web:host1', 'cpu', True),
+                          ('web:host1', 'mem', True),
+                          ('web:host2', 'cpu', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from graphite_newts import patterns
+
+ENTRIES = ['foo', 'bar', 'baz', 'web1', 'web2', 'web10', 'a.b', 'x{y']
+
+
+class TestPatterns(unittest.TestCase):
+    def _match(self, part):
+        return patterns.match(ENTRIES, part)
+
+    def testWildcards(self):
+        self.assertEqual(self._match('*'), sorted(ENTRIES))
+        self.assertEqual(self._match('ba*'), ['bar', 'baz'])
+        self.assertEqual(self._match('web?'), ['web1', 'web2'])
+        self.assertEqual(self._match('a?b'), ['a.b'])
+        self.assertEqual(self._match('nothere*'), [])
+
+    def testCharacterClass(self):
+        self.assertEqual(self._match('ba[rz]'), ['bar', 'baz'])
+        self.assertEqual(self._match('ba[!r]'), ['baz'])
+        self.assertEqual(self._match('web[0-1]*'), ['web1', 'web10'])
+
+    def testBraces(self):
+        self.assertEqual(self._match('{foo,bar}'), ['bar', 'foo'])
+        self.assertEqual(self._match('web{1,2}'), ['web1', 'web2'])
+        self.assertEqual(self._match('{f*,web1?}'), ['foo', 'web10'])
+        self.assertEqual(self._match('{ba{r,z},foo}'), ['bar', 'baz', 'foo'])
+        # unbalanced braces are literals
+        self.assertEqual(self._match('x{y'), ['x{y'])
+        self.assertEqual(self._match('x{*'), ['x{y'])
+
+    def testLiterals(self):
+        self.assertEqual(patterns.literals('foo'), ['foo'])
+        self.assertEqual(patterns.literals('web{1,2}'), ['web1', 'web2'])
+        self.assertEqual(patterns.literals('web{2,1,2}'), ['web2', 'web1'])
+        self.assertEqual(patterns.literals('{a,b}{1,2}'),
+                         ['a1', 'a2', 'b1', 'b2'])
+        self.assertIsNone(patterns.literals('web*'))
+        self.assertIsNone(patterns.literals('{a*,b}'))
+        self.assertIsNone(patterns.literals('{a,b}{c,d}', limit=3))
+
+    def testSearchExpression(self):
+        self.assertEqual(patterns.search_expression('web1', '_name'),
+                         '_name:web1')
+        self.assertEqual(patterns.search_expression('host-1*', '_name'),
+                         r'_name:host\-1*')
+        self.assertEqual(patterns.search_expression('web{1,2}*', '_name'),
+                         '(_name:web1* OR _name:web2*)')
+        # left to client side matching
+        for part in ('*', 'a*b', 'h?', 'web[12]', '{a,b*}x'):
+            self.assertIsNone(patterns.search_expression(part, '_name'))
+
+    def testCache(self):
+        regex = patterns.compile_part('cached*')
+        self.assertIs(patterns.compile_part('cached*'), regex)
+
+
+if __name__ == '__main__':
+    unittest.main()
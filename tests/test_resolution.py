@@ -0,0 +1,59 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+import graphite_api_app
+from graphite_newts import resolution
+
+
+class TestLadder(unittest.TestCase):
+    def setUp(self):
+        self.ladder = resolution.Ladder()
+
+    def testSnap(self):
+        self.assertEqual(self.ladder.rung(0, 3600, 200).step, 60)
+        self.assertEqual(self.ladder.rung(0, 86400, 200).step, 3600)
+        self.assertEqual(self.ladder.rung(0, 86400, 1440).step, 60)
+        self.assertEqual(self.ladder.rung(0, 86400, 1439).step, 300)
+        # past the coarsest step
+        self.assertEqual(self.ladder.rung(0, 86400 * 3650, 10).step, 86400)
+
+    def testRungs(self):
+        ladder = resolution.Ladder([
+            {'step': 600, 'heartbeat': '20m'},
+            {'step': 10, 'interval': '5s', 'heartbeat': '20s'},
+        ])
+        rung = ladder.rung(0, 1000, 100)
+        self.assertEqual((rung.step, rung.interval, rung.heartbeat),
+                         (10, '5s', '20s'))
+        rung = ladder.rung(0, 10000, 100)
+        self.assertEqual((rung.step, rung.interval, rung.heartbeat),
+                         (600, '30s', '20m'))
+        self.assertRaises(ValueError, resolution.Ladder, [])
+
+    def testMaxDataPoints(self):
+        with graphite_api_app.app.test_request_context(
+                '/render?maxDataPoints=20'):
+            self.assertEqual(resolution.request_maxpoints(), 20)
+            self.assertEqual(self.ladder.rung(0, 3600, 200).step, 300)
+        with graphite_api_app.app.test_request_context(
+                '/render?maxDataPoints=bogus'):
+            self.assertIsNone(resolution.request_maxpoints())
+        self.assertIsNone(resolution.request_maxpoints())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from graphite_newts import cache, searchstore
+
+
+class TestSearchStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for s in self.stores:
+            s.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _store(self, size=1024 * 1024, directory=None):
+        s = searchstore.SearchStore(directory or self.directory, size)
+        self.stores.append(s)
+        return s
+
+    def testRoundTrip(self):
+        s = self._store()
+        self.assertIsNone(s.get('a'))
+        s.set('a', (100.0, True, b'\x00data'), 60)
+        s.set('b', (200.0, False, None), 60)
+        self.assertEqual(s.get_many('a', 'b', 'c'),
+                         [(100.0, True, b'\x00data'), (200.0, False, None),
+                          None])
+        s.set('a', (300.0, True, b''), 60)
+        self.assertEqual(s.get('a'), (300.0, True, b''))
+
+    def testExpiry(self):
+        s = self._store()
+        s.set('a', (0, True, b'data'), -1)
+        self.assertIsNone(s.get('a'))
+
+    def testShared(self):
+        first = self._store()
+        second = self._store()
+        first.set('a', (100.0, True, b'data'), 60)
+        self.assertEqual(second.get('a'), (100.0, True, b'data'))
+
+    def testFork(self):
+        s = self._store()
+        s.get('a')
+        pid = os.fork()
+        if not pid:
+            try:
+                s.set('a', (100.0, True, b'data'), 60)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(s.get('a'), (100.0, True, b'data'))
+
+    def testBoundedSize(self):
+        s = self._store(size=0)
+        for i in range(searchstore.PRUNE_EVERY):
+            s.set('k%d' % i, (0, True, b'x' * 100), 100 + i)
+        # the entries evicted first are deleted
+        self.assertIsNone(s.get('k0'))
+        self.assertIsNotNone(s.get('k%d' % (searchstore.PRUNE_EVERY - 1)))
+
+    def testUnwritable(self):
+        path = os.path.join(self.directory, 'file')
+        open(path, 'w').close()
+        s = self._store(directory=os.path.join(path, 'cache'))
+        self.assertIsNone(s.get('a'))
+        s.set('a', (100.0, True, b'data'), 60)
+
+    def testSearchCache(self):
+        results = [('a:b', ['m1']), ('a:c', ['m2'])]
+        calls = []
+
+        def search():
+            calls.append(1)
+            return results
+
+        first = cache.SearchCache(self._store())
+        second = cache.SearchCache(self._store())
+        self.assertEqual(list(first.get('_parent:a', search)), results)
+        # another process finds it
+        self.assertEqual(list(second.get('_parent:a', search)), results)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
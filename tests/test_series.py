@@ -0,0 +1,46 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from graphite_newts import series
+
+
+class TestSeriesBuffer(unittest.TestCase):
+    def _fill(self):
+        buf = series.SeriesBuffer(600, 900, 60)
+        buf.add(540, 0.0)
+        buf.add(600, 1.0)
+        buf.add(719, 2.0)
+        buf.add(780, float('nan'))
+        buf.add(900, 5.0)
+        return buf
+
+    def testAlignment(self):
+        buf = self._fill()
+        self.assertEqual(len(buf.values), 5)
+        self.assertEqual(buf.tolist(), [1.0, 2.0, None, None, None])
+
+    def testWithoutNumpy(self):
+        numpy, series.numpy = series.numpy, None
+        try:
+            self.assertEqual(self._fill().tolist(),
+                             [1.0, 2.0, None, None, None])
+        finally:
+            series.numpy = numpy
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import unittest
+
+import flask
+import requests_mock
+
+import graphite_api_app
+from test_cache import DictCache
+from test_finder import FakeNewtsClient, Query
+from graphite_newts import finder, stats
+from graphite_newts.client import NewtsClient
+
+
+class RecordingSink(object):
+    def __init__(self):
+        self.records = []
+
+    def count(self, name, value):
+        self.records.append(('count', name, value))
+
+    def gauge(self, name, value):
+        self.records.append(('gauge', name, value))
+
+    def timing(self, name, seconds):
+        self.records.append(('timing', name, seconds))
+
+    def observe(self, name, value):
+        self.records.append(('observe', name, value))
+
+    def total(self, kind, name):
+        return sum(v for k, n, v in self.records if (k, n) == (kind, name))
+
+
+class TestStats(unittest.TestCase):
+    def testNullStats(self):
+        s = stats.NullStats()
+        self.assertFalse(s.enabled)
+        with s.timer('foo'):
+            s.incr('foo')
+
+    def testStats(self):
+        sink = RecordingSink()
+        s = stats.Stats(sink, prefix='p')
+        s.incr('a')
+        s.incr('a', 2)
+        s.adjust('b', 1)
+        s.adjust('b', 1)
+        s.adjust('b', -1)
+        s.observe('c', 10)
+        with s.timer('d'):
+            pass
+        self.assertEqual(sink.total('count', 'p.a'), 3)
+        self.assertEqual([v for k, n, v in sink.records if k == 'gauge'],
+                         [1, 2, 1])
+        self.assertEqual(sink.total('observe', 'p.c'), 10)
+        self.assertEqual([n for k, n, v in sink.records if k == 'timing'],
+                         ['p.d'])
+
+    def testStatsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        sink = stats.StatsdSink('127.0.0.1', receiver.getsockname()[1])
+        s = stats.Stats(sink, prefix='newts')
+        s.incr('http.search.requests')
+        s.timing('http.search.latency', 0.25)
+        self.assertEqual(receiver.recv(1024),
+                         b'newts.http.search.requests:1|c')
+        self.assertEqual(receiver.recv(1024),
+                         b'newts.http.search.latency:250.000|ms')
+        receiver.close()
+
+    def testPrometheus(self):
+        sink = stats.PrometheusSink()
+        s = stats.Stats(sink, prefix='newts')
+        s.incr('cache.search.hits', 3)
+        s.adjust('http.inflight', 2)
+        s.timing('find.duration', 0.5)
+        s.timing('find.duration', 1.5)
+
+        app = flask.Flask('test')
+        sink.mount(app, '/newts/metrics')
+        response = app.test_client().get('/newts/metrics')
+        self.assertEqual(response.status_code, 200)
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertIn('newts_cache_search_hits_total 3', lines)
+        self.assertIn('newts_http_inflight 2', lines)
+        self.assertIn('# TYPE newts_find_duration_seconds summary', lines)
+        self.assertIn('newts_find_duration_seconds_count 2', lines)
+        self.assertIn('newts_find_duration_seconds_sum 2.0', lines)
+
+
+class TestClientStats(unittest.TestCase):
+    @requests_mock.Mocker()
+    def testHttpStats(self, m):
+        sink = RecordingSink()
+        client = NewtsClient('http://localhost:8080',
+                             stats=stats.Stats(sink, prefix=''))
+        m.post('/measurements/foo', json=[[{'name': 'm', 'timestamp': 1000,
+                                            'value': 1}],
+                                          [{'name': 'm', 'timestamp': 2000,
+                                            'value': 2}]])
+        m.get('/search', status_code=500)
+
+        list(client.fetch_multi('foo', ['m'], 0, 60, 1))
+        list(client.search('_parent:_root'))
+        self.assertEqual(sink.total('count', 'http.measurements.requests'),
+                         1)
+        self.assertGreater(sink.total('count', 'http.measurements.bytes'), 0)
+        self.assertEqual(sink.total('count', 'fetch.points'), 2)
+        self.assertEqual(sink.total('count', 'http.search.errors'), 1)
+        # every request is done, streamed or failed
+        self.assertEqual([v for k, n, v in sink.records if k == 'gauge'],
+                         [1, 0, 1, 0])
+
+
+class TestFinderStats(graphite_api_app.TestCase):
+    def testFinderStats(self):
+        client = FakeNewtsClient('test')
+        client._insert('a:b:c', 'metric', [(60000, 1.0)])
+
+        app = flask.Flask('test')
+        app.cache = DictCache()
+        f = finder.NewtsFinder({'newts': {'url': 'localhost',
+                                          'stats.sink': 'prometheus'},
+                                'cache': {}},
+                               newts_client=client, app=app)
+        for _ in range(2):
+            nodes = list(f.find_nodes(Query('a.*.*.metric')))
+        nodes[0].reader.fetch(0, 120)
+
+        lines = app.test_client().get('/newts/metrics').data
+        lines = lines.decode('utf-8').splitlines()
+        self.assertIn('graphite_newts_find_requests_total 2', lines)
+        # the children of a, a:b and a:b:c are searched, a is not
+        self.assertIn('graphite_newts_find_searches_sum 6.0', lines)
+        self.assertIn('graphite_newts_cache_search_hits_total 3', lines)
+        self.assertIn('graphite_newts_cache_search_misses_total 3', lines)
+        self.assertIn('graphite_newts_fetch_series_total 1', lines)
+
+    def testUnknownSink(self):
+        with self.assertRaises(ValueError):
+            finder.NewtsFinder({'newts': {'stats.sink': 'syslog'}},
+                               newts_client=FakeNewtsClient('test'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import flask
+
+from test_cache import DictCache
+from test_finder import FakeNewtsClient, Query
+from graphite_newts import finder, warmer
+
+
+class TestCacheWarmer(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'warmer', 'warmer.json')
+        self.app = flask.Flask('test')
+        self.app.cache = DictCache()
+        self.client = FakeNewtsClient('test')
+        self.client._insert('a:b', 'm1', [(60000, 1.0)])
+        self.client._insert('a:c', 'm1', [(60000, 2.0)])
+        self.finders = []
+
+    def tearDown(self):
+        for f in self.finders:
+            f.warmer.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _finder(self, **config):
+        config.update({'url': 'localhost', 'warmer.enabled': True,
+                       'warmer.path': self.path})
+        f = finder.NewtsFinder({'newts': config, 'cache': {}},
+                               newts_client=self.client, app=self.app)
+        self.finders.append(f)
+        return f
+
+    def _save(self, queries):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({'version': warmer.FORMAT_VERSION,
+                       'queries': queries}, f)
+
+    def _wait_ready(self, view):
+        for _ in range(100):
+            response = view.get('/newts/ready')
+            if response.status_code == 200:
+                return json.loads(response.data.decode('utf-8'))
+            time.sleep(0.02)
+        self.fail('never ready')
+
+    def testRecord(self):
+        w = self._finder(**{'warmer.entries': 2}).warmer
+        queries = [('a.*', 0, 0, 2), ('a.*.m1', 1000, 4590, 3),
+                   ('a.b.m1', 0, 0, 1)]
+        with self.app.test_request_context():
+            for pattern, start, end, times in queries:
+                for _ in range(times):
+                    list(w.finder.find_nodes(Query(pattern, start, end)))
+        # not recorded, outside of requests
+        list(w.finder.find_nodes(Query('x.*')))
+
+        w.save()
+        self.assertEqual(sorted(w.load()),
+                         [('a.*', None, 1), ('a.*.m1', 3600, 1)])
+        self.assertEqual(w.counts, {})
+
+    def testReplay(self):
+        self._save([['a.*', 3600, 10], ['a.*.m1', 3600, 5],
+                    ['broken.*', None, 1]])
+        self.client._broken.add('a:c')
+        f = self._finder(**{'warmer.threshold': 1})
+        state = self._wait_ready(self.app.test_client())
+        self.assertEqual(state, {'ready': True, 'total': 3, 'done': 3,
+                                 'failed': 0})
+        # the caches are warm
+        searches = len(self.client.searches)
+        self.assertGreater(searches, 0)
+        self.assertTrue(any(x.startswith('newts-fetch')
+                            for x in self.app.cache.data))
+        list(f.find_nodes(Query('a.*.m1')))
+        self.assertEqual(len(self.client.searches), searches)
+
+    def testDecay(self):
+        self._save([['a.*', None, 8]])
+        first = self._finder(**{'warmer.interval': 3600}).warmer
+        second = self._finder(**{'warmer.interval': 3600}).warmer
+        first.save()
+        second.save()
+        # halved once per interval, not once per process
+        self.assertEqual(first.load(), [('a.*', None, 4)])
+
+    def testFailedReplay(self):
+        self._save([['a.*', None, 1]])
+        f = self._finder()
+
+        def broken(query):
+            raise IOError('broken')
+
+        f.find_nodes = broken
+        w = warmer.CacheWarmer(f, self.path, timeout=3600)
+        w._started = time.time()
+        w.replay()
+        # failed replays do not count
+        self.assertEqual(w.progress, {'total': 1, 'done': 1, 'failed': 1})
+        self.assertFalse(w.ready)
+        w.timeout = 0
+        w._check_ready()
+        self.assertTrue(w.ready)
+
+    def testNotReady(self):
+        self._save([['a.*', None, 1]])
+        release = threading.Event()
+        search = self.client.search
+
+        def blocked(*terms, **kwargs):
+            release.wait()
+            return search(*terms, **kwargs)
+
+        self.client.search = blocked
+        self._finder()
+        response = self.app.test_client().get('/newts/ready')
+        self.assertEqual(response.status_code, 503)
+        release.set()
+        self._wait_ready(self.app.test_client())
+
+    def testNothingSaved(self):
+        self._finder()
+        self.assertTrue(self._wait_ready(self.app.test_client())['ready'])
+
+
+if __name__ == '__main__':
+    unittest.main()
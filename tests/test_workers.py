@@ -0,0 +1,83 @@
+#   Copyright (C) 2015 Filippo Giunchedi
+#                 2015 Wikimedia Foundation
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from graphite_newts.deadlines import Deadline, DeadlineExceeded
+from graphite_newts.workers import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+    def _square(self, x):
+        if x == 3:
+            raise ValueError(x)
+        # finish in reverse order
+        time.sleep((10 - x) * 0.001)
+        return x * x
+
+    def testInline(self):
+        pool = WorkerPool(1)
+        results = list(pool.map(self._square, range(5)))
+        self.assertEqual([r for _, r, _ in results], [0, 1, 4, None, 16])
+        self.assertIsInstance(results[3][2], ValueError)
+
+    def testOrderAndErrors(self):
+        pool = WorkerPool(4)
+        results = list(pool.map(self._square, range(10)))
+        self.assertEqual([x for x, _, _ in results], list(range(10)))
+        self.assertEqual(results[9][1], 81)
+        self.assertIsNone(results[3][1])
+        self.assertIsInstance(results[3][2], ValueError)
+        pool.shutdown()
+
+    def testLimit(self):
+        pool = WorkerPool(8)
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def work(x):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.005)
+            with lock:
+                state['running'] -= 1
+            return x
+
+        results = [r for _, r, _ in pool.map(work, range(20), limit=2)]
+        self.assertEqual(results, list(range(20)))
+        self.assertLessEqual(state['max'], 2)
+        pool.shutdown()
+
+    def testDeadline(self):
+        def work(x):
+            time.sleep(x)
+            return x
+
+        for size in (1, 4):
+            pool = WorkerPool(size)
+            started = time.time()
+            results = list(pool.map(work, [0, 0.5, 0, 0.5, 0.5],
+                                    deadline=Deadline(0.2)))
+            self.assertLess(time.time() - started, 0.65)
+            self.assertEqual(results[0][1], 0)
+            self.assertIsInstance(results[-1][2], DeadlineExceeded)
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()